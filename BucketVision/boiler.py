@@ -1,14 +1,18 @@
 import cv2
 import numpy as np
 import math
+from featurebackend import featureBackend
 
 class Boiler:
     """
     An OpenCV pipeline generated by GRIP.
     """
     
-    def __init__(self):
+    def __init__(self, backend='surf'):
         """initializes all values to presets or None if need to be set
+
+        backend names the feature detector and matcher to use (see
+        featurebackend.py); 'orb' is much faster than 'surf'
         """
         self.MIN_MATCH_COUNT = 10
 
@@ -16,16 +20,20 @@ class Boiler:
         self.trainingImage = cv2.imread("redBoilerTrainWhole.jpg",cv2.IMREAD_GRAYSCALE)
         print(self.trainingImage.shape)        
 
-        # Initiate a detector
-        #self.detector = cv2.xfeatures2d.SIFT_create()
-        self.detector = cv2.xfeatures2d.SURF_create()
-        self.norm = cv2.NORM_L2       
-        # find the keypoints and descriptors with SIFT
-        self.kp1, self.des1 = self.detector.detectAndCompute(self.trainingImage,None)
+        # Initiate a detector and matcher, and find and index the keypoints
+        # and descriptors of the training image; they are the same every
+        # time, so after the first boot they come from the cache (see
+        # descriptorcache.py)
+        self.backend = featureBackend(backend)
+        self.backend.train(self.trainingImage)
+
+        # The homography from the training image to the last frame, or None
+        # if the boiler was not found in it
+        self.homography = None
 
-        # create BFMatcher object
-        self.crossCheck = False
-        self.bf = cv2.BFMatcher(self.norm, self.crossCheck)
+        # Camera frame our image is a copy of, if the BucketProcessor gives
+        # us one, so we can share its gray image (see framecache.py)
+        self.frame = None
 
 
     def process(self, source0):
@@ -33,68 +41,54 @@ class Boiler:
         Runs the pipeline and sets all outputs to new values.
         """
         
-        img2 = cv2.cvtColor(source0, cv2.COLOR_BGR2GRAY)
-        kp2, des2 = self.detector.detectAndCompute(img2,None)
-
-        # Match descriptors.
-        if (self.crossCheck == True):
-            matches = self.bf.match(self.des1,des2)
-            # Sort them in the order of their distance.
-            matches = sorted(matches, key = lambda x:x.distance)
+        if (self.frame is not None):
+            img2 = self.frame.cache.gray()
         else:
-            if (des2 == None):
-                matches = None
-            else:
-                matches = self.bf.knnMatch(self.des1,des2,k=2)
-            
-        if ((self.crossCheck == False) and (matches != None) and (len(matches) > 1)):
-            # store all the good matches as per Lowe's ratio test.
-            good = []
-            for m,n in matches:
-                if m.distance < 0.7*n.distance:
-                    good.append(m)
+            img2 = cv2.cvtColor(source0, cv2.COLOR_BGR2GRAY)
+        kp2, des2 = self.backend.detect(img2)
+        self.homography = None
+
+        # Match descriptors, keeping the good matches as per Lowe's ratio
+        # test
+        src_pts, dst_pts = self.backend.match(kp2, des2)
             
-            goodCount= len(good)
-            if (goodCount>self.MIN_MATCH_COUNT):
-                src_pts = np.float32([ self.kp1[m.queryIdx].pt for m in good ]).reshape(-1,1,2)
-                dst_pts = np.float32([ kp2[m.trainIdx].pt for m in good ]).reshape(-1,1,2)
-                M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,5.0)
-                if (mask != None):
-                    matchesMask = mask.ravel().tolist()
-                    h,w = self.trainingImage.shape
-                    pts = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
-                    dst = cv2.perspectiveTransform(pts,M)
-                    
-                    
-                    angle = (goodCount-self.MIN_MATCH_COUNT-1)
-                    if (angle > 50):
-                        angle = 50
-                    
-                    angle = math.pi/2 * (angle / 50)
-                    r = int(math.cos(angle)*255)
-                    g = int(math.sin(angle)*255)
-                    
-                    cv2.polylines(source0,[np.int32(dst)],True,(0,g,r),2, cv2.LINE_AA)
+        goodCount= len(src_pts)
+        if (goodCount>self.MIN_MATCH_COUNT):
+            M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,5.0)
+            if ((mask is not None) and (M is not None)):
+                self.homography = M
+                matchesMask = mask.ravel().tolist()
+                h,w = self.trainingImage.shape
+                pts = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
+                dst = cv2.perspectiveTransform(pts,M)
+                
                 
-                # The above polygon should be a quadralateral and should
-                # represent the extent of the boiler (even beyond the image)
-                # With some calibration we should be able to estimate the
-                # distance and angle, as well as estimate where the high
-                # goal should be.
+                angle = (goodCount-self.MIN_MATCH_COUNT-1)
+                if (angle > 50):
+                    angle = 50
                 
-            else:
+                angle = math.pi/2 * (angle / 50)
+                r = int(math.cos(angle)*255)
+                g = int(math.sin(angle)*255)
                 
-                #print("Not enough matches are found - %d/%d" % (len(good),self.MIN_MATCH_COUNT))
-                matchesMask = None
+                cv2.polylines(source0,[np.int32(dst)],True,(0,g,r),2, cv2.LINE_AA)
             
+            # The above polygon should be a quadralateral and should
+            # represent the extent of the boiler (even beyond the image)
+            # With some calibration we should be able to estimate the
+            # distance and angle, as well as estimate where the high
+            # goal should be.
             
+        else:
+            
+            #print("Not enough matches are found - %d/%d" % (len(good),self.MIN_MATCH_COUNT))
+            matchesMask = None
+        
+        
 #            draw_params = dict(matchColor = (0,255,0), # draw matches in green color
 #                               singlePointColor = None,
 #                               matchesMask = matchesMask, # draw only inliers
 #                               flags = 2)
-            
-            #img3 = cv2.drawMatches(self.trainingImage,self.kp1,img2,kp2,good,None,**draw_params)
-                
-#        else:
-#            ## Draw first 10 matches.
-#            img3 = cv2.drawMatches(self.trainingImage,self.kp1,img2,kp2,matches[:10], None, flags=2)        
\ No newline at end of file
+        
+        #img3 = cv2.drawMatches(self.trainingImage,self.backend.keypoints,img2,kp2,good,None,**draw_params)
+        
\ No newline at end of file
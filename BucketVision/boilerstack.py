@@ -1,6 +1,10 @@
 import cv2
 import numpy as np
 from targetdata import TargetData
+from clock import monotonic
+from contourfilter import filterContours
+from hslthreshold import HSLThreshold
+from candidatepairs import rectArrays, upperPairs, bestPair
 
 class BoilerStack:
     """
@@ -23,6 +27,19 @@ class BoilerStack:
         self.__hsl_threshold_hue = [51.798561151079134, 93.99317406143345]
         self.__hsl_threshold_saturation = [71.08812949640287, 255.0]
         self.__hsl_threshold_luminance = [36.690647482014384, 255.0]
+        # Lookup table version of GRIP's cvtColor()/inRange(); building the
+        # table takes a moment, so start it now in the background
+        self.__hsl_threshold = HSLThreshold()
+        self.__hsl_threshold.warmUp(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+
+        # The camera frame our image is a copy of, when the BucketProcessor
+        # gives us one; other pipelines on the same frame with the same
+        # thresholds then share one mask (see framecache.py)
+        self.frame = None
+
+        # Monotonic time the frame was captured, when the BucketProcessor
+        # tells us (see clock.py); published as the latency of our results
+        self.captureTime = None
 
         self.hsl_threshold_output = None
 
@@ -59,7 +76,12 @@ class BoilerStack:
 
         # Step HSL_Threshold0:
         self.__hsl_threshold_input = source0
-        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        if (self.frame is not None):
+            # The cached mask is shared and findContours() modifies its
+            # input, so we work on a copy
+            (self.hsl_threshold_output) = self.frame.cache.hslThreshold(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance, self.__hsl_threshold).copy()
+        else:
+            (self.hsl_threshold_output) = self.__hsl_threshold.threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
 
         # Step Find_Contours0:
         self.__find_contours_input = self.hsl_threshold_output
@@ -67,7 +89,7 @@ class BoilerStack:
 
         # Step Filter_Contours0:
         self.__filter_contours_contours = self.find_contours_output
-        (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
+        (self.filter_contours_output) = filterContours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
 
         # Optionally draw the contours for debug
         # For now, just uncomment as needed
@@ -189,77 +211,57 @@ class BoilerStack:
         observations = []
         observationsVerified = False
         if (numDetections > 2):
-            i = 0
-            for di in detections:
-                i = i + 1
-                xi = di[0][0]
-                yi = di[0][1]
-                wi = di[1][0]
-                hi = di[1][1]
-                
-                for dj in detections[i:]:
-                    xj = dj[0][0]
-                    yj = dj[0][1]
-                    wj = dj[1][0]
-                    hj = dj[1][1]
-
-                    # We care about top/bottom: the top target should appear
-                    # twice as high as the bottom target and be centered
-                    # within 5 degrees and be spaced approximately the same
-                    # as the height of the top target.
-                    
-                    # determine which is on top
-                    if (yi < yj):
-                        top = di
-                        topx = xi
-                        topy = yi
-                        topw = wi
-                        toph = hi
-                        
-                        bot = dj
-                        botx = xj
-                        boty = yj
-                        botw = wj
-                        both = hj
-                    else:
-                        top = dj
-                        topx = xj
-                        topy = yj
-                        topw = wj
-                        toph = hj
-                        
-                        bot = di
-                        botx = xi
-                        boty = yi
-                        botw = wi
-                        both = hi
-                    
-                    
-                    # First top must be approximately 2x taller than bottom
-                    # We will allow a 10% error (0.2 to 0.4 inches total) on 
-                    # either side
-                    if (1.8 <= toph/both <= 2.2):
-                        # To be the correct target, the centers must be spaced 7"
-                        # apart and within 5 degrees of vertical.
-                        # Sum of top (4") and bottom (2") heights is  assumed 6"
-                        inchh = (toph + both) / 6.0
-                        deltay = abs(topy - boty)
-                        if (6.5 <= (deltay/inchh) <= 7.5):  # 0.5 inch tolerance seems reasonable
-                           # We cannot reliably define the width since we are never sure how much
-                           # of the curved tape will reflect... all we can do is use pixel
-                           # estimates based on known width of image and sassuming that
-                           # the local area of the image is flat enough
-                           deltax = abs(topx - botx)
-                           errorx_deg = (deltax / 320.0) * FOV_deg
-                           if (errorx_deg <= 5.0):
-                               # This looks like the real thing
-                               observations.append(top)
-                               observations.append(bot)
-                               observationsVerified = True
-                               break;
-                
-                if (observations != []):
-                    break
+            (xd, yd, wd, hd, ad) = rectArrays(detections)
+
+            # We care about top/bottom: the top target should appear
+            # twice as high as the bottom target and be centered
+            # within 5 degrees and be spaced approximately the same
+            # as the height of the top target.
+            #
+            # Every pair is tested at once, in the orientation where
+            # element [i, j] has i on top
+            iOnTop = yd[:, None] < yd[None, :]
+            toph = np.where(iOnTop, hd[:, None], hd[None, :])
+            both = np.where(iOnTop, hd[None, :], hd[:, None])
+
+            # First top must be approximately 2x taller than bottom
+            # We will allow a 10% error (0.2 to 0.4 inches total) on 
+            # either side
+            heightRatio = toph/both
+
+            # To be the correct target, the centers must be spaced 7"
+            # apart and within 5 degrees of vertical.
+            # Sum of top (4") and bottom (2") heights is  assumed 6"
+            inchh = (toph + both) / 6.0
+            deltay = np.abs(yd[:, None] - yd[None, :])
+            spacing = deltay/inchh      # 0.5 inch tolerance seems reasonable
+
+            # We cannot reliably define the width since we are never sure how much
+            # of the curved tape will reflect... all we can do is use pixel
+            # estimates based on known width of image and sassuming that
+            # the local area of the image is flat enough
+            deltax = np.abs(xd[:, None] - xd[None, :])
+            errorx_deg = (deltax / 320.0) * FOV_deg
+
+            valid = (upperPairs(numDetections) &
+                     (1.8 <= heightRatio) & (heightRatio <= 2.2) &
+                     (6.5 <= spacing) & (spacing <= 7.5) &
+                     (errorx_deg <= 5.0))
+
+            # Of the pairs that fit, take the one closest to the ideal
+            # geometry, relative to the tolerance on each test
+            score = np.abs(heightRatio - 2.0)/0.2 + np.abs(spacing - 7.0)/0.5 + errorx_deg/5.0
+            pair = bestPair(valid, score)
+            if (pair is not None):
+                # This looks like the real thing
+                (i, j) = pair
+                if (iOnTop[i, j] == True):
+                    observations.append(detections[i])
+                    observations.append(detections[j])
+                else:
+                    observations.append(detections[j])
+                    observations.append(detections[i])
+                observationsVerified = True
         else:
             observations = detections
                     
@@ -270,6 +272,13 @@ class BoilerStack:
         cv2.line(source0,(320/2,0),(320/2,240),(255,0,0),1)
         
         nan = float('NaN')
+
+        # How old the frame these results come from is, so the robot can
+        # correct for where it was pointing when the frame was captured
+        if (self.captureTime is not None):
+            self.networkTable.putNumber("StackLatency_ms",1000.0 * (monotonic() - self.captureTime))
+        else:
+            self.networkTable.putNumber("StackLatency_ms",nan)
         
         if (numObservations == 2):
             # Having exactly two (2) observations is the easy case
@@ -419,20 +428,6 @@ class BoilerStack:
         """
         return cv2.resize(input, ((int)(width), (int)(height)), 0, 0, interpolation)
 
-    @staticmethod
-    def __hsl_threshold(input, hue, sat, lum):
-        """Segment an image based on hue, saturation, and luminance ranges.
-        Args:
-            input: A BGR numpy.ndarray.
-            hue: A list of two numbers the are the min and max hue.
-            sat: A list of two numbers the are the min and max saturation.
-            lum: A list of two numbers the are the min and max luminance.
-        Returns:
-            A black and white numpy.ndarray.
-        """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
-        return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
-
     @staticmethod
     def __find_contours(input, external_only):
         """Sets the values of pixels in a binary image to their distance to the nearest black pixel.
@@ -450,50 +445,5 @@ class BoilerStack:
         im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
         return contours
 
-    @staticmethod
-    def __filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
-                        min_height, max_height, solidity, max_vertex_count, min_vertex_count,
-                        min_ratio, max_ratio):
-        """Filters out contours that do not meet certain criteria.
-        Args:
-            input_contours: Contours as a list of numpy.ndarray.
-            min_area: The minimum area of a contour that will be kept.
-            min_perimeter: The minimum perimeter of a contour that will be kept.
-            min_width: Minimum width of a contour.
-            max_width: MaxWidth maximum width.
-            min_height: Minimum height.
-            max_height: Maximimum height.
-            solidity: The minimum and maximum solidity of a contour.
-            min_vertex_count: Minimum vertex Count of the contours.
-            max_vertex_count: Maximum vertex Count.
-            min_ratio: Minimum ratio of width to height.
-            max_ratio: Maximum ratio of width to height.
-        Returns:
-            Contours as a list of numpy.ndarray.
-        """
-        output = []
-        for contour in input_contours:
-            x,y,w,h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
-
 
 
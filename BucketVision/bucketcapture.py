@@ -13,34 +13,43 @@ Created on Tue Jan 24 20:46:25 2017
 import cv2
 
 from subprocess import call
-from threading import Lock
 from threading import Thread
-from threading import Condition
 
 import platform
 
+import numpy as np
+
 # import our classes
 
-from framerate import FrameRate
-from frameduration import FrameDuration
+import clock
+import threadcpu
+
+from framering import FrameRing
+from metrics import StageMetrics
 
 class BucketCapture:
-    def __init__(self, name,src,width,height,exposure):
+    def __init__(self, name,src,width,height,exposure,backend='opencv',numSlots=4):
 
         print("Creating BucketCapture for " + name)
         
-        self._lock = Lock()
-        self._condition = Condition()
-        self.fps = FrameRate()
-        self.duration = FrameDuration()
+        self.metrics = StageMetrics("BucketCapture", name)
         self.name = name
         self.src = src
+        self.backend = backend
         
         # initialize the video camera stream and read the first frame
         # from the stream
-        self.stream = cv2.VideoCapture(src)
-        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH,width)
-        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
+        #
+        # The 'v4l2' backend bypasses OpenCV and reads straight from the
+        # driver's mmap'd buffers into a fixed pool of frames, which avoids
+        # a new frame allocation on every read (Linux only)
+        if (self.backend == 'v4l2'):
+            from v4l2capture import V4L2Capture
+            self.stream = V4L2Capture(src,width,height)
+        else:
+            self.stream = cv2.VideoCapture(src)
+            self.stream.set(cv2.CAP_PROP_FRAME_WIDTH,width)
+            self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
         self.exposure = exposure
 
         self.setExposure()
@@ -57,20 +66,29 @@ class BucketCapture:
 ##        self.iso = self.stream.get(cv2.CAP_PROP_ISO_SPEED)
 ##        print("ISO = " + str(self.iso))
 
-        (self._grabbed, self._frame) = self.stream.read()
+        # The first frame tells us the size of the frames we will be
+        # handing out; all frame memory is allocated here, once, as a
+        # ring of slots that consumers lease (see framering.py)
+        (self.grabbed, frame) = self.stream.read()
         
-        if (self._grabbed == True):
-            self.grabbed = self._grabbed
-            self.frame = self._frame
-            self.outFrame = self.frame
-            self.count = 1
-            self.outCount = self.count
+        if (self.grabbed == True):
+            shape = frame.shape
+            dtype = frame.dtype
         else:
-            self.grabbed = False
-            self.frame = None
-            self.outFrame = None
-            self.count = 0
-            self.outCount = self.count
+            shape = (int(height), int(width), 3)
+            dtype = np.uint8
+            
+        self.ring = FrameRing(numSlots, shape, dtype)
+        
+        # Frames that arrive when every slot is leased are read into
+        # this scratch frame and dropped
+        self._scratch = np.zeros(shape, dtype=dtype)
+
+        if (self.grabbed == True):
+            slot = self.ring.acquire()
+            np.copyto(slot.image, frame)
+            slot.timestamp = self._captureTime()
+            self.ring.publish(slot)
 
         # initialize the variable used to indicate if the thread should
         # be stopped
@@ -89,9 +107,9 @@ class BucketCapture:
 
     def update(self):
         print("BucketCapture for " + self.name + " RUNNING")
+        threadcpu.register("BucketCapture " + self.name)
         # keep looping infinitely until the thread is stopped
         self.stopped = False
-        self.fps.start()
 
         lastExposure = self.exposure
         
@@ -106,44 +124,59 @@ class BucketCapture:
                 self.setExposure()
                 lastExposure = self.exposure
 
-            # otherwise, read the next frame from the stream
-            (self._grabbed, self._frame) = self.stream.read()
-            self.duration.start()
-            self.fps.update()
+            # otherwise, read the next frame from the stream directly
+            # into a free slot of the ring; if every slot is still being
+            # read by someone the frame is read and dropped
+            slot = self.ring.acquire()
+            if (slot is None):
+                self.stream.read(self._scratch)
+                self.metrics.drop()
+                continue
             
+            (grabbed, frame) = self.stream.read(slot.image)
+            self.metrics.start()
             
-            # if something was grabbed and retreived then lock
-            # the outboundw buffer for the update
-            # This limits the blocking to just the copy operations
-            # later we may consider a queue or double buffer to
-            # minimize blocking
-            if (self._grabbed == True):
-                self._condition.acquire()
-                self._lock.acquire()
-                self.count = self.count + 1
-                self.grabbed = self._grabbed
-                self.frame = self._frame
-                self._lock.release()
-                self._condition.notifyAll()
-                self._condition.release()
-
-            self.duration.update()
+            if (grabbed == True):
+                # The backends write in place, but copy just in case one
+                # had to hand back a different buffer
+                if (frame is not slot.image):
+                    np.copyto(slot.image, frame)
+                self.grabbed = grabbed
+                slot.timestamp = self._captureTime()
+                now = clock.monotonic()
+                slot.stamp("BucketCapture", slot.timestamp, now)
+                self.ring.publish(slot)
+                self.metrics.end(now, slot.timestamp)
+            else:
+                self.ring.abandon(slot)
+                self.metrics.end()
                 
         print("BucketCapture for " + self.name + " STOPPING")
 
-    def read(self):
-        # return the frame most recently read if the frame
-        # is not being updated at this exact moment
-        self._condition.acquire()
-        self._condition.wait()
-        self._condition.release()
-        if (self._lock.acquire() == True):
-            self.outFrame = self.frame
-            self.outCount = self.count
-            self._lock.release()
-            return (self.outFrame, self.outCount, True)
-        else:
-            return (self.outFrame, self.outCount, False)
+    def read(self, afterCount=0, timeout=None):
+        # return a lease on the newest frame read after afterCount,
+        # waiting up to timeout seconds for one (0 polls without blocking,
+        # None waits as long as it takes)
+        #
+        # Returns (frame, count, isNew); isNew is False (and frame is None)
+        # when nothing newer than afterCount arrived in time
+        #
+        # The caller MUST call frame.release() when done with frame.image
+        # and must copy it before drawing on it (other consumers may be
+        # reading the same frame)
+        frame = self.ring.read(afterCount, timeout)
+        if (frame is None):
+            return (None, afterCount, False)
+        return (frame, frame.count, True)
+
+    def _captureTime(self):
+        # monotonic time the frame we just read was captured; the driver's
+        # own timestamp when the backend has one, otherwise the time
+        # read() handed it to us (which includes whatever time it sat in
+        # OpenCV's buffers)
+        if ((self.backend == 'v4l2') and (self.stream.driverTimestamp == True)):
+            return self.stream.timestamp
+        return clock.monotonic()
 
     def processUserCommand(self, key):
         if key == ord('x'):
@@ -195,7 +228,7 @@ class BucketCapture:
     def setExposure(self):
         # cv2 exposure control DOES NOT WORK ON PI self.stream.set(cv2.CAP_PROP_EXPOSURE,self.exposure)
         # cv2 exposure control DOES NOT WORK ON PI self.stream.set(cv2.CAP_PROP_EXPOSURE,self.exposure)
-        if (platform.system() == 'Windows'):
+        if ((platform.system() == 'Windows') or (self.backend == 'v4l2')):
             self.stream.set(cv2.CAP_PROP_EXPOSURE,self.exposure)
         else:
             cmd = ['v4l2-ctl --device=' + str(self.src) + ' -c exposure_auto=1 -c exposure_absolute=' + str(self.exposure)]
@@ -205,9 +238,7 @@ class BucketCapture:
     def stop(self):
         # indicate that the thread should be stopped
         self._stop = True
-        self._condition.acquire()
-        self._condition.notifyAll()
-        self._condition.release()
+        self.ring.wakeAll()
 
     def isStopped(self):
         return self.stopped
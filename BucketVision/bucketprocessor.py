@@ -1,18 +1,20 @@
 
-from threading import Lock
 from threading import Thread
-from threading import Condition
 
-from framerate import FrameRate
-from frameduration import FrameDuration
+import numpy as np
+
+import clock
+import threadcpu
+
+from framering import FrameRing
+from metrics import StageMetrics
+from metrics import registry
+from pipelineworker import PipelineWorker
 
 class BucketProcessor:
-    def __init__(self,stream,ipdictionary, ipselection):
+    def __init__(self,stream,ipdictionary, ipselection, numSlots=4, useProcess=False, targetLatency=None):
         print("Creating BucketProcessor for " + stream.name)
-        self._lock = Lock()
-        self._condition = Condition()
-        self.fps = FrameRate()
-        self.duration = FrameDuration()
+        self.metrics = StageMetrics("BucketProcessor", stream.name)
         self.stream = stream
         self.name = self.stream.name
         self.ipdictionary = ipdictionary
@@ -20,9 +22,49 @@ class BucketProcessor:
         self.ip = self.ipdictionary[ipselection]
 
         self._frame = None
-        self.frame = None
         self.count = 0
         self.isNew = False
+        self.latency = 0.0      # capture to processed, of the last frame
+
+        # Called with the capture timestamp of each frame once the
+        # pipeline's results for it are in its table (e.g., by the
+        # BucketRecorder, to record each frame with its own results)
+        self.resultListeners = []
+
+        # Frame budget: with a targetLatency (seconds, capture to
+        # processed) frames that are already older than that when we get
+        # them are skipped (but never more than maxStaleSkips in a row, so
+        # results keep coming), and pipelines with a setQuality() are
+        # switched to a cheaper mode (one of their qualityLevels, 0 being
+        # full quality) while we miss it; they are switched back a level
+        # at a time once restoreFrames frames in a row have finished
+        # within restoreFraction of it. Each time the better level turns
+        # out to still be too slow we wait twice as long before trying it
+        # again (up to 32 times)
+        self.targetLatency = targetLatency
+        self.maxStaleSkips = 2
+        self.restoreFraction = 0.7
+        self.restoreFrames = 30
+        self.quality = 0
+        self._staleRun = 0
+        self._headroom = 0
+        self._restoreWait = self.restoreFrames
+        self._restored = False      # the last change was back up a level
+        self.stale = registry.counter('stale', "Frames skipped for being older than the target latency", stage="BucketProcessor", instance=self.name)
+        self.degraded = registry.counter('degraded', "Frames processed at reduced quality", stage="BucketProcessor", instance=self.name)
+        self.qualityGauge = registry.gauge('quality', "Quality level of the pipeline (0 is full)", stage="BucketProcessor", instance=self.name)
+        self.__applyQuality()
+        
+        # Outgoing frames are copies of the camera frames that the
+        # pipelines are free to draw on
+        #
+        # With useProcess the pipelines run in a worker process (outside
+        # of our GIL) directly on these frames, so they live in shared memory
+        self.ring = FrameRing(numSlots, self.stream.ring.shape, self.stream.ring.dtype, shared=useProcess)
+        if (useProcess == True):
+            self.worker = PipelineWorker(self.name, self.ipdictionary, self.ring)
+        else:
+            self.worker = None
         
         # initialize the variable used to indicate if the thread should
         # be stopped
@@ -33,6 +75,8 @@ class BucketProcessor:
         
     def start(self):
         print("STARTING BucketProcessor for " + self.name)
+        if (self.worker is not None):
+            self.worker.start()
         t = Thread(target=self.update, args=())
         t.daemon = True
         t.start()
@@ -40,72 +84,168 @@ class BucketProcessor:
 
     def update(self):
         print("BucketProcessor for " + self.name + " RUNNING")
+        threadcpu.register("BucketProcessor " + self.name)
         # keep looping infinitely until the thread is stopped
         self.stopped = False
-        self.fps.start()
+
+        lastCount = 0
 
         lastIpSelection = self.ipselection
         
         while True:
             # if the thread indicator variable is set, stop the thread
             if (self._stop == True):
+                if (self.worker is not None):
+                    self.worker.stop()
                 self._stop = False
                 self.stopped = True
                 return
 
             # otherwise, read the next frame from the stream
             # grab the frame from the threaded video stream
-            (self._frame, count, isNew) = self.stream.read()
-            self.duration.start()
-            self.fps.update()
+            previousCount = lastCount
+            (self._frame, lastCount, isNew) = self.stream.read(lastCount, 0.1)
+            if (isNew == False):
+                continue    # nothing new yet; go check for a stop request
+            enter = clock.monotonic()
+            if (previousCount != 0):
+                self.metrics.skip(lastCount - previousCount - 1)
+
+            # A frame that is already too old can only make us later; the
+            # next one will be newer
+            if ((self.targetLatency is not None) and (self._frame.timestamp > 0.0) and
+                (enter - self._frame.timestamp > self.targetLatency) and
+                (self._staleRun < self.maxStaleSkips)):
+                self._staleRun += 1
+                self._frame.release()
+                self.stale.inc()
+                continue
+            self._staleRun = 0
+            self.metrics.start(enter)
 
             if (lastIpSelection != self.ipselection):
                 self.ip = self.ipdictionary[self.ipselection]
                 lastIpSelection = self.ipselection
+                self.__applyQuality()
 
             if (isNew == True):
-                # TODO: Insert processing code then forward display changes
-                self.ip.process(self._frame)
+                # Pipelines draw on the frame they are given, so they get
+                # a private copy in one of our slots; the camera frame
+                # may still be in use by another consumer
+                out = self.ring.acquire()
+                if (out is None):
+                    self._frame.release()
+                    self.metrics.drop()
+                    continue
+                np.copyto(out.image, self._frame.image)
+                out.copyStamps(self._frame)
+
+                # Pipelines that look for a captureTime attribute get the
+                # time the frame was captured, so they can publish the
+                # latency of their results along with them
+                if (hasattr(self.ip, 'captureTime') == True):
+                    self.ip.captureTime = out.timestamp
+                
+                if (self.worker is not None):
+                    self._frame.release()
+                    try:
+                        self.worker.process(lastIpSelection, out, self.quality)
+                    except (EOFError, IOError) as e:
+                        # Worker died; reap it and carry on with the
+                        # pipelines in this process
+                        print("BucketProcessor for " + self.name + " lost its PipelineWorker (" + str(e) + "); FALLING BACK to in-process pipelines")
+                        self.worker.stop()
+                        self.worker = None
+                        self.ip.process(out.image)
+                else:
+                    # Pipelines that look for a frame attribute also get the
+                    # camera frame itself, so they can share derived images
+                    # (HLS, masks, ...) with the other processors on this
+                    # camera through its cache (see framecache.py); we hold
+                    # our lease on it until they are done
+                    if (hasattr(self.ip, 'frame') == True):
+                        self.ip.frame = self._frame
+                        self.ip.process(out.image)
+                        self.ip.frame = None
+                    else:
+                        self.ip.process(out.image)
+                    self._frame.release()
                 
-                # Now that image processing is complete, place results
-                # into an outgoing buffer to be grabbed at the convenience
-                # of the reader
-                self._condition.acquire()
-                self._lock.acquire()
+                # Now that image processing is complete, publish the results
+                # to be grabbed at the convenience of the reader
+                now = clock.monotonic()
+                out.stamp("BucketProcessor", enter, now)
+                self.latency = out.age(now)
+                if (self.quality > 0):
+                    self.degraded.inc()
+                self.__schedule()
+                for listener in self.resultListeners:
+                    listener(out.timestamp)
                 self.count = self.count + 1
                 self.isNew = isNew
-                self.frame = self._frame
-                self._lock.release()
-                self._condition.notifyAll()
-                self._condition.release()
-
-            self.duration.update()
+                self.ring.publish(out)
+                self.metrics.end(now, out.timestamp)
                 
         print("BucketProcessor for " + self.name + " STOPPING")
 
+    def __schedule(self):
+        # Trade quality for time against the target latency
+        if (self.targetLatency is None):
+            return
+        levels = getattr(self.ip, 'qualityLevels', 1)
+        if (self.latency > self.targetLatency):
+            self._headroom = 0
+            if (self._restored == True):
+                self._restoreWait = min(2 * self._restoreWait, 32 * self.restoreFrames)
+                self._restored = False
+            if (self.quality < levels - 1):
+                self.quality += 1
+                self.__applyQuality()
+            return
+
+        if (self._restored == True):
+            self._restoreWait = self.restoreFrames
+            self._restored = False
+        if (self.latency < self.restoreFraction * self.targetLatency):
+            self._headroom += 1
+            if ((self._headroom >= self._restoreWait) and (self.quality > 0)):
+                self._headroom = 0
+                self.quality -= 1
+                self._restored = True
+                self.__applyQuality()
+        else:
+            self._headroom = 0
+
+    def __applyQuality(self):
+        # Tell the current pipeline (the worker tells its own copy)
+        self.quality = min(self.quality, max(0, getattr(self.ip, 'qualityLevels', 1) - 1))
+        if (hasattr(self.ip, 'setQuality') == True):
+            self.ip.setQuality(self.quality)
+        self.qualityGauge.set(self.quality)
+
     def updateSelection(self, ipselection):
         self.ipselection = ipselection
 
-    def read(self):
-        # return the frame most recently processed if the frame
-        # is not being updated at this exact moment
-        self._condition.acquire()
-        self._condition.wait()
-        self._condition.release()
-        if (self._lock.acquire() == True):
-            self.outFrame = self.frame
-            self.outCount = self.count
-            self._lock.release()
-            return (self.outFrame, self.outCount, True)
-        else:
-            return (self.outFrame, self.outCount, False)
+    def read(self, afterCount=0, timeout=None):
+        # return a lease on the newest frame processed after afterCount,
+        # waiting up to timeout seconds for one (0 polls without blocking,
+        # None waits as long as it takes)
+        #
+        # Returns (frame, count, isNew); isNew is False (and frame is None)
+        # when nothing newer than afterCount arrived in time
+        #
+        # The caller MUST call frame.release() when done with frame.image
+        # and must copy it before drawing on it (other consumers may be
+        # reading the same frame)
+        frame = self.ring.read(afterCount, timeout)
+        if (frame is None):
+            return (None, afterCount, False)
+        return (frame, frame.count, True)
           
     def stop(self):
         # indicate that the thread should be stopped
         self._stop = True
-        self._condition.acquire()
-        self._condition.notifyAll()
-        self._condition.release()
+        self.ring.wakeAll()
 
     def isStopped(self):
         return self.stopped
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+bucketrecorder
+
+Flight recorder: what the camera saw, and what we made of it
+
+BucketRecorder tees the frames of any stage (usually the BucketCapture, for
+the raw footage) to disk, along with the capture time of each frame and
+what the pipelines made of it (e.g., GearDistance_inches), so a missed peg
+in autonomous can be looked at after the match.
+
+The results come later than the frame: the BucketProcessor is still working
+on it when we tee it. So when given the processor, the recorder has it call
+back with the capture time of each frame it finishes, reads the results
+then, and the writer thread pairs them with the frame of the same capture
+time. Frames the processor skipped have no results. Without a processor all
+we can do is read the table when we tee the frame, which gives the results
+of an earlier frame; those are recorded as 'latestResults' instead.
+
+The recording is a bounded ring of chunks in one directory:
+
+    chunk-000042.mjpg   the frames, one after the other
+    chunk-000042.jsonl  one line per frame: where it is in the .mjpg, its
+                        sequence number, capture timestamp, its results,
+                        and how it was encoded
+
+A chunk holds chunkFrames frames; once there are more than maxChunks the
+oldest is deleted, so the recorder can be left on for a whole event.
+Numbering carries on from whatever is already in the directory.
+
+Frames are stored as:
+
+    'jpeg'      encoded by the recorder's writer thread at its own quality
+    'raw'       the pixels as they are (no encode cost, lots of disk)
+    'stream'    the JPEG the BucketStreamer already made for its clients
+                (source must be the streamer; costs nothing, but has the
+                overlay drawn on it)
+
+Recording must never hold up capture. The recorder's own thread only
+copies each frame out of the source's ring into one of a fixed pool of
+buffers and queues it; a writer thread does the encoding and the (purely
+sequential, appending) file I/O. If the writer falls behind, frames are
+dropped and counted rather than queued without limit.
+
+RecordingReader reads a recording back; BucketReplay and pipelinebench.py
+take a recording directory wherever they take a video or images.
+"""
+
+import glob
+import json
+import os
+import re
+import time
+
+from threading import Condition, Thread
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+import cv2
+import numpy as np
+
+import clock
+import threadcpu
+
+from metrics import StageMetrics
+from metrics import registry
+
+CHUNK_PATTERN = re.compile(r'chunk-(\d+)\.jsonl$')
+
+def chunkIndexes(directory):
+    """Lists the chunks of a recording.
+    Args:
+        directory: The recording's directory.
+    Returns:
+        The sorted list of (number, index path, frames path).
+    """
+    chunks = []
+    for path in glob.glob(os.path.join(directory, 'chunk-*.jsonl')):
+        match = CHUNK_PATTERN.search(path)
+        if (match is not None):
+            chunks.append((int(match.group(1)), path, path[:-len('.jsonl')] + '.mjpg'))
+    chunks.sort()
+    return chunks
+
+def isRecording(path):
+    # True if path is a directory written by a BucketRecorder
+    return (os.path.isdir(path) == True) and (len(chunkIndexes(path)) > 0)
+
+
+class BucketRecorder:
+    def __init__(self, name, source, directory, encoding='jpeg', quality=90,
+                 chunkFrames=300, maxChunks=20, table=None, keys=(), numBuffers=16,
+                 processor=None, resultsTimeout=1.0):
+        """
+        Args:
+            name: name of the recorder (for metrics and messages)
+            source: stage whose frames to record (see read() of BucketCapture)
+            directory: where the chunks go; created if need be
+            encoding: 'jpeg', 'raw' or 'stream' (see above)
+            quality: JPEG quality, for 'jpeg'
+            chunkFrames: frames per chunk
+            maxChunks: chunks to keep; the oldest are deleted
+            table: table to read the results from with getNumber(), or None
+            keys: the results to record with each frame
+            numBuffers: frames that may be waiting for the writer
+            processor: the BucketProcessor that computes the results from
+                source's frames, so each frame gets its own (see above)
+            resultsTimeout: seconds after capture to give up waiting for
+                the results of a frame
+        """
+        print("Creating BucketRecorder for " + name)
+        self.metrics = StageMetrics("BucketRecorder", name)
+        self.bytes = registry.counter('recorded_bytes', "Bytes written to the recording", stage="BucketRecorder", instance=name)
+        self.waiting = registry.gauge('recorder_queue', "Frames waiting to be written", stage="BucketRecorder", instance=name)
+        self.name = name
+        self.source = source
+        self.directory = directory
+        self.encoding = encoding
+        self.quality = quality
+        self.chunkFrames = chunkFrames
+        self.maxChunks = maxChunks
+        self.table = table
+        self.keys = list(keys)
+        self.flushInterval = 1.0    # seconds between flushes to the OS
+
+        # Results by capture timestamp, as the processor finishes frames;
+        # the writer takes them out
+        self.processor = processor
+        self.resultsTimeout = resultsTimeout
+        self._results = {}
+        self._resultsDone = 0.0     # capture timestamp of the last one
+        self._resultsReady = Condition()
+        if ((processor is not None) and (table is not None)):
+            processor.resultListeners.append(self.__noteResults)
+
+        if (os.path.isdir(directory) == False):
+            os.makedirs(directory)
+        chunks = chunkIndexes(directory)
+        self._chunk = (chunks[-1][0] + 1) if (len(chunks) > 0) else 0
+        self._frames = None         # chunk files being written
+        self._index = None
+        self._chunkCount = 0
+
+        # Buffers are only needed when we copy the pixels; the streamer's
+        # JPEGs are immutable and just get queued
+        self._free = Queue()
+        if (self.encoding != 'stream'):
+            for i in range(numBuffers):
+                self._free.put(np.zeros(source.ring.shape, dtype=source.ring.dtype))
+        self._queue = Queue(numBuffers)
+
+        # initialize the variable used to indicate if the threads should
+        # be stopped
+        self._stop = False
+        self.stopped = True
+        self._writing = False
+
+        print("BucketRecorder created for " + self.name + " in " + self.directory)
+
+    def start(self):
+        print("STARTING BucketRecorder for " + self.name)
+        self._writing = True
+        t = Thread(target=self.write, args=())
+        t.daemon = True
+        t.start()
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("BucketRecorder for " + self.name + " RUNNING")
+        threadcpu.register("BucketRecorder " + self.name)
+        # keep looping infinitely until the thread is stopped
+        self.stopped = False
+
+        lastCount = 0
+        while True:
+            # if the thread indicator variable is set, stop the thread
+            if (self._stop == True):
+                self._stop = False
+                self._queue.put(None)       # tells the writer to finish up
+                while (self._writing == True):
+                    time.sleep(0.001)
+                self.stopped = True
+                return
+
+            previousCount = lastCount
+            (frame, lastCount, isNew) = self.source.read(lastCount, 0.1)
+            if (isNew == False):
+                continue
+            enter = clock.monotonic()
+            self.metrics.start(enter)
+            if (previousCount != 0):
+                self.metrics.skip(lastCount - previousCount - 1)
+
+            # Let go of the frame as soon as we have what we need from it
+            if (self.encoding == 'stream'):
+                data = self.source.encoded(frame)
+            else:
+                try:
+                    data = self._free.get_nowait()
+                except Empty:
+                    data = None
+                if (data is not None):
+                    np.copyto(data, frame.image)
+            timestamp = frame.timestamp
+            frame.release()
+
+            if (data is None):
+                # The writer is behind and every buffer is waiting on it
+                self.metrics.drop()
+                continue
+
+            entry = {'seq' : lastCount,
+                     'timestamp' : timestamp,
+                     'time' : time.time()}
+            if ((self.table is not None) and (self.processor is None)):
+                entry['latestResults'] = self.__readResults()
+
+            try:
+                self._queue.put_nowait((data, entry))
+            except Full:
+                if (self.encoding != 'stream'):
+                    self._free.put(data)
+                self.metrics.drop()
+                continue
+
+            now = clock.monotonic()
+            self.waiting.set(self._queue.qsize())
+            self.metrics.end(now, timestamp)
+
+        print("BucketRecorder for " + self.name + " STOPPING")
+
+    def write(self):
+        # The writer thread: encode (if need be) and append to the chunk
+        threadcpu.register("BucketRecorder writer " + self.name)
+        nextFlush = clock.monotonic() + self.flushInterval
+        while True:
+            try:
+                item = self._queue.get(True, self.flushInterval)
+            except Empty:
+                item = False
+
+            now = clock.monotonic()
+            if ((now >= nextFlush) or (item is None)):
+                nextFlush = now + self.flushInterval
+                if (self._frames is not None):
+                    self._frames.flush()
+                    self._index.flush()
+            if (item is None):
+                self._closeChunk()
+                self._writing = False
+                return
+            if (item is False):
+                continue
+
+            (data, entry) = item
+            if ((self.table is not None) and (self.processor is not None)):
+                results = self.__takeResults(entry['timestamp'])
+                if (results is not None):
+                    entry['results'] = results
+            if (self.encoding == 'stream'):
+                encoded = data
+                entry['encoding'] = 'jpeg'
+            elif (self.encoding == 'raw'):
+                encoded = data.tobytes()
+                entry['encoding'] = 'raw'
+                entry['shape'] = list(data.shape)
+                entry['dtype'] = str(data.dtype)
+            else:
+                (r, buf) = cv2.imencode(".jpg", data, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+                encoded = buf.tobytes() if (r == True) else None
+                entry['encoding'] = 'jpeg'
+            if (self.encoding != 'stream'):
+                self._free.put(data)
+            if (encoded is None):
+                continue
+
+            if (self._frames is None):
+                self._openChunk()
+            entry['offset'] = self._frames.tell()
+            entry['length'] = len(encoded)
+            self._frames.write(encoded)
+            self._index.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.bytes.inc(len(encoded))
+            self._chunkCount += 1
+            if (self._chunkCount >= self.chunkFrames):
+                self._closeChunk()
+
+    def __readResults(self):
+        results = {}
+        for key in self.keys:
+            value = self.table.getNumber(key, None)
+            if ((value is not None) and (value == value)):
+                results[key] = value
+        return results
+
+    def __noteResults(self, timestamp):
+        # Called by the processor's thread when it is done with a frame
+        results = self.__readResults()
+        with self._resultsReady:
+            self._results[timestamp] = results
+            self._resultsDone = timestamp
+            self._resultsReady.notify()
+
+    def __takeResults(self, timestamp):
+        # Wait for the processor to get past the frame, then return its
+        # results (None if it skipped it)
+        deadline = timestamp + self.resultsTimeout
+        with self._resultsReady:
+            while (self._resultsDone < timestamp):
+                wait = deadline - clock.monotonic()
+                if (wait <= 0.0):
+                    break
+                self._resultsReady.wait(wait)
+            results = self._results.pop(timestamp, None)
+            for older in [t for t in self._results if (t < timestamp)]:
+                del self._results[older]
+        return results
+
+    def _openChunk(self):
+        base = os.path.join(self.directory, 'chunk-{:06d}'.format(self._chunk))
+        self._chunk += 1
+        self._frames = open(base + '.mjpg', 'wb')
+        self._index = open(base + '.jsonl', 'w')
+        self._chunkCount = 0
+
+        # Keep the ring bounded; the chunk we just opened counts
+        chunks = chunkIndexes(self.directory)
+        for (number, indexPath, framesPath) in chunks[:max(0, len(chunks) - self.maxChunks)]:
+            for path in (indexPath, framesPath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _closeChunk(self):
+        if (self._frames is not None):
+            self._frames.close()
+            self._index.close()
+            self._frames = None
+            self._index = None
+
+    def stop(self):
+        # indicate that the threads should be stopped; what is queued is
+        # still written
+        self._stop = True
+
+    def isStopped(self):
+        return self.stopped
+
+
+class RecordingReader:
+    # Reads the frames of a recording back, oldest first
+    def __init__(self, directory):
+        self.directory = directory
+        self.chunks = chunkIndexes(directory)
+
+    def entries(self):
+        # Return every index entry (each has 'chunk', the frames path, added)
+        entries = []
+        for (number, indexPath, framesPath) in self.chunks:
+            with open(indexPath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break       # cut short by a power off
+                    entry['chunk'] = framesPath
+                    entries.append(entry)
+        return entries
+
+    def frames(self):
+        # Generate (image, entry) for every frame, reading each chunk in
+        # order
+        for (number, indexPath, framesPath) in self.chunks:
+            entries = []
+            with open(indexPath) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+            if (len(entries) == 0):
+                continue
+            try:
+                frames = open(framesPath, 'rb')
+            except IOError:
+                continue            # deleted by the recorder meanwhile
+            with frames:
+                for entry in entries:
+                    frames.seek(entry['offset'])
+                    data = frames.read(entry['length'])
+                    if (len(data) < entry['length']):
+                        break
+                    image = decode(data, entry)
+                    if (image is not None):
+                        entry['chunk'] = framesPath
+                        yield (image, entry)
+
+    def rate(self):
+        # Average frame rate it was recorded at, or None if unknown
+        entries = self.entries()
+        if (len(entries) < 2):
+            return None
+        seconds = entries[-1]['timestamp'] - entries[0]['timestamp']
+        if (seconds <= 0.0):
+            return None
+        return (len(entries) - 1) / seconds
+
+def decode(data, entry):
+    """Turns the bytes of a recorded frame back into an image.
+    Args:
+        data: The bytes from the chunk.
+        entry: The frame's index entry.
+    Returns:
+        The image, or None if it could not be decoded.
+    """
+    if (entry.get('encoding') == 'raw'):
+        return np.frombuffer(data, dtype=np.dtype(str(entry['dtype']))).reshape(entry['shape']).copy()
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
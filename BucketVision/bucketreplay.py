@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+bucketreplay
+
+Plays recorded frames in place of a camera
+
+BucketReplay looks like a BucketCapture to whatever consumes it (a
+BucketProcessor, the BucketStreamer, ...) but its frames come from a video
+file or a set of still images, e.g.:
+
+    BucketReplay("FrontCam", "redBoiler*.jpg")      glob of images
+    BucketReplay("FrontCam", "match3/")             every image in a directory
+    BucketReplay("FrontCam", "match3.avi")          video file
+    BucketReplay("FrontCam", "recordings/")         flight recording
+
+so the whole bucket brigade can be run, timed and checked on a laptop with
+no camera attached (see the --replay option of bucketvision.py).
+
+The rate says how fast to play:
+
+    None    native speed; the video's own frame rate or the average rate a
+            recording was made at (images have none, so they go at
+            DEFAULT_RATE)
+    > 0     that many frames per second
+    0       as fast as the frames can be copied out; consumers always take
+            the newest frame, so the skipped counts in their metrics show
+            how far behind they fall
+
+Still images are all read (and resized to the first, or to width x height)
+up front so that disk and JPEG decoding times do not get mixed up with the
+pipeline's; videos and recordings (see bucketrecorder.py) are decoded as
+they play. Each frame is stamped with the monotonic time it was handed out,
+as if it had just been captured.
+"""
+
+import glob
+import os
+import time
+
+from threading import Thread
+
+import cv2
+import numpy as np
+
+import clock
+import threadcpu
+
+from bucketrecorder import RecordingReader
+from bucketrecorder import isRecording
+from framering import FrameRing
+from metrics import StageMetrics
+
+DEFAULT_RATE = 30.0
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def replayPaths(source):
+    """Finds the images a replay source names.
+    Args:
+        source: A directory, a glob pattern or a single file.
+    Returns:
+        The sorted list of image paths, or an empty list if source is not
+        a directory of images or a pattern (i.e., it should be a video).
+    """
+    if (os.path.isdir(source) == True):
+        paths = [os.path.join(source, entry) for entry in os.listdir(source)]
+    elif (glob.has_magic(source) == True):
+        paths = glob.glob(source)
+    elif (os.path.splitext(source)[1].lower() in IMAGE_EXTENSIONS):
+        paths = [source]
+    else:
+        return []
+    return sorted(path for path in paths if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+
+
+class BucketReplay:
+    def __init__(self, name, source, width=None, height=None, rate=None, loop=True, numSlots=4):
+
+        print("Creating BucketReplay for " + name)
+
+        self.metrics = StageMetrics("BucketReplay", name)
+        self.name = name
+        self.src = source
+        self.loop = loop
+        self.exposure = None
+        self.finished = False   # True once the last frame went out (loop=False)
+
+        self.images = None
+        self.stream = None
+        self.recording = None
+        paths = replayPaths(source)
+        if (isRecording(source) == True):
+            self.recording = RecordingReader(source)
+            self._recorded = self.recording.frames()
+            try:
+                (frame, entry) = next(self._recorded)
+            except StopIteration:
+                raise IOError("No frames could be read from " + source)
+            self._recorded = self.recording.frames()
+            if ((width is None) or (height is None)):
+                (height, width) = frame.shape[:2]
+            shape = (int(height), int(width)) + frame.shape[2:]
+            dtype = frame.dtype
+            nativeRate = self.recording.rate()
+            if (nativeRate is None):
+                nativeRate = DEFAULT_RATE
+            print("BucketReplay for " + self.name + " has " + str(len(self.recording.chunks)) + " recorded chunks")
+        elif (len(paths) > 0):
+            self.images = []
+            for path in paths:
+                image = cv2.imread(path)
+                if (image is None):
+                    print("BucketReplay for " + self.name + " could not read " + path)
+                    continue
+                if ((width is None) or (height is None)):
+                    if (len(self.images) > 0):
+                        (height, width) = self.images[0].shape[:2]
+                    else:
+                        (height, width) = image.shape[:2]
+                if (image.shape[:2] != (height, width)):
+                    image = cv2.resize(image, (int(width), int(height)))
+                self.images.append(image)
+            if (len(self.images) == 0):
+                raise IOError("No images could be read from " + source)
+            shape = self.images[0].shape
+            dtype = self.images[0].dtype
+            nativeRate = DEFAULT_RATE
+            print("BucketReplay for " + self.name + " has " + str(len(self.images)) + " images")
+        else:
+            self.stream = cv2.VideoCapture(source)
+            (grabbed, frame) = self.stream.read()
+            if (grabbed == False):
+                raise IOError("Could not read a frame from " + source)
+            if ((width is None) or (height is None)):
+                (height, width) = frame.shape[:2]
+            shape = (int(height), int(width)) + frame.shape[2:]
+            dtype = frame.dtype
+            nativeRate = self.stream.get(cv2.CAP_PROP_FPS)
+            if ((nativeRate != nativeRate) or (nativeRate <= 0.0)):
+                nativeRate = DEFAULT_RATE
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            # read() wants a frame of the video's own size to read into
+            self._scratch = np.zeros(frame.shape, dtype=frame.dtype)
+
+        if (rate is None):
+            rate = nativeRate
+        self.rate = rate
+        print("RATE = " + str(self.rate))
+
+        self.ring = FrameRing(numSlots, shape, dtype)
+
+        self._index = 0
+
+        # initialize the variable used to indicate if the thread should
+        # be stopped
+        self._stop = False
+        self.stopped = True
+
+        print("BucketReplay created for " + self.name)
+
+    def start(self):
+        # start the thread to play the frames
+        print("STARTING BucketReplay for " + self.name)
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("BucketReplay for " + self.name + " RUNNING")
+        threadcpu.register("BucketReplay " + self.name)
+        # keep looping infinitely until the thread is stopped
+        self.stopped = False
+
+        nextTime = clock.monotonic()
+
+        while True:
+            # if the thread indicator variable is set, stop the thread
+            if (self._stop == True):
+                self._stop = False
+                if (self.stream is not None):
+                    self.stream.release()
+                self.stopped = True
+                return
+
+            if (self.finished == True):
+                time.sleep(0.01)
+                continue
+
+            # Wait for the frame's turn, like a camera would; if we fall
+            # more than a frame behind just carry on from now rather than
+            # trying to catch up
+            if (self.rate > 0.0):
+                period = 1.0 / self.rate
+                now = clock.monotonic()
+                if (nextTime > now):
+                    time.sleep(nextTime - now)
+                elif (now - nextTime > period):
+                    nextTime = now
+                nextTime += period
+
+            slot = self.ring.acquire()
+            if (slot is None):
+                # Every slot is leased; like a camera, the frame is lost
+                self._next(None)
+                self.metrics.drop()
+                continue
+
+            enter = clock.monotonic()
+            if (self._next(slot.image) == False):
+                self.ring.abandon(slot)
+                continue
+
+            self.metrics.start(enter)
+            now = clock.monotonic()
+            slot.timestamp = now
+            slot.stamp("BucketReplay", enter, now)
+            self.ring.publish(slot)
+            self.metrics.end(now, now)
+
+        print("BucketReplay for " + self.name + " STOPPING")
+
+    def _next(self, out):
+        # Put the next frame into out (None just skips it)
+        # Returns False if there was no frame to give
+        if (self.images is not None):
+            if (self._index >= len(self.images)):
+                if (self.loop == False):
+                    self.finished = True
+                    return False
+                self._index = 0
+            if (out is not None):
+                np.copyto(out, self.images[self._index])
+            self._index += 1
+            return True
+
+        if (self.recording is not None):
+            frame = next(self._recorded, (None, None))[0]
+            if ((frame is None) and (self.loop == True)):
+                self._recorded = self.recording.frames()
+                frame = next(self._recorded, (None, None))[0]
+            if (frame is None):
+                self.finished = True
+                return False
+        else:
+            (grabbed, frame) = self.stream.read(self._scratch)
+            if (grabbed == False):
+                if (self.loop == False):
+                    self.finished = True
+                    return False
+                self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                (grabbed, frame) = self.stream.read(self._scratch)
+                if (grabbed == False):
+                    self.finished = True
+                    return False
+        if (out is not None):
+            if (frame.shape == out.shape):
+                np.copyto(out, frame)
+            else:
+                cv2.resize(frame, (out.shape[1], out.shape[0]), dst=out)
+        return True
+
+    def read(self, afterCount=0, timeout=None):
+        # Same contract as BucketCapture.read()
+        frame = self.ring.read(afterCount, timeout)
+        if (frame is None):
+            return (None, afterCount, False)
+        return (frame, frame.count, True)
+
+    def processUserCommand(self, key):
+        # There are no camera controls to play with
+        return key == ord('x')
+
+    def updateExposure(self, exposure):
+        self.exposure = exposure
+
+    def stop(self):
+        # indicate that the thread should be stopped
+        self._stop = True
+        self.ring.wakeAll()
+
+    def isStopped(self):
+        return self.stopped
+
+    def isFinished(self):
+        # True once every frame was played (never, when looping)
+        return self.finished
@@ -4,6 +4,9 @@ bucketserver
 
 Simple web service for image
 
+Each request is handled on its own thread (ThreadedHTTPServer) so a client
+sitting in the endless .mjpg stream does not block anyone else
+
 Copyright (c) 2017 - RocketRedNeck.com RocketRedNeck.net 
 
 RocketRedNeck and MIT Licenses 
@@ -36,8 +39,16 @@ SOFTWARE.
 import cv2
 
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+from SocketServer import ThreadingMixIn
 
 from threading import Thread
+
+import threadcpu
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    # One thread per request; the threads must not keep us alive on exit
+    daemon_threads = True
+    allow_reuse_address = True
         
 class BucketServer:
 
@@ -62,6 +73,7 @@ class BucketServer:
 
     def update(self):
         print("BuckerServer for " + self.name + " RUNNING")
+        threadcpu.register("BucketServer " + self.name)
         
 
         self.stopped = False
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+bucketstats
+
+Machine readable telemetry for the camera HTTP server
+
+Gathers everything we know about how the bucket brigade is doing: the
+metrics every stage records (see metrics.py), how many of each stage's
+frame slots are in use, how far behind each stream client is and how
+many bytes a second it is getting, the CPU used by each thread (see
+threadcpu.py) and which camera and pipelines are selected. It is served
+in two forms:
+
+    /stats      JSON, for a person or a script on the pit laptop
+    /metrics    Prometheus text format, for a scraper
+
+Histograms go out as Prometheus summaries (p50/p95/p99 plus a _max
+gauge) rather than all of their buckets, to keep a scrape small.
+"""
+
+import json
+import time
+
+from threading import Lock
+
+from clock import monotonic
+from metrics import Counter, Gauge, Histogram
+from metrics import registry
+from threadcpu import ThreadCpu
+
+QUANTILES = ((0.5, 50), (0.95, 95), (0.99, 99))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if (len(labels) == 0):
+        return ''
+    return '{' + ','.join(key + '="' + _escape(labels[key]) + '"' for key in sorted(labels.keys())) + '}'
+
+def _number(value):
+    if (value != value):
+        return 'NaN'
+    return repr(float(value))
+
+
+class BucketStats:
+    def __init__(self, cameras, processors, streamer, prefix='bucketvision'):
+        """
+        Args:
+            cameras: dictionary of the capture stages, by camera name
+            processors: dictionary of the processing stages, by camera name
+            streamer: the BucketStreamer whose clients to report on
+            prefix: prepended to every Prometheus metric name
+        """
+        self.cameras = cameras
+        self.processors = processors
+        self.streamer = streamer
+        self.prefix = prefix
+        self.started = monotonic()
+
+        self._cpuLock = Lock()
+        self._cpu = ThreadCpu()
+
+    def _stages(self):
+        stages = []
+        for name in sorted(self.cameras.keys()):
+            stages.append(self.cameras[name])
+        for name in sorted(self.processors.keys()):
+            stages.append(self.processors[name])
+        stages.append(self.streamer)
+        return stages
+
+    def _threads(self):
+        self._cpuLock.acquire()
+        try:
+            return self._cpu.sample(monotonic())
+        finally:
+            self._cpuLock.release()
+
+    def snapshot(self):
+        # Return everything as a dictionary (what /stats sends)
+        stages = []
+        for stage in self._stages():
+            metrics = stage.metrics
+            entry = {'stage' : metrics.stage,
+                     'instance' : metrics.name,
+                     'fps' : metrics.fps(),
+                     'busy' : metrics.busy(),
+                     'frames' : metrics.frames.value,
+                     'dropped' : metrics.dropped.value,
+                     'skipped' : metrics.skipped.value,
+                     'duration' : metrics.duration.summary(),
+                     'interval' : metrics.interval.summary(),
+                     'latency' : metrics.latency.summary(),
+                     'slots' : len(stage.ring.slots),
+                     'leased' : stage.ring.leased()}
+            if (hasattr(stage, 'targetLatency') == True):
+                # The processors' frame budget (see bucketprocessor.py)
+                entry['targetLatency'] = stage.targetLatency
+                entry['stale'] = stage.stale.value
+                entry['degraded'] = stage.degraded.value
+                entry['quality'] = stage.quality
+            stages.append(entry)
+
+        latest = self.streamer.ring.count
+        clients = []
+        for client in self.streamer.clientList():
+            clients.append({'address' : client.metrics.name,
+                            'quality' : client.quality,
+                            'scale' : client.scale,
+                            'maxFps' : client.maxFps,
+                            'auto' : client.auto,
+                            'fps' : client.metrics.fps(),
+                            'frames' : client.metrics.frames.value,
+                            'skipped' : client.metrics.skipped.value,
+                            'behind' : max(0, latest - client.lastSeq),
+                            'bytes' : client.bytes.value,
+                            'bytesPerSecond' : client.byteRate.value,
+                            'latency' : client.metrics.latency.summary()})
+
+        threads = []
+        for (name, tid, seconds, percent) in self._threads():
+            threads.append({'name' : name,
+                            'tid' : tid,
+                            'cpuSeconds' : seconds,
+                            'cpuPercent' : percent})
+
+        pipelines = {}
+        for name in sorted(self.processors.keys()):
+            pipelines[name] = self.processors[name].ipselection
+
+        return {'time' : time.time(),
+                'uptime' : monotonic() - self.started,
+                'camera' : self.streamer.selection,
+                'pipelines' : pipelines,
+                'overlay' : self.streamer.overlay,
+                'stages' : stages,
+                'clients' : clients,
+                'threads' : threads}
+
+    def json(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+    def prometheus(self):
+        # Return everything in the Prometheus text exposition format
+        #
+        # The lines of each metric family have to be together, so they
+        # are gathered by family and written out at the end
+        families = {}
+        order = []
+
+        def family(name, kind, help):
+            name = self.prefix + '_' + name
+            if (name not in families):
+                families[name] = ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' ' + kind]
+                order.append(name)
+            return (name, families[name])
+
+        def add(name, kind, help, labels, value):
+            (name, lines) = family(name, kind, help)
+            lines.append(name + _labels(labels) + ' ' + _number(value))
+
+        for metric in registry.all():
+            if (isinstance(metric, Counter) == True):
+                add(metric.name + '_total', 'counter', metric.help, metric.labels, metric.value)
+            elif (isinstance(metric, Gauge) == True):
+                add(metric.name, 'gauge', metric.help, metric.labels, metric.value)
+            elif (isinstance(metric, Histogram) == True):
+                counts = list(metric.counts)
+                (name, lines) = family(metric.name, 'summary', metric.help)
+                for (quantile, percentile) in QUANTILES:
+                    labels = dict(metric.labels)
+                    labels['quantile'] = str(quantile)
+                    lines.append(name + _labels(labels) + ' ' + _number(metric.percentile(percentile, counts)))
+                lines.append(name + '_sum' + _labels(metric.labels) + ' ' + _number(metric.sum))
+                lines.append(name + '_count' + _labels(metric.labels) + ' ' + _number(metric.count))
+                add(metric.name + '_max', 'gauge', metric.help + " (largest)", metric.labels, metric.max)
+
+        for stage in self._stages():
+            labels = {'stage' : stage.metrics.stage, 'instance' : stage.metrics.name}
+            add('ring_slots', 'gauge', "Frame slots of the stage", labels, len(stage.ring.slots))
+            add('ring_leased', 'gauge', "Frame slots of the stage in use", labels, stage.ring.leased())
+
+        latest = self.streamer.ring.count
+        for client in self.streamer.clientList():
+            labels = {'stage' : 'StreamClient', 'instance' : client.metrics.name}
+            add('client_behind', 'gauge', "Frames the client is behind the stream", labels, max(0, latest - client.lastSeq))
+            add('client_quality', 'gauge', "JPEG quality sent to the client", labels, client.quality)
+            add('client_scale', 'gauge', "Scale of the frames sent to the client", labels, client.scale)
+
+        for (name, tid, seconds, percent) in self._threads():
+            labels = {'thread' : name, 'tid' : tid}
+            add('thread_cpu_seconds_total', 'counter', "CPU time used by the thread", labels, seconds)
+
+        for name in sorted(self.processors.keys()):
+            labels = {'camera' : name, 'pipeline' : self.processors[name].ipselection}
+            add('pipeline_selected', 'gauge', "Pipeline selected on each camera", labels, 1)
+        add('camera_streamed', 'gauge', "Camera being streamed", {'camera' : self.streamer.selection}, 1)
+        add('overlay', 'gauge', "Status overlay drawn on the stream", {}, 1 if (self.streamer.overlay == True) else 0)
+
+        lines = []
+        for name in order:
+            lines.extend(families[name])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+bucketstreamer
+
+Encode-once MJPEG stage
+
+Takes the processed frames of the selected camera, draws the status
+overlay and JPEG encodes each frame exactly once. Every HTTP client then
+just writes the same encoded bytes, so adding viewers (driver station,
+pit laptop, recorder, ...) costs socket I/O only.
+
+Each HTTP client gets a StreamClient, which is its send queue: it only
+ever holds the newest encoded frame (see framemailbox.py), so a client
+that falls behind skips the frames it missed instead of queuing them, and
+a stalled client only ever blocks its own thread.
+
+Clients may also ask for a lower frame rate, JPEG quality or scale (the
+field radio has a hard bandwidth cap), or let the StreamClient adjust the
+quality and scale automatically from how long its sends take. Encodes are
+cached per frame by (quality, scale), so clients that want the same
+settings still share one encode: the first to ask does it and the others
+wait for it.
+"""
+
+# import the necessary packages
+
+import cv2
+
+import time
+
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+import numpy as np
+
+# import our classes
+
+import clock
+import threadcpu
+
+from framering import FrameRing
+from metrics import StageMetrics
+from metrics import registry
+
+DEFAULT_QUALITY = 95        # same as cv2.imencode's default
+MIN_QUALITY = 20
+MIN_SCALE = 0.25
+
+def streamOptions(query):
+    # Turn the query string of a stream URL, e.g.
+    #
+    #     /cam.mjpg?fps=10&quality=50&scale=0.5&auto=1
+    #
+    # into the keyword arguments for BucketStreamer.addClient()
+    # Values that are missing or make no sense are ignored
+    options = {}
+    params = parse_qs(query)
+    try:
+        fps = float(params['fps'][0])
+        if (fps > 0.0):
+            options['maxFps'] = fps
+    except (KeyError, ValueError):
+        pass
+    try:
+        options['quality'] = int(min(100, max(MIN_QUALITY, int(params['quality'][0]))))
+    except (KeyError, ValueError):
+        pass
+    try:
+        options['scale'] = min(1.0, max(MIN_SCALE, float(params['scale'][0])))
+    except (KeyError, ValueError):
+        pass
+    if ('auto' in params):
+        options['auto'] = params['auto'][0].lower() in ('1', 'true', 'yes', 'on')
+    return options
+
+
+class StreamClient:
+    def __init__(self, streamer, address, maxFps=None, quality=DEFAULT_QUALITY, scale=1.0, auto=False):
+        self.streamer = streamer
+        self.address = address
+        self.lastSeq = 0
+        self.connected = time.time()
+
+        # Frames sent, skipped because we were behind, how long each took
+        # to encode and send and how old it was once sent
+        name = ":".join(str(part) for part in address)
+        self.metrics = StageMetrics("StreamClient", name)
+        self.bytes = registry.counter('sent_bytes', "Bytes sent", stage="StreamClient", instance=name)
+        self.byteRate = registry.gauge('sent_bytes_per_second', "Smoothed bytes sent per second", stage="StreamClient", instance=name)
+        self._lastSent = None
+        self.frameTime = 0.0    # capture time of the frame being sent
+        self.latency = 0.0      # capture to sent, of the last frame
+
+        # Requested limits; in auto mode quality and scale only ever go
+        # down from (and back up to) what was asked for
+        self.maxFps = maxFps
+        self.maxQuality = int(min(100, max(MIN_QUALITY, quality)))
+        self.maxScale = min(1.0, max(MIN_SCALE, scale))
+        self.quality = self.maxQuality
+        self.scale = self.maxScale
+        self.auto = auto
+
+        self._lastSendTime = 0.0
+        self._sendDuration = 0.0    # smoothed seconds per send
+
+    def next(self, timeout=None):
+        # Return the newest encoded frame not yet sent to this client,
+        # or None if nothing new arrived within timeout seconds
+        if (self.maxFps is not None):
+            wait = self._lastSendTime + 1.0 / self.maxFps - clock.monotonic()
+            if (wait > 0.0):
+                time.sleep(wait)
+
+        (frame, seq, isNew) = self.streamer.read(self.lastSeq, timeout)
+        if (isNew == False):
+            return None
+        self.metrics.start()
+        jpeg = self.streamer.encoded(frame, self.quality, self.scale)
+        self.frameTime = frame.timestamp
+        frame.release()
+
+        if (self.lastSeq != 0):
+            self.metrics.skip(seq - self.lastSeq - 1)
+        self.lastSeq = seq
+        return jpeg
+
+    def sent(self, numBytes, seconds=None):
+        # Record a completed send; seconds is how long the write took
+        self.bytes.inc(numBytes)
+        now = clock.monotonic()
+        self._lastSendTime = now
+        if ((self._lastSent is not None) and (now > self._lastSent)):
+            rate = numBytes / (now - self._lastSent)
+            self.byteRate.set(self.byteRate.value + 0.1 * (rate - self.byteRate.value))
+        self._lastSent = now
+        self.latency = now - self.frameTime
+        self.metrics.end(now, self.frameTime)
+        if (seconds is not None):
+            self._sendDuration = 0.8 * self._sendDuration + 0.2 * seconds
+            if (self.auto == True):
+                self._adapt()
+
+    def close(self):
+        # The client is gone; so are its metrics
+        self.metrics.close()
+        registry.remove(self.bytes)
+        registry.remove(self.byteRate)
+
+    def _adapt(self):
+        # When sends take a large part of the frame period the link is
+        # saturated (the socket buffer is full), so back off the quality
+        # first and then the scale; creep back up when there is headroom
+        #
+        # Steps are coarse so that clients on similar links end up with
+        # the same settings and share encodes
+        fps = self.streamer.metrics.fps()
+        if (self.maxFps is not None):
+            fps = min(fps, self.maxFps) if (fps > 0.0) else self.maxFps
+        if (fps <= 0.0):
+            return
+        period = 1.0 / fps
+
+        if (self._sendDuration > 0.5 * period):
+            if (self.quality > MIN_QUALITY):
+                self.quality = max(MIN_QUALITY, self.quality - 10)
+            elif (self.scale > MIN_SCALE):
+                self.scale = max(MIN_SCALE, self.scale / 2.0)
+            self._sendDuration = 0.0    # give the new setting a chance
+        elif (self._sendDuration < 0.2 * period):
+            if (self.scale < self.maxScale):
+                self.scale = min(self.maxScale, self.scale * 2.0)
+            elif (self.quality < self.maxQuality):
+                self.quality = min(self.maxQuality, self.quality + 10)
+
+
+class BucketStreamer:
+    def __init__(self, name, cameras, processors, selection, numSlots=4):
+        print("Creating BucketStreamer for " + name)
+        self.metrics = StageMetrics("BucketStreamer", name)
+        self.name = name
+        self.cameras = cameras
+        self.processors = processors
+        self.selection = selection
+        self.defaultSelection = selection
+
+        # Overlay is drawn on our own copy of each processed frame; clients
+        # lease these frames just long enough to get an encode of them
+        processorSelection = self.processors[selection]
+        self.ring = FrameRing(numSlots, processorSelection.ring.shape, processorSelection.ring.dtype)
+
+        # Encodes of each slot's current frame keyed by (quality, scale);
+        # each is [done, jpeg], where done is an Event set once jpeg is in
+        self._encodeLock = Lock()
+        self._encodes = [(0, {}) for slot in self.ring.slots]
+
+        self._clientLock = Lock()
+        self.clients = []
+
+        # The status text drawn on the video; the same numbers (and more)
+        # are at /stats and /metrics, so it can be turned off
+        self.overlay = True
+
+        self.latency = 0.0      # capture to encoded, of the last frame
+
+        # initialize the variable used to indicate if the thread should
+        # be stopped
+        self._stop = False
+        self.stopped = True
+
+        print("BucketStreamer created for " + self.name)
+
+    def start(self):
+        print("STARTING BucketStreamer for " + self.name)
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("BucketStreamer for " + self.name + " RUNNING")
+        threadcpu.register("BucketStreamer " + self.name)
+        # keep looping infinitely until the thread is stopped
+        self.stopped = False
+
+        lastProcessor = None
+        lastCount = 0
+
+        while True:
+            # if the thread indicator variable is set, stop the thread
+            if (self._stop == True):
+                self._stop = False
+                self.stopped = True
+                return
+
+            selection = self.selection
+            if (selection not in self.processors):
+                selection = self.defaultSelection
+            cameraSelection = self.cameras[selection]
+            processorSelection = self.processors[selection]
+
+            # Sequence numbers are per processor; start over on a switch
+            if (processorSelection is not lastProcessor):
+                lastProcessor = processorSelection
+                lastCount = 0
+
+            previousCount = lastCount
+            (frame, lastCount, isNew) = processorSelection.read(lastCount, 0.1)
+            if (isNew == False):
+                continue
+            enter = clock.monotonic()
+            self.metrics.start(enter)
+            if (previousCount != 0):
+                self.metrics.skip(lastCount - previousCount - 1)
+
+            out = self.ring.acquire()
+            if (out is None):
+                # Every slot is held by a client; skip this frame
+                frame.release()
+                self.metrics.drop()
+                continue
+            if (frame.image.shape == out.image.shape):
+                np.copyto(out.image, frame.image)
+            else:
+                cv2.resize(frame.image, (out.image.shape[1], out.image.shape[0]), dst=out.image)
+            out.copyStamps(frame)
+            frame.release()
+            img = out.image
+
+            if (self.overlay == True):
+                camFps = cameraSelection.metrics.fps()
+                procFps = processorSelection.metrics.fps()
+                procBusy = processorSelection.metrics.busy()
+
+                cv2.putText(img,"{:.1f}".format(camFps),(0,20),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+                if (procFps != 0.0):
+                    cv2.putText(img,"{:.1f}".format(procFps) + " : {:.0f}".format(100 * procBusy) + "%",(0,40),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+                cv2.putText(img,"{:.1f}".format(self.metrics.fps()),(0,60),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+
+                cv2.putText(img,selection,(0, 80),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+                cv2.putText(img,processorSelection.ipselection,(0,100),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+                cv2.putText(img,"{:.0f} ms".format(1000 * out.age(enter)),(0,120),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
+
+            # Encode the full quality version before publishing since that
+            # is what most clients ask for; publish() gives the slot the
+            # next sequence number (we are the ring's only producer)
+            done = Event()
+            done.set()
+            jpeg = self._encode(out.image, DEFAULT_QUALITY, 1.0)
+            self._encodeLock.acquire()
+            self._encodes[out.index] = (self.ring.count + 1, {(DEFAULT_QUALITY, 1.0) : [done, jpeg]})
+            self._encodeLock.release()
+            now = clock.monotonic()
+            out.stamp("BucketStreamer", enter, now)
+            self.ring.publish(out)
+            self.latency = out.age(now)
+            self.metrics.end(now, out.timestamp)
+
+        print("BucketStreamer for " + self.name + " STOPPING")
+
+    def updateSelection(self, selection):
+        self.selection = selection
+
+    def updateOverlay(self, overlay):
+        self.overlay = overlay
+
+    def read(self, afterSeq=0, timeout=None):
+        # return (frame, seq, isNew) with a lease on the newest streamed
+        # frame after afterSeq, waiting up to timeout seconds for one
+        # Use encoded() to get its JPEG, then frame.release()
+        frame = self.ring.read(afterSeq, timeout)
+        if (frame is None):
+            return (None, afterSeq, False)
+        return (frame, frame.count, True)
+
+    def encoded(self, frame, quality=DEFAULT_QUALITY, scale=1.0):
+        # return the JPEG bytes of a leased frame at the given settings,
+        # encoding them only if no one has asked for them yet (if someone
+        # is encoding them right now, wait for theirs)
+        # The bytes are shared by every client and must not be modified
+        key = (quality, scale)
+        self._encodeLock.acquire()
+        (count, cache) = self._encodes[frame.index]
+        if (count != frame.count):
+            cache = {}
+            self._encodes[frame.index] = (frame.count, cache)
+        entry = cache.get(key)
+        if (entry is None):
+            entry = [Event(), None]
+            cache[key] = entry
+            encoding = True
+        else:
+            encoding = False
+        self._encodeLock.release()
+
+        if (encoding == True):
+            entry[1] = self._encode(frame.image, quality, scale)
+            entry[0].set()
+        else:
+            entry[0].wait()
+        return entry[1]
+
+    def _encode(self, img, quality, scale):
+        # JPEG bytes of an image at the given settings, or None
+        if (scale != 1.0):
+            img = cv2.resize(img, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        r, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if (r == False):
+            return None
+        return buf.tobytes()
+
+    def addClient(self, address, maxFps=None, quality=DEFAULT_QUALITY, scale=1.0, auto=False):
+        client = StreamClient(self, address, maxFps, quality, scale, auto)
+        self._clientLock.acquire()
+        self.clients.append(client)
+        self._clientLock.release()
+        return client
+
+    def removeClient(self, client):
+        self._clientLock.acquire()
+        if (client in self.clients):
+            self.clients.remove(client)
+        self._clientLock.release()
+        client.close()
+
+    def clientList(self):
+        # return a copy of the list of clients
+        self._clientLock.acquire()
+        clients = list(self.clients)
+        self._clientLock.release()
+        return clients
+
+    def stop(self):
+        # indicate that the thread should be stopped
+        self._stop = True
+        self.ring.wakeAll()
+
+    def isStopped(self):
+        return self.stopped
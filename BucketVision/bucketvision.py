@@ -39,9 +39,12 @@ SOFTWARE.
 
 # import the necessary packages
 
+import argparse
 import cv2
 from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+from urlparse import urlparse
 import time
+import socket
 
 from subprocess import call
 from threading import Lock
@@ -53,11 +56,17 @@ import logging      # Needed if we want to see debug messages from NetworkTables
 
 # import our classes
 
-from framerate import FrameRate
+import clock                                # Monotonic time stamps (see clock.py)
 
 from bucketcapture import BucketCapture     # Camera capture threads... may rename this
+from bucketreplay import BucketReplay       # Recorded frames in place of a camera
+from bucketrecorder import BucketRecorder   # Flight recorder of frames and results
 from bucketprocessor import BucketProcessor   # Image processing threads... has same basic structure (may merge classes)
 from bucketserver import BucketServer       # Run the HTTP service
+from bucketserver import ThreadedHTTPServer # One thread per HTTP client
+from bucketstreamer import BucketStreamer   # Overlay and encode frames once for all HTTP clients
+from bucketstreamer import streamOptions    # Per-client fps, quality and scale from the URL
+from bucketstats import BucketStats         # /stats and /metrics
 
 import platform
 
@@ -90,7 +99,28 @@ from blueboiler import BlueBoiler
 from redboiler import RedBoiler
 from boiler import Boiler
 from gearlift import GearLift
+from targettracker import TargetTracker
 from smokestack import SmokeStack
+from templatematcher import TemplateMatch
+
+# A recording can stand in for the camera, so everything downstream can be
+# run (and timed) without one, e.g.
+#
+#   python bucketvision.py --replay 'redBoiler*.jpg' --replay-rate 0
+parser = argparse.ArgumentParser(description='Bit Buckets vision')
+parser.add_argument('--replay', metavar='SOURCE',
+                    help='play a video file, image directory or image glob instead of the front camera')
+parser.add_argument('--replay-rate', type=float, default=None,
+                    help='frames per second to replay at (default: native, 0: as fast as possible)')
+parser.add_argument('--replay-once', action='store_true',
+                    help='stop after the last frame instead of looping')
+parser.add_argument('--record', metavar='DIRECTORY',
+                    help='keep a flight recording of the front camera and the results here')
+parser.add_argument('--record-encoding', default='jpeg', choices=('jpeg', 'raw'),
+                    help='how to store the recorded frames (default: jpeg)')
+parser.add_argument('--target-latency', metavar='MS', type=float, default=None,
+                    help='skip stale frames and degrade the front pipelines to keep capture to result under this')
+args = parser.parse_args()
 
 # And so it begins
 print("Starting BUCKET VISION!")
@@ -115,9 +145,10 @@ bvTable.putString("BucketVisionState","Starting")
 
 # Make the cameraMode an auto updating listener from the network table
 camMode = bvTable.getAutoUpdateValue('CurrentCam','frontCam') # 'frontcam' or 'rearcam'
-frontCamMode = bvTable.getAutoUpdateValue('FrontCamMode', 'gearLift') # 'gearLift' or 'Boiler'
+frontCamMode = bvTable.getAutoUpdateValue('FrontCamMode', 'gearLift') # 'gearLift', 'Boiler' or 'shirt'
 alliance = bvTable.getAutoUpdateValue('allianceColor','red')   # default until chooser returns a value
 location = bvTable.getAutoUpdateValue('allianceLocation',1)
+overlay = bvTable.getAutoUpdateValue('StreamOverlay',True)   # status text on the video
 
 # NOTE: NOTE: NOTE
 #
@@ -133,10 +164,17 @@ location = bvTable.getAutoUpdateValue('allianceLocation',1)
 redBoiler = RedBoiler()
 blueBoiler = BlueBoiler()
 boiler = Boiler()
-gearLift = GearLift(bvTable)
+
+# The gear pipeline writes through a tracker, which also publishes smoothed
+# values predicted to the current time at its own rate (GearTracked_deg, etc.)
+gearTracker = TargetTracker("Gear", bvTable).start()
+gearLift = GearLift(gearTracker)
 
 rope = Rope()
 
+# Finds the shirt (reported as ShirtFound, ShirtCenter_deg, etc.)
+shirt = TemplateMatch(bvTable, 'shirtTraining.jpg', 'Shirt')
+
 nada = Nada()
 
 # NOTE: NOTE: NOTE:
@@ -149,7 +187,10 @@ nada = Nada()
 FRONT_CAM_GEAR_EXPOSURE = 0
 FRONT_CAM_NORMAL_EXPOSURE = -1   # Camera default
 
-frontCam = BucketCapture(name="FrontCam",src=0,width=320,height=240,exposure=FRONT_CAM_GEAR_EXPOSURE).start()    # start low for gears
+if (args.replay is None):
+    frontCam = BucketCapture(name="FrontCam",src=0,width=320,height=240,exposure=FRONT_CAM_GEAR_EXPOSURE).start()    # start low for gears
+else:
+    frontCam = BucketReplay(name="FrontCam",source=args.replay,width=320,height=240,rate=args.replay_rate,loop=(args.replay_once == False)).start()
 
 print("Waiting for BucketCapture to start...")
 while ((frontCam.isStopped() == True)):
@@ -168,9 +209,11 @@ print("BucketCapture appears online!")
 
 frontPipes = {'redBoiler' : nada, #boiler, #redBoiler,
               'blueBoiler' : nada, #boiler, #blueBoiler,
-              'gearLift' : gearLift}
+              'gearLift' : gearLift,
+              'shirt' : shirt}
 
-frontProcessor = BucketProcessor(frontCam,frontPipes,'gearLift').start()
+targetLatency = (args.target_latency / 1000.0) if (args.target_latency is not None) else None
+frontProcessor = BucketProcessor(frontCam,frontPipes,'gearLift',targetLatency=targetLatency).start()
 
 
 print("Waiting for BucketProcessors to start...")
@@ -179,9 +222,17 @@ while ((frontProcessor.isStopped() == True)):
 
 print("BucketProcessors appear online!")
 
+# What the front camera saw and what we reported, for after the match; the
+# recording can be played back with --replay
+frontRecorder = None
+if (args.record is not None):
+    recordKeys = ['GearConfidence', 'GearDistance_inches', 'GearCenter_deg', 'GearLatency_ms',
+                  'GearTracked_deg', 'GearTrackedDistance_inches', 'GearTrackedConfidence',
+                  'StackConfidence', 'StackDistance_inches', 'StackCenter_deg', 'StackLatency_ms']
+    frontRecorder = BucketRecorder("FrontCam", frontCam, args.record, encoding=args.record_encoding,
+                                   table=bvTable, keys=recordKeys, processor=frontProcessor).start()
+
 # Continue feeding display or streams in foreground told to stop
-#fps = FrameRate()   # Keep track of display rate  TODO: Thread that too!
-#fps.start()
 
 # Loop forever displaying the images for initial testing
 #
@@ -199,63 +250,90 @@ print("BucketProcessors appear online!")
 camera = {'frontCam' : frontCam}
 processor = {'frontCam' : frontProcessor}
 
+# Overlay and JPEG encoding happen once per frame here, no matter how
+# many clients are watching
+camStreamer = BucketStreamer("CamStreamer", camera, processor, 'frontCam').start()
+
+print("Waiting for BucketStreamer to start...")
+while ((camStreamer.isStopped() == True)):
+    time.sleep(0.001)
+
+print("BucketStreamer appears online!")
+
+# The same status (and much more) as the overlay, for scraping from the pit
+stats = BucketStats(camera, processor, camStreamer)
+
 class CamHTTPHandler(BaseHTTPRequestHandler):
     _stop = False
-    fps = FrameRate()
+    
+    # Give up on a client whose socket will not take data for this many
+    # seconds (e.g., dropped off the Wi-Fi) so it does not linger forever
+    timeout = 5.0
 
     def stop(self):
         self._self = True
+
+    def sendText(self, text, contentType):
+        self.send_response(200)
+        self.send_header('Content-type',contentType)
+        self.send_header('Content-length',str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
         
     def do_GET(self):
         print(self.path)
-        self.fps.start()
-        if self.path.endswith('.mjpg'):
+        url = urlparse(self.path)
+        if (url.path == '/stats'):
+            self.sendText(stats.json(), 'application/json')
+            return
+
+        if (url.path == '/metrics'):
+            self.sendText(stats.prometheus(), 'text/plain; version=0.0.4')
+            return
+
+        if url.path.endswith('.mjpg'):
             self.send_response(200)
             self.send_header('Content-type','multipart/x-mixed-replace; boundary=--jpgboundary')
             self.end_headers()
             
-            while (frontProcessor.isStopped() == False):
-                try:
-
-                    
+            # Every client sends the same encoded frames (see bucketstreamer.py)
+            # Our StreamClient only ever holds the newest one, so if we are
+            # slow we skip frames rather than fall further behind
+            #
+            # Clients on a tight link can ask for less, e.g.
+            # /cam.mjpg?fps=10&quality=40&scale=0.5, or /cam.mjpg?auto=1 to
+            # have quality and scale follow how fast we can send to them
+            client = camStreamer.addClient(self.client_address, **streamOptions(url.query))
+            
+            # Whatever ends the loop (including an error we do not catch),
+            # the streamer must stop encoding for this client
+            try:
+                while (camStreamer.isStopped() == False):
                     try:
-                        camModeValue = camMode.value
-                        cameraSelection = camera[camModeValue]
-                        processorSelection = processor[camModeValue]
-                    except:
-                        camModeValue = 'frontCam'
-                        cameraSelection = camera[camModeValue]
-                        processorSelection = processor[camModeValue]
-                        
+                        jpeg = client.next(1.0)
                     
-                    (img, count, isNew) = processorSelection.read()
+                        if (jpeg is None):
+                                continue
+
+                        sendStart = clock.monotonic()
+                        self.wfile.write("--jpgboundary\r\n")
+                        self.send_header('Content-type','image/jpeg')
+                        self.send_header('Content-length',str(len(jpeg)))
+                        self.end_headers()
+                        self.wfile.write(jpeg)
+                        self.wfile.write('\r\n')
+
+                        self.wfile.flush()
+                        client.sent(len(jpeg), clock.monotonic() - sendStart)
                     
-                    if (isNew == False):
-                            continue
-                    camFps = cameraSelection.fps.fps()
-                    procFps = processorSelection.fps.fps()
-                    procDuration = processorSelection.duration.duration()
-
-                    cv2.putText(img,"{:.1f}".format(camFps),(0,20),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
-                    if (procFps != 0.0):
-                        cv2.putText(img,"{:.1f}".format(procFps) + " : {:.0f}".format(100 * procDuration * procFps) + "%",(0,40),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
-                    cv2.putText(img,"{:.1f}".format(self.fps.fps()),(0,60),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
-
-                    cv2.putText(img,camModeValue,(0, 80),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
-                    cv2.putText(img,processorSelection.ipselection,(0,100),cv2.FONT_HERSHEY_PLAIN,1,(0,255,0),1)
-
-                    r, buf = cv2.imencode(".jpg",img)
-                    self.wfile.write("--jpgboundary\r\n")
-                    self.send_header('Content-type','image/jpeg')
-                    self.send_header('Content-length',str(len(buf)))
-                    self.end_headers()
-                    self.wfile.write(bytearray(buf))
-                    self.wfile.write('\r\n')
-
-                    self.fps.update()
-                    
-                except KeyboardInterrupt:
-                    break
+                    except KeyboardInterrupt:
+                        break
+                    except (socket.error, socket.timeout) as e:
+                        # Client went away or stalled; only this thread cares
+                        print("CamHTTPHandler client " + str(self.client_address) + " dropped: " + str(e))
+                        break
+            finally:
+                camStreamer.removeClient(client)
             return
 
         if self.path.endswith('.html') or self.path=="/":
@@ -284,7 +362,7 @@ call(cmd,shell=True)
 cmd = ['sudo iptables -t nat -A PREROUTING -i wlan0 -p tcp --dport 80 -j REDIRECT --to-port 8080']
 call(cmd,shell=True)
 
-camHttpServer = HTTPServer(('',8080),CamHTTPHandler)
+camHttpServer = ThreadedHTTPServer(('',8080),CamHTTPHandler)
 camServer = BucketServer("CamServer", camHttpServer).start()
 
 while (camServer.isStopped() == True):
@@ -304,25 +382,46 @@ while (True):
         runTime = runTime + 1
         bvTable.putNumber("BucketVisionTime",runTime)
 
+    camStreamer.updateSelection(camMode.value)
+    camStreamer.updateOverlay(overlay.value)
+
     if (frontCamMode.value == 'gearLift'):
         frontProcessor.updateSelection('gearLift')
         frontCam.updateExposure(FRONT_CAM_GEAR_EXPOSURE)
     elif (frontCamMode.value == 'Boiler'):
         frontProcessor.updateSelection(alliance.value + "Boiler")
         frontCam.updateExposure(FRONT_CAM_NORMAL_EXPOSURE)
+    elif (frontCamMode.value == 'shirt'):
+        frontProcessor.updateSelection('shirt')
+        frontCam.updateExposure(FRONT_CAM_NORMAL_EXPOSURE)
 
     # Monitor network tables for commands to relay to processors and servers
     key = cv2.waitKey(100)
 
     if (frontCam.processUserCommand(key) == True):
         break
+
+    # A replay played once is done when it runs out of frames
+    if ((args.replay_once == True) and (frontCam.isFinished() == True)):
+        break
         
+# How the replay went, for comparing runs
+if (args.replay is not None):
+    print(stats.json())
+
 # NOTE: NOTE: NOTE:
 # Sometimes the exit gets messed up, but for now we just don't care
 
 #stop the bucket server and processors
 
-frontProcessor.stop()      # stop this first to make the server exit
+camStreamer.stop()      # stop this first to make the server exit
+
+print("Waiting for BucketStreamer to stop...")
+while ((camStreamer.isStopped() == False)):
+    time.sleep(0.001)
+print("BucketStreamer appears to have stopped.")
+
+frontProcessor.stop()
 
 
 print("Waiting for BucketProcessors to stop...")
@@ -336,6 +435,19 @@ while (camServer.isStopped() == False):
     time.sleep(0.001)
 print("CamServer appears to have stopped.")
 
+gearTracker.stop()
+print("Waiting for TargetTracker to stop...")
+while (gearTracker.isStopped() == False):
+    time.sleep(0.001)
+print("TargetTracker appears to have stopped.")
+
+
+if (frontRecorder is not None):
+    frontRecorder.stop()
+    print("Waiting for BucketRecorder to stop...")
+    while (frontRecorder.isStopped() == False):
+        time.sleep(0.001)
+    print("BucketRecorder appears to have stopped.")
 
 #stop the camera capture
 frontCam.stop()
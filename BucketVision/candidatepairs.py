@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+candidatepairs
+
+Helpers for pairing target candidates (rotated rectangles) with numpy
+
+The pipelines look for pairs of pieces of tape that fit the known target
+geometry. Rather than testing every pair in nested Python loops and
+taking the first one that passes, the candidate geometry is put in
+arrays, every pairwise test is computed at once as an n x n matrix, and
+the pair that fits the geometry best wins. Ties go to the pair that comes
+first (lowest i, then lowest j), so the choice is deterministic.
+"""
+
+import numpy as np
+
+def rectArrays(rects):
+    """Splits rotated rectangles into arrays.
+    Args:
+        rects: A list of ((x, y), (w, h), angle) as from cv2.minAreaRect.
+    Returns:
+        A tuple of numpy.ndarray (x, y, w, h, angle).
+    """
+    if (len(rects) == 0):
+        empty = np.zeros(0)
+        return (empty, empty, empty, empty, empty)
+    values = np.array([(r[0][0], r[0][1], r[1][0], r[1][1], r[2]) for r in rects], dtype=np.float64)
+    return (values[:, 0], values[:, 1], values[:, 2], values[:, 3], values[:, 4])
+
+def upperPairs(n):
+    """Returns an n x n boolean matrix that is True for i < j, so each
+    unordered pair is considered once.
+    """
+    return np.triu(np.ones((n, n), dtype=bool), 1)
+
+def bestPair(valid, score):
+    """Picks the best valid pair.
+    Args:
+        valid: n x n boolean numpy.ndarray of pairs that pass every test.
+        score: n x n numpy.ndarray; lower is better.
+    Returns:
+        (i, j) of the valid pair with the lowest score, or None.
+    """
+    if (not valid.any()):
+        return None
+    index = np.argmin(np.where(valid, score, np.inf))
+    return np.unravel_index(index, valid.shape)
+
+def greedyPairs(valid, score):
+    """Picks disjoint pairs, best first.
+    Args:
+        valid: n x n boolean numpy.ndarray of pairs that pass every test.
+        score: n x n numpy.ndarray; lower is better.
+    Returns:
+        A list of (i, j); no candidate is used twice.
+    """
+    valid = valid.copy()
+    pairs = []
+    while True:
+        pair = bestPair(valid, score)
+        if (pair is None):
+            return pairs
+        pairs.append(pair)
+        (i, j) = pair
+        valid[[i, j], :] = False
+        valid[:, [i, j]] = False
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+clock
+
+Monotonic time stamps that every stage (and every process) agrees on
+
+time.time() jumps whenever the coprocessor's clock is set (e.g., NTP once
+the radio comes up), which makes latencies measured with it meaningless.
+monotonic() reads CLOCK_MONOTONIC, the same clock the V4L2 drivers stamp
+their buffers with, so a driver timestamp and a stamp taken anywhere else
+in BucketVision (including another process) can be subtracted directly.
+
+Python 2 has no time.monotonic(), so on Linux we call clock_gettime()
+through ctypes; where neither is available we fall back to time.time().
+"""
+
+import ctypes
+import ctypes.util
+import time
+
+CLOCK_MONOTONIC = 1     # linux/time.h
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+def _clockGettime():
+    # Return a monotonic() built on clock_gettime(), or None
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if (path is None):
+            continue
+        try:
+            lib = ctypes.CDLL(path, use_errno=True)
+            clock_gettime = lib.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        ts = _timespec()
+        if (clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0):
+            continue
+
+        def monotonic():
+            ts = _timespec()    # not shared; any thread may call this
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return None
+
+if (hasattr(time, 'monotonic') == True):
+    monotonic = time.monotonic
+    isMonotonic = True
+else:
+    monotonic = _clockGettime()
+    isMonotonic = monotonic is not None
+    if (isMonotonic == False):
+        monotonic = time.time
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+contourfilter
+
+Vectorized version of the GRIP "Filter Contours" step
+
+The code GRIP generates loops over the contours in Python and asks OpenCV
+for the bounding box, area, perimeter and convex hull of every one of
+them, even though nearly all of them are then rejected on size. When the
+retro-reflective tape glares, a frame can have hundreds of tiny specks
+and that loop is where the frame time goes.
+
+Here all of the contours are concatenated into one array of points and
+the cheap features (bounding box, vertex count, area and perimeter) are
+computed for all of them at once with numpy. The convex hull is only
+computed for the contours that survive, and not at all when the solidity
+range lets everything through.
+
+The results match the GRIP code: boundingRect() counts both end pixels,
+contourArea() is the shoelace formula and arcLength() treats the contour
+as closed.
+"""
+
+import cv2
+import numpy as np
+
+def contourFeatures(contours):
+    """Computes the cheap features of many contours at once.
+    Args:
+        contours: Contours as a list of numpy.ndarray.
+    Returns:
+        A tuple of numpy.ndarray (x, y, width, height, area, perimeter,
+        vertices), one entry per contour.
+    """
+    vertices = np.array([len(contour) for contour in contours], dtype=np.intp)
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    starts = np.zeros(len(contours), dtype=np.intp)
+    np.cumsum(vertices[:-1], out=starts[1:])
+
+    px = points[:, 0]
+    py = points[:, 1]
+    x = np.minimum.reduceat(px, starts)
+    y = np.minimum.reduceat(py, starts)
+    width = np.maximum.reduceat(px, starts) - x + 1
+    height = np.maximum.reduceat(py, starts) - y + 1
+
+    # Index of the next point around each (closed) contour
+    following = np.arange(1, len(points) + 1)
+    following[starts + vertices - 1] = starts
+    nx = px[following]
+    ny = py[following]
+
+    area = np.abs(np.add.reduceat(px * ny - nx * py, starts)) / 2.0
+    perimeter = np.add.reduceat(np.hypot(nx - px, ny - py), starts)
+
+    return (x, y, width, height, area, perimeter, vertices)
+
+def filterContours(input_contours, min_area, min_perimeter, min_width, max_width,
+                   min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                   min_ratio, max_ratio):
+    """Filters out contours that do not meet certain criteria.
+    Args:
+        input_contours: Contours as a list of numpy.ndarray.
+        min_area: The minimum area of a contour that will be kept.
+        min_perimeter: The minimum perimeter of a contour that will be kept.
+        min_width: Minimum width of a contour.
+        max_width: MaxWidth maximum width.
+        min_height: Minimum height.
+        max_height: Maximimum height.
+        solidity: The minimum and maximum solidity of a contour.
+        min_vertex_count: Minimum vertex Count of the contours.
+        max_vertex_count: Maximum vertex Count.
+        min_ratio: Minimum ratio of width to height.
+        max_ratio: Maximum ratio of width to height.
+    Returns:
+        Contours as a list of numpy.ndarray.
+    """
+    if (len(input_contours) == 0):
+        return []
+
+    (x, y, w, h, area, perimeter, vertices) = contourFeatures(input_contours)
+    ratio = w / h
+
+    keep = ((w >= min_width) & (w <= max_width) &
+            (h >= min_height) & (h <= max_height) &
+            (area >= min_area) &
+            (perimeter >= min_perimeter) &
+            (vertices >= min_vertex_count) & (vertices <= max_vertex_count) &
+            (ratio >= min_ratio) & (ratio <= max_ratio))
+
+    output = []
+    checkSolidity = (solidity[0] > 0) or (solidity[1] < 100)
+    for i in np.flatnonzero(keep):
+        contour = input_contours[i]
+        if (checkSolidity == True):
+            hullArea = cv2.contourArea(cv2.convexHull(contour))
+            if (hullArea > 0.0):
+                solid = 100 * area[i] / hullArea
+            else:
+                solid = 0.0
+            if (solid < solidity[0] or solid > solidity[1]):
+                continue
+        output.append(contour)
+    return output
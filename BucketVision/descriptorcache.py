@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+descriptorcache
+
+On-disk cache of the keypoints and descriptors of training images
+
+Feature matching pipelines (e.g., Boiler) find the keypoints of their
+training image when they are created, which with SURF takes a good while
+on the coprocessor, and it is the same answer every time. Here the answer
+is kept on disk, keyed by a hash of the training image's pixels and of
+everything that changes the answer (the detector, its parameters and the
+OpenCV version), so
+
+    (keypoints, descriptors) = detectAndCompute(detector, image)
+
+only runs the detector the first time; after that it loads two .npy
+files (a keypoint table and the descriptors), the descriptors memory
+mapped straight from the file.
+
+The files are written to a temporary name and renamed into place, so a
+power off while writing can not leave a half-written entry behind.
+Deleting the cache directory is always safe.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+CACHE_DIRECTORY = 'descriptorcache'
+
+# Getters of the feature detectors' parameters; whichever the detector has
+# go into the key
+PARAMETER_GETTERS = ('getHessianThreshold', 'getNOctaves', 'getNOctaveLayers',
+                     'getExtended', 'getUpright', 'getThreshold', 'getOctaves',
+                     'getPatternScale', 'getMaxFeatures', 'getScaleFactor',
+                     'getNLevels', 'getEdgeThreshold', 'getFirstLevel', 'getWTA_K',
+                     'getScoreType', 'getPatchSize', 'getFastThreshold',
+                     'getDescriptorType', 'getDescriptorSize', 'getDescriptorChannels',
+                     'getDiffusivity')
+
+# One row per keypoint
+KEYPOINT_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('size', '<f4'), ('angle', '<f4'),
+                           ('response', '<f4'), ('octave', '<i4'), ('class_id', '<i4')])
+
+def detectorKey(detector):
+    """Describes everything about a detector that changes its answer.
+    Args:
+        detector: An OpenCV Feature2D (SURF, ORB, ...).
+    Returns:
+        A string naming the detector, its parameters and the OpenCV version.
+    """
+    parts = [cv2.__version__, detector.__class__.__name__]
+    if (hasattr(detector, 'getDefaultName') == True):
+        parts.append(detector.getDefaultName())
+    for getter in PARAMETER_GETTERS:
+        if (hasattr(detector, getter) == True):
+            try:
+                parts.append(getter[3:] + '=' + repr(getattr(detector, getter)()))
+            except cv2.error:
+                pass
+    return ';'.join(parts)
+
+def imageKey(image, detector):
+    # Hash of the image's pixels and the detector, used to name the files
+    h = hashlib.sha1()
+    h.update(detectorKey(detector).encode('utf-8'))
+    h.update(str(image.shape).encode('utf-8'))
+    h.update(str(image.dtype).encode('utf-8'))
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+def keypointTable(keypoints):
+    table = np.zeros(len(keypoints), dtype=KEYPOINT_DTYPE)
+    for (i, kp) in enumerate(keypoints):
+        table[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+    return table
+
+def keypointList(table):
+    # tolist() gives plain Python numbers, which is much quicker than
+    # indexing the rows one at a time
+    return [cv2.KeyPoint(x, y, size, angle, response, octave, classId)
+            for (x, y, size, angle, response, octave, classId) in table.tolist()]
+
+def _save(path, array):
+    # Write array to path without ever leaving a partial file there
+    directory = os.path.dirname(path)
+    (fd, temporary) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.rename(temporary, path)
+    except:
+        os.remove(temporary)
+        raise
+
+def detectAndCompute(detector, image, mask=None, directory=CACHE_DIRECTORY):
+    """Finds the keypoints and descriptors of a training image, from the cache
+    if they have been found before.
+    Args:
+        detector: An OpenCV Feature2D (SURF, ORB, ...).
+        image: The training image.
+        mask: Optional mask, as for detector.detectAndCompute(); a masked
+            call is never cached.
+        directory: Where the cache lives; None to not use it.
+    Returns:
+        (keypoints, descriptors), as detector.detectAndCompute() returns
+        them, except that descriptors may be a read-only memory map.
+    """
+    if ((directory is None) or (mask is not None)):
+        return detector.detectAndCompute(image, mask)
+
+    key = imageKey(image, detector)
+    base = os.path.join(directory, key)
+    try:
+        table = np.load(base + '.kp.npy')
+        descriptors = np.load(base + '.des.npy', mmap_mode='r')
+        if (len(descriptors) == len(table)):
+            return (keypointList(table), descriptors)
+    except (IOError, ValueError):
+        pass
+
+    (keypoints, descriptors) = detector.detectAndCompute(image, None)
+    if (descriptors is None):
+        return (keypoints, descriptors)     # nothing worth remembering
+    try:
+        if (os.path.isdir(directory) == False):
+            os.makedirs(directory)
+        _save(base + '.des.npy', descriptors)
+        _save(base + '.kp.npy', keypointTable(keypoints))
+    except (IOError, OSError) as e:
+        # Read-only file system, full disk, ...; we just do this again
+        # next time
+        print("Could not cache descriptors in " + directory + ": " + str(e))
+    return (keypoints, descriptors)
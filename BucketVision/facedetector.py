@@ -37,12 +37,13 @@ SOFTWARE.
 # import the necessary packages
 
 import cv2
+import numpy as np
 
 import time
 
 # import our classes
 
-from framerate import FrameRate
+from metrics import StageMetrics
 
 from bucketcapture import BucketCapture     # Camera capture threads... may rename this
 from imageprocessor import ImageProcessor   # Image processing threads... has same basic structure (may merge classes)
@@ -113,8 +114,10 @@ while (bucketProcessor.isStopped() == True):
 print("ImageProcessors appear online!")
 
 # Continue feeding display or streams in foreground told to stop
-fps = FrameRate()   # Keep track of display rate  TODO: Thread that too!
-fps.start()
+display = StageMetrics("Display", "bucketCam")    # Keep track of display rate  TODO: Thread that too!
+
+bucketFrame = None  # display copy that the overlay is drawn on
+lastCount = 0       # last frame displayed
 
 # Loop forever displaying the images for initial testing
 #
@@ -130,31 +133,39 @@ fps.start()
 #
 while (True):
     # grab the frame from the image processor
-    (bucketFrame, count, isNew) = bucketProcessor.read()
+    (frame, lastCount, isNew) = bucketProcessor.read(lastCount)
 
     # check to see if the frame should be displayed to our screen
     # For now, just show every new frame
     if (isNew == True):
-         camFps = bucketCam.fps.fps()
-         procFps = bucketProcessor.fps.fps()
-         procDuration = bucketProcessor.duration.duration()
+         display.start()
+         if (bucketFrame is None):
+             bucketFrame = np.empty_like(frame.image)
+         np.copyto(bucketFrame, frame.image)
+         timestamp = frame.timestamp
+         frame.release()
+
+         camFps = bucketCam.metrics.fps()
+         procFps = bucketProcessor.metrics.fps()
+         procBusy = bucketProcessor.metrics.busy()
 
          cv2.putText(bucketFrame,"{:.1f}".format(camFps),(0,40),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
          if (procFps != 0.0):
-             cv2.putText(bucketFrame,"{:.1f}".format(procFps) + " : {:.0f}".format(100 * procDuration * procFps) + "%",(0,80),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
-         cv2.putText(bucketFrame,"{:.1f}".format(fps.fps()),(0,120),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
+             cv2.putText(bucketFrame,"{:.1f}".format(procFps) + " : {:.0f}".format(100 * procBusy) + "%",(0,80),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
+         cv2.putText(bucketFrame,"{:.1f}".format(display.fps()),(0,120),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
+         cv2.putText(bucketFrame,"detect 1/{}".format(faces.interval),(0,160),cv2.FONT_HERSHEY_PLAIN,2,(0,255,0),2)
 
          cv2.imshow("bucketCam", bucketFrame)
 
          key = cv2.waitKey(1) & 0xFF
+
+         # update the display FPS counter (in this case it will be roughly the rate of the slowest pipeline because
+         # we are displaying both pipelines in the same thread (again because I just don't feel like messing
+         # with the extra steps to make X11 behave
+         display.end(timestamp=timestamp)
          
          if (bucketCam.processUserCommand(key) == True):
              break
-            
-    # update the display FPS counter (in this case it will be roughly the rate of the slowest pipeline because
-    # we are displaying both pipelines in the same thread (again because I just don't feel like messing
-    # with the extra steps to make X11 behave
-    fps.update()
 
 
 # NOTE: NOTE: NOTE:
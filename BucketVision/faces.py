@@ -1,30 +1,169 @@
+import math
+
 import cv2
 import numpy
 
+from clock import monotonic
+
 class Faces:
     """
     An OpenCV pipeline created to find faces
+
+    The cascades are slow, so they are only run every few frames, on a
+    smaller copy of the frame; in between, each face is followed with
+    Lucas-Kanade optical flow on a handful of corners inside it, which
+    costs a fraction of a detection. A face whose corners can not be
+    followed is dropped and the next frame is a detection frame.
+
+    Unless detectEvery is given, how many frames go by between detections
+    is worked out from how long a detection and a tracking frame take, so
+    that on average a frame fits in budget_ms.
     """
-    
-    def __init__(self):
+
+    def __init__(self, detectEvery=None, detectScale=0.5, budget_ms=1000.0/30, maxInterval=15):
         """initializes all values to presets or None if need to be set
+
+        detectEvery: detect on every this many frames (1 is every frame,
+            with no tracking); None to adapt it to budget_ms
+        detectScale: how much the frame is shrunk for the face cascade
+        budget_ms: time per frame to fit in, on average, when adapting
+        maxInterval: most frames between detections when adapting
         """
         self.face_cascade = cv2.CascadeClassifier('haarcascade_frontalface_default.xml')
-        self.eye_cascade = cv2.CascadeClassifier('haarcascade_eye.xml')        
+        self.eye_cascade = cv2.CascadeClassifier('haarcascade_eye.xml')
+
+        # Camera frame our image is a copy of, if the BucketProcessor gives
+        # us one, so we can share its gray image (see framecache.py)
+        self.frame = None
+
+        self.detectEvery = detectEvery
+        self.detectScale = detectScale
+        self.budget_ms = budget_ms
+        self.maxInterval = maxInterval
+
+        # Faces being followed: each is [x, y, w, h] (floats), the eyes in it
+        # as fractions of the face, and the corners followed in it
+        self.faces = []
+        self._previous = None       # gray frame the corners are from
+        self._sinceDetect = None    # frames since the last detection
+
+        # Running averages of the time per frame of each kind
+        self.detect_ms = None
+        self.track_ms = None
+        # (adapting starts at 2 so that a tracking frame gets timed too)
+        self.interval = 2 if (detectEvery is None) else max(1, int(detectEvery))
 
     def process(self, source0):
         """
         Runs the pipeline and sets all outputs to new values.
         """
         img = source0
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
-        for (x,y,w,h) in faces:
+        start = monotonic()
+        if (self.frame is not None):
+            gray = self.frame.cache.gray()
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        if ((self._sinceDetect is None) or (self._sinceDetect + 1 >= self.interval) or
+            (self._previous is None) or (self._previous.shape != gray.shape)):
+            self.__detect(gray)
+            self._sinceDetect = 0
+            self.detect_ms = self.__average(self.detect_ms, 1000.0 * (monotonic() - start))
+        else:
+            lost = self.__track(gray)
+            self._sinceDetect = None if (lost == True) else self._sinceDetect + 1
+            self.track_ms = self.__average(self.track_ms, 1000.0 * (monotonic() - start))
+        self.__adapt()
+
+        # Keep our own copy; the cached gray image goes with the frame
+        if ((self._previous is None) or (self._previous.shape != gray.shape)):
+            self._previous = numpy.empty_like(gray)
+        numpy.copyto(self._previous, gray)
+
+        for (box, eyes, corners) in self.faces:
+            (x, y, w, h) = [int(round(v)) for v in box]
             cv2.rectangle(img,(x,y),(x+w,y+h),(255,0,0),2)
-            roi_gray = gray[y:y+h, x:x+w]
-            roi_color = img[y:y+h, x:x+w]
-            eyes = self.eye_cascade.detectMultiScale(roi_gray)
             for (ex,ey,ew,eh) in eyes:
-                cv2.rectangle(roi_color,(ex,ey),(ex+ew,ey+eh),(0,255,0),2)
+                (ex, ey) = (x + int(ex * w), y + int(ey * h))
+                cv2.rectangle(img,(ex,ey),(ex+int(ew*w),ey+int(eh*h)),(0,255,0),2)
 
         return img
+
+    def __detect(self, gray):
+        # Run the cascades and start following what they found
+        small = gray
+        if (self.detectScale != 1.0):
+            size = (int(gray.shape[1] * self.detectScale), int(gray.shape[0] * self.detectScale))
+            small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        self.faces = []
+        for (sx,sy,sw,sh) in self.face_cascade.detectMultiScale(small, 1.3, 5):
+            (x, y, w, h) = [int(v / self.detectScale) for v in (sx, sy, sw, sh)]
+            roi_gray = gray[y:y+h, x:x+w]
+            eyes = [(ex / float(w), ey / float(h), ew / float(w), eh / float(h))
+                    for (ex,ey,ew,eh) in self.eye_cascade.detectMultiScale(roi_gray)]
+            corners = cv2.goodFeaturesToTrack(roi_gray, 20, 0.01, 3)
+            if (corners is None):
+                corners = numpy.zeros((0, 1, 2), dtype=numpy.float32)
+            corners = corners + numpy.float32([x, y])
+            self.faces.append(([float(x), float(y), float(w), float(h)], eyes, corners))
+
+    def __track(self, gray):
+        # Move each face with its corners; returns True if any face was lost
+        if (len(self.faces) == 0):
+            return False
+        p0 = numpy.concatenate([corners for (box, eyes, corners) in self.faces])
+        if (len(p0) == 0):
+            self.faces = []
+            return True
+        (p1, status, _) = cv2.calcOpticalFlowPyrLK(self._previous, gray, p0, None, winSize=(15,15), maxLevel=2)
+        (back, backStatus, _) = cv2.calcOpticalFlowPyrLK(gray, self._previous, p1, None, winSize=(15,15), maxLevel=2)
+
+        # Only corners that come back to where they started can be trusted
+        good = ((status.ravel() == 1) & (backStatus.ravel() == 1) &
+                (numpy.abs(p0 - back).reshape(-1, 2).max(axis=1) < 1.0))
+
+        lost = False
+        faces = []
+        first = 0
+        for (box, eyes, corners) in self.faces:
+            last = first + len(corners)
+            keep = good[first:last]
+            (old, new) = (p0[first:last][keep].reshape(-1, 2), p1[first:last][keep].reshape(-1, 2))
+            first = last
+            if (len(new) < 4):
+                lost = True
+                continue
+
+            # The median motion moves the face; how much the corners spread
+            # out (or in) scales it
+            oldCenter = numpy.median(old, axis=0)
+            newCenter = numpy.median(new, axis=0)
+            oldSpread = numpy.median(numpy.hypot(*(old - oldCenter).T))
+            newSpread = numpy.median(numpy.hypot(*(new - newCenter).T))
+            scale = (newSpread / oldSpread) if (oldSpread > 0.0) else 1.0
+
+            (x, y, w, h) = box
+            (cx, cy) = (x + w / 2.0 + newCenter[0] - oldCenter[0], y + h / 2.0 + newCenter[1] - oldCenter[1])
+            (w, h) = (w * scale, h * scale)
+            faces.append(([cx - w / 2.0, cy - h / 2.0, w, h], eyes, new.reshape(-1, 1, 2)))
+        self.faces = faces
+        return lost
+
+    def __adapt(self):
+        # Detect as often as the budget allows: with a detection every N
+        # frames a frame takes (detect + (N - 1) * track) / N on average
+        if ((self.detectEvery is not None) or (self.detect_ms is None) or (self.track_ms is None)):
+            return
+        if (self.detect_ms <= self.budget_ms):
+            self.interval = 1
+        elif (self.track_ms >= self.budget_ms):
+            self.interval = self.maxInterval
+        else:
+            n = math.ceil((self.detect_ms - self.track_ms) / (self.budget_ms - self.track_ms))
+            self.interval = int(min(self.maxInterval, max(1, n)))
+
+    @staticmethod
+    def __average(average, value):
+        if (average is None):
+            return value
+        return 0.9 * average + 0.1 * value
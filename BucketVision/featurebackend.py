@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+featurebackend
+
+Feature detector and matcher pairs for the training image matchers
+
+Boiler finds its training image in each frame by detecting features,
+matching them against the training image's and keeping the matches that
+pass Lowe's ratio test. How fast that is depends almost entirely on the
+detector and the matcher, so they are chosen by name:
+
+    'surf'      SURF (float descriptors, needs opencv-contrib) with a FLANN
+                KD-tree index of the training descriptors
+    'surf-bf'   SURF with a brute force matcher (what Boiler always did)
+    'orb'       ORB (binary descriptors) with a FLANN LSH index
+    'orb-bf'    ORB with a brute force Hamming matcher
+    'brisk'     BRISK (binary) with a FLANN LSH index
+
+The training descriptors come from descriptorcache.py and are indexed once,
+in train(); each frame then only has its own descriptors matched against
+that index. The ratio test is done on arrays of the match distances rather
+than one match at a time, and the matched points come out as the arrays
+cv2.findHomography() wants.
+
+pipelinebench.py runs Boiler with each backend, so they can be compared on
+both speed and how often the homography is found.
+"""
+
+import cv2
+import numpy as np
+
+from descriptorcache import detectAndCompute
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+BACKENDS = ('surf', 'surf-bf', 'orb', 'orb-bf', 'brisk')
+
+def _kdTree():
+    return cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_KDTREE, trees=5), dict(checks=50))
+
+def _lsh():
+    return cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12,
+                                      multi_probe_level=1), dict(checks=50))
+
+def featureBackend(name, maxFeatures=1000):
+    """Makes a backend by name.
+    Args:
+        name: One of BACKENDS.
+        maxFeatures: Most features ORB keeps per image.
+    Returns:
+        The FeatureBackend.
+    Raises:
+        ValueError if the name is unknown, AttributeError if this OpenCV
+        does not have the detector (SURF needs opencv-contrib).
+    """
+    if (name == 'surf'):
+        return FeatureBackend(name, cv2.xfeatures2d.SURF_create(), _kdTree())
+    elif (name == 'surf-bf'):
+        return FeatureBackend(name, cv2.xfeatures2d.SURF_create(), cv2.BFMatcher(cv2.NORM_L2, False))
+    elif (name == 'orb'):
+        return FeatureBackend(name, cv2.ORB_create(maxFeatures), _lsh())
+    elif (name == 'orb-bf'):
+        return FeatureBackend(name, cv2.ORB_create(maxFeatures), cv2.BFMatcher(cv2.NORM_HAMMING, False))
+    elif (name == 'brisk'):
+        return FeatureBackend(name, cv2.BRISK_create(), _lsh())
+    raise ValueError("Unknown feature backend " + str(name) + "; use one of " + ", ".join(BACKENDS))
+
+
+class FeatureBackend:
+    def __init__(self, name, detector, matcher):
+        self.name = name
+        self.detector = detector
+        self.matcher = matcher
+        self.ratio = 0.7            # Lowe's ratio test
+
+        self.keypoints = None
+        self.descriptors = None
+        self.points = None          # training keypoint locations, N x 2
+
+    def train(self, image):
+        # Find the training image's features and index them for matching
+        (self.keypoints, self.descriptors) = detectAndCompute(self.detector, image)
+        self.points = np.float32([kp.pt for kp in self.keypoints]).reshape(-1, 2)
+        self.matcher.clear()
+        if (self.descriptors is not None):
+            # The FLANN matchers build their index here, once; the cached
+            # descriptors may be a read-only memory map, which they do not
+            # take
+            self.matcher.add([np.ascontiguousarray(self.descriptors)])
+            self.matcher.train()
+
+    def detect(self, gray):
+        # Return (keypoints, descriptors) of a frame
+        return self.detector.detectAndCompute(gray, None)
+
+    def match(self, keypoints, descriptors):
+        """Matches a frame's features to the training image's.
+        Args:
+            keypoints: The frame's keypoints.
+            descriptors: The frame's descriptors (may be None).
+        Returns:
+            (trainingPoints, framePoints), the locations of the matches that
+            pass the ratio test as N x 1 x 2 float32 arrays (N may be 0).
+        """
+        none = np.zeros((0, 1, 2), dtype=np.float32)
+        if ((descriptors is None) or (self.descriptors is None) or (len(descriptors) < 2)):
+            return (none, none)
+
+        # Each of the frame's features against the trained index; LSH may
+        # come back with fewer than two neighbors for some of them
+        matches = [pair for pair in self.matcher.knnMatch(descriptors, k=2) if (len(pair) == 2)]
+        if (len(matches) == 0):
+            return (none, none)
+        matched = np.array([(m.distance, n.distance, m.queryIdx, m.trainIdx) for (m, n) in matches],
+                           dtype=np.float64)
+        good = matched[matched[:, 0] < self.ratio * matched[:, 1]]
+
+        framePoints = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+        trainingPoints = self.points[good[:, 3].astype(np.intp)].reshape(-1, 1, 2)
+        framePoints = framePoints[good[:, 2].astype(np.intp)].reshape(-1, 1, 2)
+        return (trainingPoints, framePoints)
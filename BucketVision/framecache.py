@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+framecache
+
+Per-frame cache of images derived from a frame (HLS, gray, resized,
+threshold masks, ...)
+
+When several processors run on the same camera (e.g., GearLift and
+BoilerStack at the same time) they would each convert the same frame to
+the same color space, resize it the same way and even threshold it with
+the same numbers. Every FrameSlot carries a FrameCache, so the first
+pipeline to ask for something computes it and the rest just use it:
+
+    hls = frame.cache.hls()
+
+Entries belong to the frame the slot currently holds (its sequence
+number); when the producer reuses the slot for a newer frame they are
+dropped, but their memory is kept and written over by the next
+computation of the same thing, so steady-state memory stays flat.
+
+Cached images are shared, so they are read-only: copy one before handing
+it to anything that modifies its input (e.g., findContours() in OpenCV 3).
+Entries are only valid while the frame is leased.
+"""
+
+from threading import RLock
+
+import cv2
+import numpy as np
+
+class FrameCache:
+    def __init__(self, slot):
+        self.slot = slot
+        self._lock = RLock()    # an entry may be computed from another
+        self._count = 0         # frame the entries belong to
+        self._images = {}
+        self._buffers = {}      # memory of entries from earlier frames
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, shape, dtype=np.uint8):
+        """Returns the image for key, computing it if this is the first
+        request for it on the current frame.
+        Args:
+            key: Any hashable that identifies what compute() produces.
+            compute: Function that takes the destination numpy.ndarray,
+                fills it from self.slot.image and returns it.
+            shape: The shape of the image compute() produces.
+            dtype: The type of the image compute() produces.
+        Returns:
+            A numpy.ndarray that must not be modified.
+        """
+        self._lock.acquire()
+        try:
+            if (self._count != self.slot.count):
+                self._reset(self.slot.count)
+
+            image = self._images.get(key)
+            if (image is not None):
+                self.hits += 1
+                return image
+
+            dst = self._buffers.pop(key, None)
+            if ((dst is None) or (dst.shape != tuple(shape)) or (dst.dtype != dtype)):
+                dst = np.empty(shape, dtype=dtype)
+
+            # Computed under the lock so that concurrent requests for the
+            # same thing wait for the first instead of repeating it
+            image = compute(dst)
+            self._images[key] = image
+            self.misses += 1
+            return image
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        # Called when the slot is about to be written with a new frame
+        self._lock.acquire()
+        self._reset(0)
+        self._lock.release()
+
+    def _reset(self, count):
+        for (key, image) in self._images.items():
+            self._buffers[key] = image
+        self._images = {}
+        self._count = count
+
+    def convert(self, code, channels=3):
+        """Returns the frame converted with cv2.cvtColor.
+        Args:
+            code: The cv2.COLOR_* conversion.
+            channels: How many channels the conversion produces.
+        """
+        image = self.slot.image
+        shape = image.shape[:2] if (channels == 1) else image.shape[:2] + (channels,)
+        return self.get(('convert', code), lambda dst: cv2.cvtColor(image, code, dst=dst), shape)
+
+    def hls(self):
+        return self.convert(cv2.COLOR_BGR2HLS)
+
+    def gray(self):
+        return self.convert(cv2.COLOR_BGR2GRAY, 1)
+
+    def resized(self, width, height, interpolation=cv2.INTER_LINEAR):
+        """Returns the frame resized to width x height.
+        """
+        image = self.slot.image
+        size = (int(width), int(height))
+        return self.get(('resized', size, interpolation),
+                        lambda dst: cv2.resize(image, size, dst=dst, interpolation=interpolation),
+                        (size[1], size[0]) + image.shape[2:], image.dtype)
+
+    def hslThreshold(self, hue, sat, lum, threshold=None):
+        """Returns the mask of the pixels inside the hue, saturation and
+        luminance ranges.
+        Args:
+            hue: A list of two numbers the are the min and max hue.
+            sat: A list of two numbers the are the min and max saturation.
+            lum: A list of two numbers the are the min and max luminance.
+            threshold: Optional HSLThreshold to compute it with; otherwise
+                the cached HLS image is thresholded with inRange().
+        """
+        image = self.slot.image
+        if (threshold is not None):
+            compute = lambda dst: threshold.threshold(image, hue, sat, lum, dst)
+        else:
+            compute = lambda dst: cv2.inRange(self.hls(), (hue[0], lum[0], sat[0]), (hue[1], lum[1], sat[1]), dst)
+        key = ('hslThreshold', tuple(hue), tuple(sat), tuple(lum))
+        return self.get(key, compute, image.shape[:2])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+framemailbox
+
+Sequence-numbered "latest value" mailbox for handing frames between stages
+
+The producer puts each new item in the mailbox, which stamps it with the
+next sequence number and drops whatever was there before. A consumer
+remembers the last sequence number it saw and asks for anything newer:
+
+    (item, seq) = mailbox.read(lastSeq, timeout)
+
+If a newer item is already waiting it is returned immediately, so a
+notify that happened while the consumer was busy is never lost; a
+timeout of 0 polls without blocking. When nothing newer arrives before
+the timeout (or wakeAll() is called) the result is (None, lastSeq).
+"""
+
+import clock
+
+from threading import Lock
+from threading import Condition
+
+class FrameMailbox:
+    def __init__(self, lock=None, claim=None):
+        """
+        Args:
+            lock: optional lock to share with the owner (e.g., FrameRing)
+                  so its own bookkeeping is atomic with respect to reads
+            claim: optional function called with the item, under the lock,
+                   just before it is handed to a reader (e.g., to take a
+                   reference on it)
+        """
+        if (lock is None):
+            lock = Lock()
+        self._lock = lock
+        self._condition = Condition(lock)
+        self._claim = claim
+        self._item = None
+        self._seq = 0
+        self._wakeups = 0
+
+    def put(self, item):
+        # Replace the current item and wake everyone waiting; returns
+        # the sequence number assigned to the item
+        self._condition.acquire()
+        try:
+            self._seq += 1
+            self._item = item
+            self._condition.notifyAll()
+            return self._seq
+        finally:
+            self._condition.release()
+
+    def read(self, afterSeq=0, timeout=None):
+        # Return (item, seq) for the newest item with seq > afterSeq,
+        # waiting up to timeout seconds (forever if None) for one to arrive
+        self._condition.acquire()
+        try:
+            wakeups = self._wakeups
+            if (timeout is not None):
+                deadline = clock.monotonic() + timeout
+            while ((self._seq <= afterSeq) and (self._wakeups == wakeups)):
+                if (timeout is None):
+                    self._condition.wait()
+                else:
+                    remaining = deadline - clock.monotonic()
+                    if (remaining <= 0.0):
+                        break
+                    self._condition.wait(remaining)
+
+            if ((self._seq <= afterSeq) or (self._item is None)):
+                return (None, afterSeq)
+
+            if (self._claim is not None):
+                self._claim(self._item)
+            return (self._item, self._seq)
+        finally:
+            self._condition.release()
+
+    def peek(self):
+        # Return (item, seq) for the current item without claiming it;
+        # the caller must already hold the lock if it needs consistency
+        return (self._item, self._seq)
+
+    def seq(self):
+        return self._seq
+
+    def wakeAll(self):
+        # Make every blocked reader return (e.g., when stopping)
+        self._condition.acquire()
+        self._wakeups += 1
+        self._condition.notifyAll()
+        self._condition.release()
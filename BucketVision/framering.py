@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+framering
+
+Fixed-size ring of preallocated frames shared between pipeline stages
+
+A producer (e.g., BucketCapture) acquires a free slot, fills it in place
+and publishes it. Consumers lease the most recently published slot and
+release it when they are done; a slot is never handed back to the producer
+while anyone still holds a lease on it, so a consumer can read a frame
+without it changing underneath them.
+
+Publishing goes through a FrameMailbox, so readers ask for "anything
+newer than the last frame I saw" and never miss a publish.
+
+Leases are read-only by convention: a consumer that wants to draw on a
+frame must copy it into a slot of its own first (see BucketProcessor).
+
+Each slot also carries a FrameCache (see framecache.py) of images
+derived from its frame, so consumers of the same frame can share color
+conversions, resizes, etc.
+
+Every frame carries the monotonic time it was captured (see clock.py)
+and a list of (stage, enter, exit) stamps, one per stage it went through,
+so the latency from photons to any point downstream can be measured. A
+stage that copies a frame into a slot of its own copies these along with
+the pixels (see copyStamps()) and adds its own with stamp().
+
+All of the frame memory is allocated up front so steady-state memory
+stays flat no matter how long we run. A ring created with shared=True
+puts the frames in shared memory, so a forked worker process sees the
+same pixels (see pipelineworker.py).
+"""
+
+from threading import Lock
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+from framecache import FrameCache
+from framemailbox import FrameMailbox
+
+class FrameSlot:
+    def __init__(self, ring, index, shape, dtype, shared=False):
+        self.ring = ring
+        self.index = index
+        if (shared == True):
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self._buffer = sharedctypes.RawArray('B', nbytes)
+            self.image = np.frombuffer(self._buffer, dtype=dtype).reshape(shape)
+        else:
+            self._buffer = None
+            self.image = np.zeros(shape, dtype=dtype)
+        self.count = 0          # sequence number of the frame currently held
+        self.timestamp = 0.0    # monotonic capture time of that frame
+        self.stamps = []        # (stage, enter, exit) monotonic times
+        self._refs = 0
+        self.cache = FrameCache(self)
+
+    def stamp(self, stage, enter, exit):
+        # record the time a stage started and finished with this frame
+        # (only the producer that acquired the slot may do this)
+        self.stamps.append((stage, enter, exit))
+
+    def copyStamps(self, other):
+        # carry the capture time and stamps of the frame we are a copy of
+        self.timestamp = other.timestamp
+        self.stamps = list(other.stamps)
+
+    def age(self, now):
+        # seconds between capture and now (a monotonic time)
+        return now - self.timestamp
+
+    def release(self):
+        # give back a lease obtained from FrameRing.read
+        self.ring.release(self)
+
+    def refs(self):
+        return self._refs
+
+
+class FrameRing:
+    def __init__(self, numSlots, shape, dtype=np.uint8, shared=False):
+        self._lock = Lock()
+        self._mailbox = FrameMailbox(self._lock, self._claim)
+        self.shape = shape
+        self.dtype = dtype
+        self.shared = shared
+        self.slots = [FrameSlot(self, i, shape, dtype, shared) for i in range(numSlots)]
+        self._next = 0
+        self.count = 0          # number of frames published
+        self.dropped = 0        # number of times no slot was free
+
+    def acquire(self):
+        # Return a slot the producer may write into, or None if every
+        # slot is leased (the caller should drop the frame)
+        #
+        # The most recently published slot is never handed out since
+        # it is what the next reader will get
+        found = None
+        self._lock.acquire()
+        (latest, seq) = self._mailbox.peek()
+        numSlots = len(self.slots)
+        for i in range(numSlots):
+            slot = self.slots[(self._next + i) % numSlots]
+            if ((slot._refs == 0) and (slot is not latest)):
+                slot._refs = 1      # producer holds it until publish
+                self._next = (slot.index + 1) % numSlots
+                found = slot
+                break
+        if (found is None):
+            self.dropped += 1
+        self._lock.release()
+
+        # Whatever was derived from the old frame is about to be wrong
+        if (found is not None):
+            found.cache.invalidate()
+            found.timestamp = 0.0
+            found.stamps = []
+        return found
+
+    def publish(self, slot):
+        # Make a filled slot the latest frame and wake any readers
+        #
+        # The sequence number is stamped on the slot before it becomes
+        # visible to readers, and the producer's reference is dropped only
+        # once it is the latest (so acquire() cannot hand it out again)
+        # NOTE: assumes a single producer per ring
+        self._lock.acquire()
+        slot.count = self._mailbox.seq() + 1
+        self._lock.release()
+        self.count = self._mailbox.put(slot)
+        self.release(slot)
+
+    def abandon(self, slot):
+        # Give back a slot from acquire() without publishing it
+        self.release(slot)
+
+    def _claim(self, slot):
+        # Called by the mailbox, under our lock, for each reader
+        slot._refs += 1
+
+    def release(self, slot):
+        self._lock.acquire()
+        slot._refs -= 1
+        self._lock.release()
+
+    def read(self, afterCount=0, timeout=None):
+        # Lease the latest slot if it is newer than afterCount, waiting
+        # up to timeout seconds for one (0 polls, None waits forever)
+        # Returns the slot or None
+        (slot, count) = self._mailbox.read(afterCount, timeout)
+        return slot
+
+    def wakeAll(self):
+        # Release any readers blocked in read() (e.g., when stopping)
+        self._mailbox.wakeAll()
+
+    def leased(self):
+        # Number of slots currently held by someone
+        self._lock.acquire()
+        n = sum(1 for slot in self.slots if slot._refs > 0)
+        self._lock.release()
+        return n
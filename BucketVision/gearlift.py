@@ -2,6 +2,10 @@ import cv2
 import numpy as np
 import math
 from targetdata import TargetData
+from clock import monotonic
+from contourfilter import filterContours
+from hslthreshold import HSLThreshold
+from candidatepairs import rectArrays, upperPairs, bestPair, greedyPairs
 
 class GearLift:
     """
@@ -24,6 +28,19 @@ class GearLift:
         self.__hsl_threshold_hue = [51.798561151079134, 93.99317406143345]
         self.__hsl_threshold_saturation = [71.08812949640287, 255.0]
         self.__hsl_threshold_luminance = [36.690647482014384, 255.0]
+        # Lookup table version of GRIP's cvtColor()/inRange(); building the
+        # table takes a moment, so start it now in the background
+        self.__hsl_threshold = HSLThreshold()
+        self.__hsl_threshold.warmUp(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+
+        # The camera frame our image is a copy of, when the BucketProcessor
+        # gives us one; other pipelines on the same frame with the same
+        # thresholds then share one mask (see framecache.py)
+        self.frame = None
+
+        # Monotonic time the frame was captured, when the BucketProcessor
+        # tells us (see clock.py); published as the latency of our results
+        self.captureTime = None
 
         self.hsl_threshold_output = None
 
@@ -52,23 +69,61 @@ class GearLift:
         self.lastDistance_inches = float('NaN')
         self.lastCenter_deg = float('NaN')
 
+        # Tracking mode: once we have a verified pair we only search a
+        # window around it (the target barely moves between frames, and it
+        # is largest and most expensive to find during the final approach)
+        # The window grows with every frame we miss the pair and after
+        # maxTrackingMisses misses we go back to searching the full frame
+        self.trackingEnabled = True
+        self.trackingMargin = 0.5       # of the pair's size, on each side
+        self.trackingMinMargin = 10     # pixels
+        self.maxTrackingMisses = 5
+        self.trackingBox = None         # (left, top, right, bottom) of the last pair
+        self.trackingMisses = 0
+        self.searchMode = 'Full'
+        self.searchWindow = None
+
+        # Cheaper mode the BucketProcessor may switch us to when it is
+        # behind (see setQuality()): keep searching only around the last
+        # pair for up to degradedTrackingMisses misses before falling back
+        # to the full frame
+        self.qualityLevels = 2
+        self.quality = 0
+        self.degradedTrackingMisses = 20
+
 
     def process(self, source0):
         """
         Runs the pipeline and sets all outputs to new values.
         """
 
+        # Where to look this time
+        self.searchWindow = self.__search_window(source0.shape)
+        (searchLeft, searchTop, searchRight, searchBottom) = self.searchWindow
+        if (self.trackingBox is not None):
+            self.searchMode = 'Tracking'
+        else:
+            self.searchMode = 'Full'
+
         # Step HSL_Threshold0:
         self.__hsl_threshold_input = source0
-        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        if (self.searchMode == 'Tracking'):
+            self.__hsl_threshold_input = source0[searchTop:searchBottom, searchLeft:searchRight]
+            (self.hsl_threshold_output) = self.__hsl_threshold.threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        elif (self.frame is not None):
+            # The cached mask is shared and findContours() modifies its
+            # input, so we work on a copy
+            (self.hsl_threshold_output) = self.frame.cache.hslThreshold(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance, self.__hsl_threshold).copy()
+        else:
+            (self.hsl_threshold_output) = self.__hsl_threshold.threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
 
         # Step Find_Contours0:
         self.__find_contours_input = self.hsl_threshold_output
-        (self.find_contours_output) = self.__find_contours(self.__find_contours_input, self.__find_contours_external_only)
+        (self.find_contours_output) = self.__find_contours(self.__find_contours_input, self.__find_contours_external_only, (searchLeft, searchTop))
 
         # Step Filter_Contours0:
         self.__filter_contours_contours = self.find_contours_output
-        (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
+        (self.filter_contours_output) = filterContours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
 
         # Optionally draw the contours for debug
         # For now, just uncomment as needed
@@ -201,99 +256,52 @@ class GearLift:
         # object. Again there are two possibilities: one truncated object, or
         # two smaller objects that are aligned vertically
         # We want to merge proximal pairs first, then look for truncations
-        numOthers = len(other)
-        
-        # NOTE: We may make this more efficient, later
-        # by recording only the unmatched index in a list
-        # but the logic is somewhat more complicated to
-        # understand, and we are going for easy to understand, first
-        matchFound = [False] * numOthers
-            
-        if (numOthers >= 2):
-            # NOTE: Only assuming a single split of an object
-            # We don't need to merge objects that are split more than twice
-            # But the traversal to accumulate all objects along a line is
-            # fairly stright forward
-            i = -1
-            for oi in other:
-                i = i + 1
-                # If already matched, skip it
-                if (matchFound[i] == True):
-                    continue
-                    
-                xi = oi[0][0]
-                yi = oi[0][1]
-                wi = oi[1][0]
-                hi = oi[1][1]
-                hi2 = hi/2
-                ai = abs(oi[2])
-                topi = (yi - hi2)        # 0 is top of image
-                boti = (yi + hi2)
-               
-                j = -1
-                for oj in other[i:]:
-                    j = j + 1
-                    # If already matched, skip it
-                    if (matchFound[j + i] == True):
-                        continue
-                
-                    # Does this pair look like they came from the same object?
-                    xj = oj[0][0]
-                    yj = oj[0][1]
-                    wj = oj[1][0]
-                    hj = oj[1][1]
-                    hj2 = hj/2
-                    aj = abs(oj[2])
-                    topj = (yj - hj2)
-                    botj = (yj + hj2)
-                    
-                    # Assuming that only objects with tilts less than
-                    # 5 deg are present we will apply the same criteria 
-                    # for proximal items... 
-                    # this means that the vertical alignment
-                    # must be within 0.5" over 5" or a factor of 0.1 based on
-                    # the sum of the heights... we will allow a little extra (1" --> 0.2)
-                    # as a margin against pixel granularity for object further away
-                    deltaX = abs(xj - xi)
-                    distanceRatioX = deltaX / (hi + hj)
-                    if (distanceRatioX < 0.2):
-                                            
-                        # Build a composite retangle from the two pieces
-                        # as a faux observation then apply the final ratio
-                        # criteria to determine if it is a detection
-                        x = (xi + xj)/2
-                        y = (yi + yj)/2
-                        w = (wi + wj)/2
-                        a = (ai + aj)/2
-                        
-                        # Height is composed of the upper and lower extents
-                        # of the two pieces
-                        # Remembering that (x,y) = (0,0) is top-left corner
-                        # lower values of y are above higher values of y
-                        if (topi < topj):
-                            h = (botj - topi)
-                        else:
-                            h = (boti - topj)
-                        
-                        ratio = w / h
-                        
-                        if (0.25 <= ratio <= 0.45):        # 2"/5" --> 0.4 + tolerance
-                        
-                            matchFound.pop(i)
-                            matchFound.insert(i,True)
-                            matchFound.pop(j + i)
-                            matchFound.insert(j + i,True)
-                            
-                            rect = ((x,y),(w,h),a)
-                            detections.append(rect)
-                            detectionType.append('Merged')
+        #
+        # Every pair of pieces is tested at once; pieces that line up
+        # vertically and whose combined extent has the tape's aspect ratio
+        # are merged, best fitting pairs first, each piece at most once
+        if (len(other) >= 2):
+            (xo, yo, wo, ho, ao) = rectArrays(other)
+            ao = np.abs(ao)
+            topo = yo - ho/2        # 0 is top of image
+            boto = yo + ho/2
+
+            # Assuming that only objects with tilts less than
+            # 5 deg are present we will apply the same criteria 
+            # for proximal items... 
+            # this means that the vertical alignment
+            # must be within 0.5" over 5" or a factor of 0.1 based on
+            # the sum of the heights... we will allow a little extra (1" --> 0.2)
+            # as a margin against pixel granularity for object further away
+            distanceRatioX = np.abs(xo[:, None] - xo[None, :]) / (ho[:, None] + ho[None, :])
+
+            # Height is composed of the upper and lower extents
+            # of the two pieces
+            # Remembering that (x,y) = (0,0) is top-left corner
+            # lower values of y are above higher values of y
+            hm = np.where(topo[:, None] < topo[None, :],
+                          boto[None, :] - topo[:, None],
+                          boto[:, None] - topo[None, :])
+            wm = (wo[:, None] + wo[None, :])/2
+            ratio = wm / hm
+
+            valid = (upperPairs(len(other)) & (distanceRatioX < 0.2) &
+                     (0.25 <= ratio) & (ratio <= 0.45))       # 2"/5" --> 0.4 + tolerance
+            score = np.abs(ratio - 0.4)/0.05 + distanceRatioX/0.2
+
+            for (i, j) in greedyPairs(valid, score):
+                # Build a composite retangle from the two pieces
+                # as a faux observation
+                rect = (((xo[i] + xo[j])/2, (yo[i] + yo[j])/2), (wm[i, j], hm[i, j]), (ao[i] + ao[j])/2)
+                detections.append(rect)
+                detectionType.append('Merged')
                         
-                            # Identify angled bounding box and display
-                            box = cv2.boxPoints(rect)
-                            box = np.int0(box)
-                            
-                            # Draw this candidate in magenta
-                            cv2.drawContours(source0,[box],0,(255,0,255),2)
+                # Identify angled bounding box and display
+                box = cv2.boxPoints(rect)
+                box = np.int0(box)
+                
+                # Draw this candidate in magenta
+                cv2.drawContours(source0,[box],0,(255,0,255),2)
 
         # If there are any detections we need to sift through them for a pair
         # that is on the same horizon but below the highest expected point on the image
@@ -309,49 +317,40 @@ class GearLift:
         observations = []
         observationsVerified = False
         if (numDetections > 2):
-            i = 0
-            for di in detections:
-                i = i + 1
-                xi = di[0][0]
-                yi = di[0][1]
-                wi = di[1][0]
-                hi = di[1][1]
-                
-                for dj in detections[i:]:
-                    xj = dj[0][0]
-                    yj = dj[0][1]
-                    wj = dj[1][0]
-                    hj = dj[1][1]
-
-                    # Using abs() since we don't care which detection is right or left
-                    deltaX = abs(xi - xj)
-                    distanceRatioX = deltaX / ((wi + wj)/2)  # Distance ratio using retro tape width as common factor
-                    expectedRatioX = 4.125             # (10.25 - 2.0) / 2.0 inches
-                    ratioToleranceX = 0.5            # Corresponds to 1" over the 2" baseline
-                    lowRatioX = expectedRatioX - ratioToleranceX
-                    highRatioX = expectedRatioX + ratioToleranceX
-                    
-                    
-                    # Expect the centers to be close to each other
-                    # Allowing for up to a 5 degree camera tilt there
-                    # could be as much as a 0.75" difference in center
-                    #         tan(5 deg) * 8.25" = 0.72"
-                    # Allowing for some tolerance anything less than 1" out of 5" (--> 0.2)
-                    # is acceptable
-                    deltaY = abs(yi - yj)
-                    distanceRatioY = deltaY / ((hi + hj)/2)
-                    expectedRatioY = 0.2
-                    
-                    if ((lowRatioX <= distanceRatioX <= highRatioX) and
-                        (distanceRatioY <= expectedRatioY)):
-                        # This is the droid I am looking for
-                        observations.append(di)
-                        observations.append(dj)
-                        observationsVerified = True
-                        break
-                
-                if (observations != []):
-                    break
+            (xd, yd, wd, hd, ad) = rectArrays(detections)
+
+            # Using abs() since we don't care which detection is right or left
+            deltaX = np.abs(xd[:, None] - xd[None, :])
+            distanceRatioX = deltaX / ((wd[:, None] + wd[None, :])/2)  # Distance ratio using retro tape width as common factor
+            expectedRatioX = 4.125             # (10.25 - 2.0) / 2.0 inches
+            ratioToleranceX = 0.5            # Corresponds to 1" over the 2" baseline
+            lowRatioX = expectedRatioX - ratioToleranceX
+            highRatioX = expectedRatioX + ratioToleranceX
+
+            # Expect the centers to be close to each other
+            # Allowing for up to a 5 degree camera tilt there
+            # could be as much as a 0.75" difference in center
+            #         tan(5 deg) * 8.25" = 0.72"
+            # Allowing for some tolerance anything less than 1" out of 5" (--> 0.2)
+            # is acceptable
+            deltaY = np.abs(yd[:, None] - yd[None, :])
+            distanceRatioY = deltaY / ((hd[:, None] + hd[None, :])/2)
+            expectedRatioY = 0.2
+
+            valid = (upperPairs(numDetections) &
+                     (lowRatioX <= distanceRatioX) & (distanceRatioX <= highRatioX) &
+                     (distanceRatioY <= expectedRatioY))
+
+            # Of the pairs that fit, take the one closest to the ideal spacing
+            # and level, relative to the tolerance on each
+            score = np.abs(distanceRatioX - expectedRatioX)/ratioToleranceX + distanceRatioY/expectedRatioY
+            pair = bestPair(valid, score)
+            if (pair is not None):
+                # This is the droid I am looking for
+                observations.append(detections[pair[0]])
+                observations.append(detections[pair[1]])
+                observationsVerified = True
+                deltaX = deltaX[pair]   # for the distance estimate below
         else:
             observations = detections
                     
@@ -360,8 +359,20 @@ class GearLift:
         
         # Draw thin line down center of screen
         cv2.line(source0,(320/2,0),(320/2,240),(255,0,0),1)
+
+        # and where we looked, when it was not everywhere
+        if (self.searchMode == 'Tracking'):
+            cv2.rectangle(source0, (searchLeft, searchTop), (searchRight - 1, searchBottom - 1), (255,255,0), 1)
         
         nan = float('NaN')
+
+        # How old the frame these results come from is, so the robot can
+        # correct for where it was pointing when the frame was captured
+        if (self.captureTime is not None):
+            self.networkTable.putNumber("GearLatency_ms",1000.0 * (monotonic() - self.captureTime))
+        else:
+            self.networkTable.putNumber("GearLatency_ms",nan)
+        pairBox = None
         
         if (numObservations == 2):
             # Having exactly two (2) observations is the easy case
@@ -470,6 +481,9 @@ class GearLift:
                 self.lastCenterY = centerY
                 self.lastDistance_inches = distance_inches
                 self.lastCenter_deg = center_deg
+
+                pairBox = (min(x1 - w1/2, x2 - w2/2), min(y1 - h1/2, y2 - h2/2),
+                           max(x1 + w1/2, x2 + w2/2), max(y1 + h1/2, y2 + h2/2))
         
             else:
                 # We simply don't have any good information to go on
@@ -570,9 +584,63 @@ class GearLift:
             self.lastCenterY = nan
             self.lastDistance_inches = nan
             self.lastCenter_deg = nan
+
+        # Report which search produced this result, then decide where to
+        # look next time
+        self.networkTable.putString("GearSearchMode",self.searchMode)
+        self.__update_tracking(pairBox)
             
         return (self.find_contours_output, self.filter_contours_output)
 
+    def setQuality(self, level):
+        # 0 is full quality, 1 holds on to the tracking window longer
+        self.quality = level
+
+    def __search_window(self, shape):
+        """Computes the part of the image to search.
+        Args:
+            shape: The shape of the image.
+        Returns:
+            (left, top, right, bottom) in pixels; the whole image unless we
+            are tracking a pair.
+        """
+        height = shape[0]
+        width = shape[1]
+        if ((self.trackingEnabled == False) or (self.trackingBox is None)):
+            return (0, 0, width, height)
+
+        # Expand around the last pair, more for every frame we missed it
+        # (up to maxTrackingMisses frames)
+        (boxLeft, boxTop, boxRight, boxBottom) = self.trackingBox
+        grow = self.trackingMargin * (1 + min(self.trackingMisses, self.maxTrackingMisses))
+        marginX = max(self.trackingMinMargin, grow * (boxRight - boxLeft))
+        marginY = max(self.trackingMinMargin, grow * (boxBottom - boxTop))
+        left = int(max(0, boxLeft - marginX))
+        top = int(max(0, boxTop - marginY))
+        right = int(min(width, boxRight + marginX + 1))
+        bottom = int(min(height, boxBottom + marginY + 1))
+        if ((right <= left) or (bottom <= top)):
+            return (0, 0, width, height)
+        return (left, top, right, bottom)
+
+    def __update_tracking(self, pairBox):
+        """Updates the tracking window after a frame.
+        Args:
+            pairBox: (left, top, right, bottom) of the verified pair found
+                in this frame, or None.
+        """
+        if (self.trackingEnabled == False):
+            self.trackingBox = None
+        elif (pairBox is not None):
+            self.trackingBox = pairBox
+            self.trackingMisses = 0
+        elif (self.trackingBox is not None):
+            self.trackingMisses += 1
+            maxMisses = self.maxTrackingMisses if (self.quality == 0) else self.degradedTrackingMisses
+            if (self.trackingMisses > maxMisses):
+                self.trackingBox = None
+                self.trackingMisses = 0
+
     @staticmethod
     def __resize_image(input, width, height, interpolation):
         """Scales and image to an exact size.
@@ -587,25 +655,13 @@ class GearLift:
         return cv2.resize(input, ((int)(width), (int)(height)), 0, 0, interpolation)
 
     @staticmethod
-    def __hsl_threshold(input, hue, sat, lum):
-        """Segment an image based on hue, saturation, and luminance ranges.
-        Args:
-            input: A BGR numpy.ndarray.
-            hue: A list of two numbers the are the min and max hue.
-            sat: A list of two numbers the are the min and max saturation.
-            lum: A list of two numbers the are the min and max luminance.
-        Returns:
-            A black and white numpy.ndarray.
-        """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
-        return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
-
-    @staticmethod
-    def __find_contours(input, external_only):
+    def __find_contours(input, external_only, offset=(0, 0)):
         """Sets the values of pixels in a binary image to their distance to the nearest black pixel.
         Args:
             input: A numpy.ndarray.
             external_only: A boolean. If true only external contours are found.
+            offset: Shift added to every point (e.g., where input was cut
+                    from a larger image).
         Return:
             A list of numpy.ndarray where each one represents a contour.
         """
@@ -614,53 +670,8 @@ class GearLift:
         else:
             mode = cv2.RETR_LIST
         method = cv2.CHAIN_APPROX_SIMPLE
-        im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
+        im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method, offset=offset)
         return contours
 
-    @staticmethod
-    def __filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
-                        min_height, max_height, solidity, max_vertex_count, min_vertex_count,
-                        min_ratio, max_ratio):
-        """Filters out contours that do not meet certain criteria.
-        Args:
-            input_contours: Contours as a list of numpy.ndarray.
-            min_area: The minimum area of a contour that will be kept.
-            min_perimeter: The minimum perimeter of a contour that will be kept.
-            min_width: Minimum width of a contour.
-            max_width: MaxWidth maximum width.
-            min_height: Minimum height.
-            max_height: Maximimum height.
-            solidity: The minimum and maximum solidity of a contour.
-            min_vertex_count: Minimum vertex Count of the contours.
-            max_vertex_count: Maximum vertex Count.
-            min_ratio: Minimum ratio of width to height.
-            max_ratio: Maximum ratio of width to height.
-        Returns:
-            Contours as a list of numpy.ndarray.
-        """
-        output = []
-        for contour in input_contours:
-            x,y,w,h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
-
 
 
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+hslbench
+
+Compares GRIP's cvtColor()/inRange() HSL threshold with the lookup table
+version (hslthreshold.py) using the thresholds of our pipelines
+
+Reports the table build time, the time per frame of each method, how
+many pixels they disagree on (which should be none) and which method
+the pipelines' own calibration picks. Run it on the robot's processor;
+the answer on a desktop can be quite different.
+
+    python hslbench.py [--width 320] [--height 240] [--iterations 200] [images ...]
+"""
+
+import argparse
+import glob
+import time
+
+import cv2
+import numpy as np
+
+from hslthreshold import HSLThreshold
+from hslthreshold import buildTable
+from hslthreshold import hslThreshold
+from resulttable import ResultTable
+
+from gearlift import GearLift
+from boilerstack import BoilerStack
+from redboiler import RedBoiler
+
+def thresholds(pipeline):
+    # The GRIP generated pipelines keep their settings private
+    prefix = '_' + pipeline.__class__.__name__ + '__hsl_threshold_'
+    return (getattr(pipeline, prefix + 'hue'),
+            getattr(pipeline, prefix + 'saturation'),
+            getattr(pipeline, prefix + 'luminance'))
+
+def timePerFrame(function, images, iterations):
+    start = time.time()
+    for i in range(iterations):
+        function(images[i % len(images)])
+    return (time.time() - start) / iterations
+
+parser = argparse.ArgumentParser(description='Benchmark the HSL threshold step')
+parser.add_argument('images', nargs='*', help='images to threshold (default: *Boiler*.jpg)')
+parser.add_argument('--width', type=int, default=320)
+parser.add_argument('--height', type=int, default=240)
+parser.add_argument('--iterations', type=int, default=200)
+args = parser.parse_args()
+
+paths = args.images
+if (len(paths) == 0):
+    paths = sorted(glob.glob('*Boiler*.jpg'))
+images = [cv2.imread(path) for path in paths]
+images = [cv2.resize(image, (args.width, args.height)) for image in images if image is not None]
+print("Using " + str(len(images)) + " images at " + str(args.width) + "x" + str(args.height))
+
+for pipeline in (GearLift(ResultTable()), BoilerStack(ResultTable()), RedBoiler()):
+    (hue, sat, lum) = thresholds(pipeline)
+
+    start = time.time()
+    buildTable(hue, sat, lum)
+    buildTime = time.time() - start
+
+    lut = HSLThreshold()
+    lut.build(hue, sat, lum)
+
+    mismatched = 0
+    for image in images:
+        mismatched += np.count_nonzero(hslThreshold(image, hue, sat, lum) != lut.lookup(image))
+
+    gripTime = timePerFrame(lambda image: hslThreshold(image, hue, sat, lum), images, args.iterations)
+    lutTime = timePerFrame(lut.lookup, images, args.iterations)
+
+    print(pipeline.__class__.__name__ +
+          ": table build {:.0f} ms".format(1000 * buildTime) +
+          ", cvtColor/inRange {:.3f} ms".format(1000 * gripTime) +
+          ", LUT {:.3f} ms".format(1000 * lutTime) +
+          ", speedup {:.2f}x".format(gripTime / lutTime) +
+          ", mismatched pixels " + str(mismatched))
+
+    # What the pipeline's own calibration settles on
+    for i in range(2 * lut.calibrationFrames):
+        lut.threshold(images[i % len(images)], hue, sat, lum)
+    print("    pipelines will use " + ("the LUT" if lut.useLut else "cvtColor/inRange"))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+hslthreshold
+
+Lookup-table version of the GRIP "HSL Threshold" step
+
+GRIP converts every frame to HLS with cvtColor() and then runs inRange()
+on it. Whether a pixel passes only depends on its BGR value, though, so
+we can instead decide that once for every one of the 2^24 colors and keep
+the answers in a table (a 3D LUT, 16 MB of uint8). Thresholding a frame
+is then a single gather: the BGR bytes of each pixel, padded to 32 bits
+and read as a little-endian number, are the index into the table.
+
+The table is built with the same cvtColor()/inRange() calls, so the
+result is identical to the GRIP code, and it is only rebuilt when the
+thresholds change (e.g., while tuning from the dashboard). Building one
+takes about a second, so it is done on a background thread (see warmUp())
+and frames are thresholded with cvtColor() until it is ready. Pipelines
+that use the same thresholds (GearLift and BoilerStack do) share one table.
+
+Which one is faster depends on the processor: OpenCV's vectorized
+cvtColor() is hard to beat on a desktop, while the gather may win on
+a small ARM board. So HSLThreshold times both on its first frames and
+keeps whichever was faster; if that is cvtColor() the table is let go
+and never built again. See hslbench.py to compare the two on a given
+machine.
+"""
+
+from threading import Lock, Thread
+import weakref
+
+import cv2
+import numpy as np
+
+import clock
+
+# Tables in use, by thresholds; a table goes away with its last user
+_tables = weakref.WeakValueDictionary()
+_tablesLock = Lock()    # held while looking up or building a table
+
+# Pixels are read as little-endian uint32 whatever the machine, so that
+# B, G, R, A reads as B | G << 8 | R << 16 | A << 24 (on little-endian
+# machines, i.e. x86 and the ARM boards, this is the native type and free)
+_INDEX_DTYPE = np.dtype('<u4')
+
+# Clears the alpha byte of a BGRA pixel read as an index
+_BGR_MASK = np.array(0x00FFFFFF, dtype=_INDEX_DTYPE)
+
+def hslThreshold(input, hue, sat, lum, dst=None):
+    """Segment an image based on hue, saturation, and luminance ranges.
+    Args:
+        input: A BGR numpy.ndarray.
+        hue: A list of two numbers the are the min and max hue.
+        sat: A list of two numbers the are the min and max saturation.
+        lum: A list of two numbers the are the min and max luminance.
+        dst: Optional numpy.ndarray to write the result into.
+    Returns:
+        A black and white numpy.ndarray.
+    """
+    out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
+    return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]), dst)
+
+def buildTable(hue, sat, lum, colorsPerPass=1 << 20):
+    """Computes hslThreshold() for every BGR color.
+    Args:
+        hue: A list of two numbers the are the min and max hue.
+        sat: A list of two numbers the are the min and max saturation.
+        lum: A list of two numbers the are the min and max luminance.
+        colorsPerPass: How many colors to convert at a time, which
+            bounds the working memory.
+    Returns:
+        A numpy.ndarray of 2^24 uint8, indexed by B | G << 8 | R << 16
+        (i.e., the pixel bytes B, G, R, 0 read as a little-endian uint32,
+        which is how HSLThreshold.lookup() reads them).
+    """
+    table = np.empty(1 << 24, dtype=np.uint8)
+
+    # Colors first to first + colorsPerPass, in table order
+    colors = np.empty((colorsPerPass, 1, 3), dtype=np.uint8)
+    code = np.arange(colorsPerPass, dtype=np.uint32)
+    for first in range(0, 1 << 24, colorsPerPass):
+        count = min(colorsPerPass, (1 << 24) - first)
+        value = code[:count] + first
+        colors[:count, 0, 0] = value & 0xFF
+        colors[:count, 0, 1] = (value >> 8) & 0xFF
+        colors[:count, 0, 2] = value >> 16
+        table[first:first + count] = hslThreshold(colors[:count], hue, sat, lum).ravel()
+    return table
+
+def getTable(hue, sat, lum):
+    """Gets the table for the given thresholds, building it if no one else
+    is using the same ones. Blocks while another thread is building one.
+    Args:
+        hue: A list of two numbers the are the min and max hue.
+        sat: A list of two numbers the are the min and max saturation.
+        lum: A list of two numbers the are the min and max luminance.
+    Returns:
+        The table, as returned by buildTable().
+    """
+    thresholds = (tuple(hue), tuple(sat), tuple(lum))
+    with _tablesLock:
+        lut = _tables.get(thresholds)
+        if (lut is None):
+            lut = buildTable(hue, sat, lum)
+            _tables[thresholds] = lut
+    return lut
+
+class HSLThreshold:
+    def __init__(self, calibrationFrames=10):
+        self.lut = None
+        self._thresholds = None
+        # Latest (thresholds, table) to come out of build() or warmUp()
+        self._built = (None, None)
+
+        # None until the first calibrationFrames frames of each method
+        # have been timed
+        self.useLut = None
+        self.calibrationFrames = calibrationFrames
+        self.lutTime = 0.0
+        self.directTime = 0.0
+        self._timedFrames = 0
+
+        # Per frame working memory, sized for the largest frame so far;
+        # smaller frames (e.g., GearLift's search windows) use the front
+        # of it, so it is not reallocated when the size changes
+        self._packed = None     # BGRA pixels, flat
+        self._output = None
+
+    def threshold(self, input, hue, sat, lum, dst=None):
+        """Segment an image based on hue, saturation, and luminance ranges.
+        Args:
+            input: A BGR numpy.ndarray.
+            hue: A list of two numbers the are the min and max hue.
+            sat: A list of two numbers the are the min and max saturation.
+            lum: A list of two numbers the are the min and max luminance.
+            dst: Optional numpy.ndarray to write the result into.
+        Returns:
+            A black and white numpy.ndarray. Without dst it may be reused
+            by the next call, so copy it to keep it.
+        """
+        thresholds = (tuple(hue), tuple(sat), tuple(lum))
+        if (thresholds != self._thresholds):
+            self.lut = None
+            if (self.useLut == False):
+                self._thresholds = thresholds
+            else:
+                self.warmUp(hue, sat, lum)
+
+        if (self.useLut == False):
+            return hslThreshold(input, hue, sat, lum, dst)
+
+        if (self.lut is None):
+            (built, lut) = self._built
+            if (built != thresholds):
+                # Table is still being built
+                return hslThreshold(input, hue, sat, lum, dst)
+            self.lut = lut
+
+        if (self.useLut == True):
+            return self.lookup(input, dst)
+
+        # Still calibrating; take turns and time each method
+        start = clock.monotonic()
+        if ((self._timedFrames % 2) == 0):
+            output = self.lookup(input, dst)
+            self.lutTime += clock.monotonic() - start
+        else:
+            output = hslThreshold(input, hue, sat, lum, dst)
+            self.directTime += clock.monotonic() - start
+        self._timedFrames += 1
+        if (self._timedFrames >= 2 * self.calibrationFrames):
+            self.useLut = (self.lutTime < self.directTime)
+            if (self.useLut == False):
+                # Let the table go (it is freed once no one else uses it)
+                self.lut = None
+                self._built = (None, None)
+        return output
+
+    def lookup(self, input, dst=None):
+        """Thresholds an image with the current table.
+        Args:
+            input: A BGR numpy.ndarray.
+            dst: Optional numpy.ndarray to write the result into.
+        Returns:
+            A black and white numpy.ndarray; without dst it is reused by
+            the next call.
+        """
+        (height, width) = input.shape[:2]
+        pixels = height * width
+        if ((self._output is None) or (self._output.size < pixels)):
+            self._packed = np.empty(4 * pixels, dtype=np.uint8)
+            self._output = np.empty(pixels, dtype=np.uint8)
+        packed = self._packed[:4 * pixels].reshape(height, width, 4)
+
+        # Pad each pixel to 32 bits and drop the alpha byte OpenCV fills
+        # in, so that each pixel reads as its BGR index
+        cv2.cvtColor(input, cv2.COLOR_BGR2BGRA, dst=packed)
+        index = packed.view(_INDEX_DTYPE).reshape(height, width)
+        np.bitwise_and(index, _BGR_MASK, out=index)
+        if (dst is None):
+            dst = self._output[:pixels].reshape(height, width)
+        # Every index is in range after the mask; 'clip' skips the bounds
+        # check, which would also make numpy write through a temporary
+        np.take(self.lut, index, out=dst, mode='clip')
+        return dst
+
+    def build(self, hue, sat, lum):
+        """Gets the table for new thresholds, waiting for it to be built.
+        Args:
+            hue: A list of two numbers the are the min and max hue.
+            sat: A list of two numbers the are the min and max saturation.
+            lum: A list of two numbers the are the min and max luminance.
+        """
+        thresholds = (tuple(hue), tuple(sat), tuple(lum))
+        self._thresholds = thresholds
+        self.lut = getTable(hue, sat, lum)
+        self._built = (thresholds, self.lut)
+
+    def warmUp(self, hue, sat, lum):
+        """Gets the table for new thresholds on a background thread;
+        threshold() uses cvtColor() until it is ready.
+        Args:
+            hue: A list of two numbers the are the min and max hue.
+            sat: A list of two numbers the are the min and max saturation.
+            lum: A list of two numbers the are the min and max luminance.
+        """
+        thresholds = (tuple(hue), tuple(sat), tuple(lum))
+        self._thresholds = thresholds
+        self.lut = None
+        t = Thread(target=self.__warmUp, args=(thresholds, hue, sat, lum))
+        t.daemon = True
+        t.start()
+
+    def __warmUp(self, thresholds, hue, sat, lum):
+        lut = getTable(hue, sat, lum)
+        # Drop it if the thresholds changed again (or calibration picked
+        # cvtColor()) while we were building
+        if ((thresholds == self._thresholds) and (self.useLut != False)):
+            self._built = (thresholds, lut)
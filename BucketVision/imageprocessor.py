@@ -1,29 +1,29 @@
 
-from threading import Lock
 from threading import Thread
-from threading import Condition
 
-from framerate import FrameRate
-from frameduration import FrameDuration
+import numpy as np
+
+import clock
+import threadcpu
+
+from framering import FrameRing
+from metrics import StageMetrics
 
 class ImageProcessor:
-    def __init__(self,stream,ip):
+    def __init__(self,stream,ip,numSlots=4):
         print("Creating ImageProcessor for " + stream.name)
-        self._lock = Lock()
-        self._condition = Condition()
-        self.fps = FrameRate()
-        self.duration = FrameDuration()
+        self.metrics = StageMetrics("ImageProcessor", stream.name)
         self.stream = stream
         self.ip = ip
 
-        (self._frame, self.count, self.isNew) = self.stream.read()
-
-        if (self.isNew == True):
-            self.count = 1
-            self.frame = self._frame
-        else:
-            self.frame = None
-            self.count = 0
+        self._frame = None
+        self.count = 0
+        self.isNew = False
+        self.latency = 0.0      # capture to processed, of the last frame
+        
+        # Outgoing frames are copies of the camera frames that the
+        # pipeline is free to draw on
+        self.ring = FrameRing(numSlots, self.stream.ring.shape, self.stream.ring.dtype)
         
         # initialize the variable used to indicate if the thread should
         # be stopped
@@ -41,9 +41,11 @@ class ImageProcessor:
 
     def update(self):
         print("ImageProcessor for " + self.stream.name + " RUNNING")
+        threadcpu.register("ImageProcessor " + self.stream.name)
         # keep looping infinitely until the thread is stopped
         self.stopped = False
-        self.fps.start()
+
+        lastCount = 0
         
         while True:
             # if the thread indicator variable is set, stop the thread
@@ -54,50 +56,75 @@ class ImageProcessor:
 
             # otherwise, read the next frame from the stream
             # grab the frame from the threaded video stream
-            (self._frame, count, isNew) = self.stream.read()
-            self.duration.start()
-            self.fps.update()
+            previousCount = lastCount
+            (self._frame, lastCount, isNew) = self.stream.read(lastCount, 0.1)
+            if (isNew == False):
+                continue    # nothing new yet; go check for a stop request
+            enter = clock.monotonic()
+            self.metrics.start(enter)
+            if (previousCount != 0):
+                self.metrics.skip(lastCount - previousCount - 1)
 
             if (isNew == True):
-                # TODO: Insert processing code then forward display changes
-                self.ip.process(self._frame)
+                # Pipelines draw on the frame they are given, so they get
+                # a private copy in one of our slots; the camera frame
+                # may still be in use by another consumer
+                out = self.ring.acquire()
+                if (out is None):
+                    self._frame.release()
+                    self.metrics.drop()
+                    continue
+                np.copyto(out.image, self._frame.image)
+                out.copyStamps(self._frame)
+
+                # Pipelines that look for a captureTime attribute get the
+                # time the frame was captured, so they can publish the
+                # latency of their results along with them
+                if (hasattr(self.ip, 'captureTime') == True):
+                    self.ip.captureTime = out.timestamp
                 
-                # Now that image processing is complete, place results
-                # into an outgoing buffer to be grabbed at the convenience
-                # of the reader
-                self._condition.acquire()
-                self._lock.acquire()
+                # Pipelines that look for a frame attribute also get the
+                # camera frame, to share its derived images (see framecache.py)
+                if (hasattr(self.ip, 'frame') == True):
+                    self.ip.frame = self._frame
+                    self.ip.process(out.image)
+                    self.ip.frame = None
+                else:
+                    self.ip.process(out.image)
+                self._frame.release()
+                
+                # Now that image processing is complete, publish the results
+                # to be grabbed at the convenience of the reader
+                now = clock.monotonic()
+                out.stamp("ImageProcessor", enter, now)
+                self.latency = out.age(now)
                 self.count = self.count + 1
                 self.isNew = isNew
-                self.frame = self._frame
-                self._lock.release()
-                self._condition.notifyAll()
-                self._condition.release()
-
-            self.duration.update()
+                self.ring.publish(out)
+                self.metrics.end(now, out.timestamp)
                 
         print("ImageProcessor for " + self.stream.name + " STOPPING")
 
-    def read(self):
-        # return the frame most recently processed if the frame
-        # is not being updated at this exact moment
-        self._condition.acquire()
-        self._condition.wait()
-        self._condition.release()
-        if (self._lock.acquire() == True):
-            self.outFrame = self.frame
-            self.outCount = self.count
-            self._lock.release()
-            return (self.outFrame, self.outCount, True)
-        else:
-            return (self.outFrame, self.outCount, False)
+    def read(self, afterCount=0, timeout=None):
+        # return a lease on the newest frame processed after afterCount,
+        # waiting up to timeout seconds for one (0 polls without blocking,
+        # None waits as long as it takes)
+        #
+        # Returns (frame, count, isNew); isNew is False (and frame is None)
+        # when nothing newer than afterCount arrived in time
+        #
+        # The caller MUST call frame.release() when done with frame.image
+        # and must copy it before drawing on it (other consumers may be
+        # reading the same frame)
+        frame = self.ring.read(afterCount, timeout)
+        if (frame is None):
+            return (None, afterCount, False)
+        return (frame, frame.count, True)
           
     def stop(self):
         # indicate that the thread should be stopped
         self._stop = True
-        self._condition.acquire()
-        self._condition.notifyAll()
-        self._condition.release()
+        self.ring.wakeAll()
 
     def isStopped(self):
         return self.stopped
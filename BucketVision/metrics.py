@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+metrics
+
+Cheap, always-on instrumentation: counters, gauges and latency histograms
+
+A frame rate or mean duration over the last dozen frames hides jitter and
+the occasional 200 ms stall, which are what actually hurt on the field.
+Here every stage records into metrics that keep the whole distribution:
+
+    Counter     ever increasing count (frames, drops, skipped frames, ...)
+    Gauge       last value set (frame rate, how busy a stage is, ...)
+    Histogram   durations in seconds, counted into fixed logarithmically
+                spaced buckets (about 19% wide, from 100 us to 10 s), from
+                which p50/p95/p99 are estimated; count, sum and max are exact
+
+Recording is a handful of Python operations and takes no lock. Each metric
+is meant to have one writer (the stage thread that owns it); a second
+writer can, very rarely, lose an update to a race but never corrupts
+anything. Readers (the overlay, the HTTP server) just look.
+
+Every metric is registered by name and labels in the module's registry, so
+anything that reports on them can find them all:
+
+    for metric in metrics.registry.all():
+        ...
+
+StageMetrics bundles what each stage (BucketCapture, BucketProcessor,
+BucketStreamer, ...) records about the frames going through it.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+from clock import monotonic
+
+def _bounds(lowest=1e-4, highest=10.0, perOctave=4):
+    bounds = []
+    bound = lowest
+    i = 0
+    while (bound < highest):
+        bound = lowest * 2.0 ** (float(i) / perOctave)
+        bounds.append(bound)
+        i += 1
+    return bounds
+
+DEFAULT_BOUNDS = _bounds()
+
+class Counter:
+    def __init__(self, name, labels, help=''):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    def __init__(self, name, labels, help=''):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, name, labels, help='', bounds=DEFAULT_BOUNDS):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.bounds = bounds                        # upper bound of each bucket
+        self.counts = [0] * (len(bounds) + 1)       # the last is everything above
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if (value > self.max):
+            self.max = value
+
+    def mean(self):
+        if (self.count == 0):
+            return 0.0
+        return self.sum / self.count
+
+    def percentile(self, p, counts=None):
+        """Estimates a percentile.
+        Args:
+            p: The percentile, 0 to 100.
+            counts: Optional copy of self.counts to work from.
+        Returns:
+            The estimate (interpolated within its bucket and never more
+            than the max), or 0.0 if nothing was recorded.
+        """
+        if (counts is None):
+            counts = list(self.counts)
+        total = sum(counts)
+        if (total == 0):
+            return 0.0
+        target = total * p / 100.0
+        cumulative = 0
+        for (i, n) in enumerate(counts):
+            if ((n > 0) and (cumulative + n >= target)):
+                if (i == len(self.bounds)):
+                    return self.max
+                lower = self.bounds[i - 1] if (i > 0) else 0.0
+                upper = self.bounds[i]
+                estimate = lower + (upper - lower) * (target - cumulative) / n
+                return min(estimate, self.max)
+            cumulative += n
+        return self.max
+
+    def summary(self):
+        # Return a dict of count, mean, p50, p95, p99 and max
+        counts = list(self.counts)
+        return {'count' : self.count,
+                'mean' : self.mean(),
+                'p50' : self.percentile(50, counts),
+                'p95' : self.percentile(95, counts),
+                'p99' : self.percentile(99, counts),
+                'max' : self.max}
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Registry:
+    def __init__(self):
+        self._lock = Lock()     # only taken to add and remove metrics
+        self._metrics = {}
+
+    def _get(self, kind, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            metric = self._metrics.get(key)
+            if (metric is None):
+                metric = kind(name, dict(labels), help)
+                self._metrics[key] = metric
+            elif (isinstance(metric, kind) == False):
+                raise ValueError(name + " is already registered as another kind of metric")
+            return metric
+        finally:
+            self._lock.release()
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def remove(self, metric):
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        self._lock.acquire()
+        if (self._metrics.get(key) is metric):
+            del self._metrics[key]
+        self._lock.release()
+
+    def all(self):
+        # Return every metric, sorted by name and then labels
+        self._lock.acquire()
+        items = sorted(self._metrics.items())
+        self._lock.release()
+        return [metric for (key, metric) in items]
+
+registry = Registry()
+
+
+class StageMetrics:
+    # What a stage records about the frames going through it
+    #
+    # Call start() when a frame arrives and end() when the stage is done
+    # with it; drop() when a frame had to be thrown away for lack of a
+    # free slot and skip(n) when n frames published upstream were never
+    # seen at all (they were replaced before we got to them)
+    def __init__(self, stage, name, smoothing=0.1):
+        self.stage = stage
+        self.name = name
+        self.smoothing = smoothing
+
+        self.frames = registry.counter('frames', "Frames handled", stage=stage, instance=name)
+        self.dropped = registry.counter('dropped', "Frames dropped for lack of a free slot", stage=stage, instance=name)
+        self.skipped = registry.counter('skipped', "Upstream frames never seen", stage=stage, instance=name)
+        self.duration = registry.histogram('duration_seconds', "Time spent on each frame", stage=stage, instance=name)
+        self.interval = registry.histogram('interval_seconds', "Time between frames", stage=stage, instance=name)
+        self.latency = registry.histogram('latency_seconds', "Capture to done with each frame", stage=stage, instance=name)
+        self.fpsGauge = registry.gauge('fps', "Smoothed frame rate", stage=stage, instance=name)
+        self.busyGauge = registry.gauge('busy', "Smoothed fraction of the time spent on frames", stage=stage, instance=name)
+
+        self._start = None
+        self._lastStart = None
+        self._meanInterval = 0.0
+        self._meanDuration = 0.0
+
+    def start(self, now=None):
+        if (now is None):
+            now = monotonic()
+        if (self._lastStart is not None):
+            interval = now - self._lastStart
+            self.interval.record(interval)
+            if (self._meanInterval == 0.0):
+                self._meanInterval = interval
+            else:
+                self._meanInterval += self.smoothing * (interval - self._meanInterval)
+        self._lastStart = now
+        self._start = now
+
+    def end(self, now=None, timestamp=None):
+        # timestamp is the frame's capture time, if known (see clock.py)
+        if (now is None):
+            now = monotonic()
+        self.frames.inc()
+        if (self._start is not None):
+            duration = now - self._start
+            self.duration.record(duration)
+            self._meanDuration += self.smoothing * (duration - self._meanDuration)
+            self._start = None
+        if ((timestamp is not None) and (timestamp > 0.0)):
+            self.latency.record(now - timestamp)
+        self.fpsGauge.set(self.fps(now))
+        self.busyGauge.set(self.busy())
+
+    def drop(self):
+        self.dropped.inc()
+
+    def skip(self, n):
+        if (n > 0):
+            self.skipped.inc(n)
+
+    def fps(self, now=None):
+        # Smoothed frame rate, falling off when frames stop coming
+        if (self._meanInterval <= 0.0):
+            return 0.0
+        if (now is None):
+            now = monotonic()
+        return 1.0 / max(self._meanInterval, now - self._lastStart)
+
+    def busy(self):
+        # Smoothed fraction of the time spent working on frames
+        if (self._meanInterval <= 0.0):
+            return 0.0
+        return self._meanDuration / self._meanInterval
+
+    def meanDuration(self):
+        return self._meanDuration
+
+    def close(self):
+        # Take our metrics out of the registry (e.g., a client went away)
+        for metric in (self.frames, self.dropped, self.skipped, self.duration,
+                       self.interval, self.latency, self.fpsGauge, self.busyGauge):
+            registry.remove(metric)
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+pipelinebench
+
+Speed and accuracy of the vision pipelines over our labeled images
+
+The image names say where each was taken from, e.g. redBoiler8ftLeft.jpg
+was taken 8 feet from the boiler, to its left. For each pipeline this
+reports:
+
+    speed       frames per second, the p50/p95 time per frame and the time
+                per frame of each step (threshold, contours, ...)
+    accuracy    on images of its own target: how often it found the
+                target, and its distance error against the label (and its
+                angle error on the Mid images, which should be 0 degrees;
+                Left/Right only give a mean angle, since the labels do not
+                say how far off center they are)
+
+Boiler is run once with each of its feature backends (Boiler, Boiler-orb,
+...; see featurebackend.py); for it, finding the target means finding a
+homography to the training image. The results can be saved as JSON and
+compared with a saved run, so a change meant to make a pipeline faster can
+be checked for making it worse:
+
+    python pipelinebench.py --json before.json
+    ... change something ...
+    python pipelinebench.py --compare before.json
+
+The comparison exits with status 1 if a pipeline got slower by more than
+--tolerance percent or found fewer targets or got its distances more wrong.
+
+Each image is run once through a fresh pipeline for the accuracy, so the
+tracking and coasting of GearLift do not carry results from one image to
+the next. The speed is measured the way the robot runs, cycling the images
+through a single pipeline. Run it on the robot's processor; the answer on a
+desktop can be quite different.
+
+Footage from the flight recorder (see bucketrecorder.py) can be given as
+well, by its directory; it has no labels, so it only counts for speed.
+
+    python pipelinebench.py [--width 320] [--height 240] [--iterations 200]
+                            [--pipelines GearLift,BoilerStack,...] [--recorded 300]
+                            [--json FILE] [--compare FILE] [images ...]
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from bucketrecorder import RecordingReader
+from bucketrecorder import isRecording
+from clock import monotonic
+from metrics import Histogram
+from resulttable import ResultTable
+
+from gearlift import GearLift
+from boilerstack import BoilerStack
+from redboiler import RedBoiler
+from boiler import Boiler
+from featurebackend import BACKENDS
+from templatematcher import TemplateMatch
+
+# <distance>ft<position> somewhere in the file name
+LABEL = re.compile(r'(\d+(?:\.\d+)?)ft(Left|Mid|Right)', re.IGNORECASE)
+
+def imageLabel(path):
+    """Reads the ground truth from an image's file name.
+    Args:
+        path: The image's path.
+    Returns:
+        (distance_inches, position) where position is 'Left', 'Mid' or
+        'Right', or None if the name does not say.
+    """
+    match = LABEL.search(os.path.basename(path))
+    if (match is None):
+        return None
+    return (12.0 * float(match.group(1)), match.group(2).capitalize())
+
+
+class StepTimer:
+    # Times the steps of a pipeline without changing it
+    #
+    # The GRIP pipelines call their steps through a handful of names:
+    # functions imported into their module (filterContours), their own
+    # static methods (__find_contours) and objects they hold (the
+    # HSLThreshold, a feature detector); each is swapped for a wrapper
+    # that adds its time to the step's total
+    def __init__(self):
+        self.seconds = {}
+        self._patched = []
+
+    def _timed(self, step, function):
+        def timed(*args, **kwargs):
+            start = monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[step] = self.seconds.get(step, 0.0) + monotonic() - start
+        return timed
+
+    def module(self, pipeline, names):
+        # Functions the pipeline's module imported
+        module = sys.modules[pipeline.__class__.__module__]
+        for name in names:
+            if (hasattr(module, name) == True):
+                self._patch(module, name, self._timed(name, getattr(module, name)))
+
+    def static(self, pipeline, names):
+        # The pipeline class's private static methods
+        cls = pipeline.__class__
+        for name in names:
+            attr = '_' + cls.__name__ + '__' + name
+            if (attr in cls.__dict__):
+                self._patch(cls, attr, staticmethod(self._timed(name, getattr(cls, attr))))
+
+    def members(self, pipeline, names):
+        # Objects the pipeline holds; every method called on them is timed
+        # (a name like 'backend.detector' reaches into a member)
+        for name in names:
+            path = name.split('.')
+            owner = pipeline
+            for part in path[:-1]:
+                owner = getattr(owner, part)
+            attr = '_' + owner.__class__.__name__ + '__' + path[-1]
+            if (hasattr(owner, attr) == False):
+                attr = path[-1]
+            if (hasattr(owner, attr) == True):
+                self._patch(owner, attr, TimedProxy(getattr(owner, attr), path[-1], self))
+
+    def _patch(self, owner, attr, value):
+        self._patched.append((owner, attr, owner.__dict__.get(attr) if hasattr(owner, '__dict__') else None))
+        setattr(owner, attr, value)
+
+    def restore(self):
+        for (owner, attr, value) in reversed(self._patched):
+            if (value is None):
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, value)
+        self._patched = []
+
+    def reset(self):
+        self.seconds = {}
+
+
+class TimedProxy:
+    # Stands in for an object, timing every method called on it
+    def __init__(self, target, step, timer):
+        self._target = target
+        self._step = step
+        self._timer = timer
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if (callable(value) == True):
+            return self._timer._timed(self._step, value)
+        return value
+
+
+# Each pipeline: how to make one, what it looks for (images with this in
+# their name carry its labels), the table keys of its results and the
+# names its steps go by (see StepTimer)
+PIPELINES = [
+    {'name' : 'GearLift',
+     'make' : lambda: GearLift(ResultTable()),
+     'target' : 'gear',
+     'keys' : ('GearConfidence', 'GearDistance_inches', 'GearCenter_deg'),
+     'module' : ('filterContours', 'rectArrays', 'upperPairs', 'bestPair'),
+     'static' : ('find_contours',),
+     'members' : ('hsl_threshold',)},
+    {'name' : 'BoilerStack',
+     'make' : lambda: BoilerStack(ResultTable()),
+     'target' : 'boiler',
+     'keys' : ('StackConfidence', 'StackDistance_inches', 'StackCenter_deg'),
+     'module' : ('filterContours', 'rectArrays', 'upperPairs', 'bestPair'),
+     'static' : ('find_contours',),
+     'members' : ('hsl_threshold',)},
+    {'name' : 'RedBoiler',
+     'make' : lambda: RedBoiler(),
+     'target' : 'redboiler',
+     'keys' : None,
+     'module' : ('filterContours',),
+     'static' : ('find_contours',),
+     'members' : ('hsl_threshold',)},
+]
+
+# Boiler with each of its feature backends (see featurebackend.py)
+for backend in BACKENDS:
+    PIPELINES.append({'name' : 'Boiler' if (backend == 'surf') else 'Boiler-' + backend,
+                      'make' : (lambda backend=backend: Boiler(backend)),
+                      'target' : 'boiler',
+                      'keys' : None,
+                      'module' : (),
+                      'static' : (),
+                      'members' : ('backend.detector', 'backend.matcher')})
+
+# Nothing in the default images is labeled as a shirt, so this one is only
+# timed
+PIPELINES.append({'name' : 'Shirt',
+                  'make' : lambda: TemplateMatch(ResultTable(), 'shirtTraining.jpg', 'Shirt'),
+                  'target' : 'shirt',
+                  'keys' : None,
+                  'module' : (),
+                  'static' : (),
+                  'members' : ('matcher',)})
+
+def found(pipeline, keys):
+    """Reads what a pipeline found on the image it just processed.
+    Returns:
+        (detected, distance_inches, center_deg); the last two are NaN when
+        unknown (RedBoiler and Boiler only say whether they saw anything;
+        for Boiler that is whether it found a homography).
+    """
+    nan = float('NaN')
+    if (keys is not None):
+        values = pipeline.networkTable.values
+        confidence = values.get(keys[0], 0.0)
+        return (confidence > 0.0, values.get(keys[1], nan), values.get(keys[2], nan))
+    if (hasattr(pipeline, 'homography') == True):
+        return (pipeline.homography is not None, nan, nan)
+    contours = getattr(pipeline, 'filter_contours_output', None)
+    if (contours is None):
+        return (None, nan, nan)
+    return (len(contours) > 0, nan, nan)
+
+def mean(values):
+    if (len(values) == 0):
+        return None
+    return sum(values) / float(len(values))
+
+def accuracy(spec, images):
+    # Run each labeled image of the pipeline's target through a fresh one
+    results = []
+    for (path, image, label) in images:
+        if ((label is None) or (spec['target'] not in os.path.basename(path).lower())):
+            continue
+        pipeline = spec['make']()
+        pipeline.process(image.copy())
+        (detected, distance, angle) = found(pipeline, spec['keys'])
+        (trueDistance, position) = label
+        result = {'image' : os.path.basename(path),
+                  'distance_inches' : trueDistance,
+                  'position' : position,
+                  'detected' : detected,
+                  'measured_inches' : distance if (distance == distance) else None,
+                  'center_deg' : angle if (angle == angle) else None}
+        if (result['measured_inches'] is not None):
+            result['distanceError_inches'] = distance - trueDistance
+        if ((result['center_deg'] is not None) and (position == 'Mid')):
+            result['angleError_deg'] = angle
+        results.append(result)
+
+    detections = [r['detected'] for r in results if (r['detected'] is not None)]
+    distanceErrors = [abs(r['distanceError_inches']) for r in results if ('distanceError_inches' in r)]
+    angleErrors = [abs(r['angleError_deg']) for r in results if ('angleError_deg' in r)]
+    summary = {'images' : len(results),
+               'detected' : (sum(1 for d in detections if (d == True)) / float(len(detections))) if (len(detections) > 0) else None,
+               'distanceError_inches' : mean(distanceErrors),
+               'distanceErrorMax_inches' : max(distanceErrors) if (len(distanceErrors) > 0) else None,
+               'midAngleError_deg' : mean(angleErrors)}
+    for position in ('Left', 'Mid', 'Right'):
+        angles = [r['center_deg'] for r in results if ((r['position'] == position) and (r['center_deg'] is not None))]
+        summary['mean' + position + '_deg'] = mean(angles)
+    return (summary, results)
+
+def speed(spec, images, iterations):
+    # Cycle every image through one pipeline, the way the robot would
+    pipeline = spec['make']()
+    timer = StepTimer()
+    timer.module(pipeline, spec['module'])
+    timer.static(pipeline, spec['static'])
+    timer.members(pipeline, spec['members'])
+    try:
+        # Once around to warm up (caches, lazy allocations, ...)
+        for (path, image, label) in images:
+            pipeline.process(image.copy())
+        timer.reset()
+
+        # Copying the frame is the BucketProcessor's job, so not timed
+        frames = [image.copy() for (path, image, label) in images]
+        times = Histogram('frame_seconds', {})
+        total = 0.0
+        for i in range(iterations):
+            source = frames[i % len(frames)]
+            np.copyto(source, images[i % len(images)][1])
+            start = monotonic()
+            pipeline.process(source)
+            elapsed = monotonic() - start
+            times.record(elapsed)
+            total += elapsed
+    finally:
+        timer.restore()
+
+    steps = {}
+    for (step, seconds) in timer.seconds.items():
+        steps[step] = 1000.0 * seconds / iterations
+    steps['other'] = 1000.0 * (total - sum(timer.seconds.values())) / iterations
+    return {'fps' : iterations / total if (total > 0.0) else 0.0,
+            'mean_ms' : 1000.0 * times.mean(),
+            'p50_ms' : 1000.0 * times.percentile(50),
+            'p95_ms' : 1000.0 * times.percentile(95),
+            'max_ms' : 1000.0 * times.max,
+            'steps_ms' : steps}
+
+def show(value, format='{:.2f}'):
+    if (value is None):
+        return '-'
+    return format.format(value)
+
+def report(name, result):
+    s = result['speed']
+    a = result['accuracy']
+    print(name + ": {:.1f} fps".format(s['fps']) +
+          ", p50 {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms".format(s['p50_ms'], s['p95_ms'], s['max_ms']))
+    print("    steps: " + ", ".join(step + " {:.3f} ms".format(ms) for (step, ms) in sorted(s['steps_ms'].items())))
+    if (a['images'] > 0):
+        print("    " + str(a['images']) + " labeled images" +
+              ", detected " + show(a['detected'], '{:.0%}') +
+              ", distance error " + show(a['distanceError_inches'], '{:.1f}') + " in" +
+              " (max " + show(a['distanceErrorMax_inches'], '{:.1f}') + ")" +
+              ", Mid angle error " + show(a['midAngleError_deg'], '{:.2f}') + " deg" +
+              ", mean angle L/M/R " + "/".join(show(a['mean' + p + '_deg'], '{:.1f}') for p in ('Left', 'Mid', 'Right')))
+
+def compare(baseline, current, tolerance):
+    """Prints how the current run differs from a saved one.
+    Args:
+        baseline: The saved run (as written by --json).
+        current: This run.
+        tolerance: Percent slower that is not yet a regression.
+    Returns:
+        The list of regressions found (empty if none).
+    """
+    regressions = []
+    print("Compared with " + baseline.get('machine', '?') + " at " + time.ctime(baseline.get('time', 0)))
+    for (name, now) in sorted(current['pipelines'].items()):
+        before = baseline['pipelines'].get(name)
+        if (before is None):
+            print(name + ": not in the baseline")
+            continue
+        fpsBefore = before['speed']['fps']
+        fpsNow = now['speed']['fps']
+        change = 100.0 * (fpsNow - fpsBefore) / fpsBefore if (fpsBefore > 0.0) else 0.0
+        print(name + ": {:.1f} -> {:.1f} fps ({:+.1f}%)".format(fpsBefore, fpsNow, change) +
+              ", p95 {:.2f} -> {:.2f} ms".format(before['speed']['p95_ms'], now['speed']['p95_ms']))
+        steps = sorted(set(before['speed']['steps_ms'].keys()) | set(now['speed']['steps_ms'].keys()))
+        print("    steps: " + ", ".join(step + " " + show(before['speed']['steps_ms'].get(step), '{:.3f}') +
+                                        " -> " + show(now['speed']['steps_ms'].get(step), '{:.3f}') for step in steps))
+        if (change < -tolerance):
+            regressions.append(name + " is {:.1f}% slower".format(-change))
+
+        a0 = before['accuracy']
+        a1 = now['accuracy']
+        if (a1['images'] > 0):
+            print("    detected " + show(a0['detected'], '{:.0%}') + " -> " + show(a1['detected'], '{:.0%}') +
+                  ", distance error " + show(a0['distanceError_inches'], '{:.1f}') + " -> " + show(a1['distanceError_inches'], '{:.1f}') + " in" +
+                  ", Mid angle error " + show(a0['midAngleError_deg'], '{:.2f}') + " -> " + show(a1['midAngleError_deg'], '{:.2f}') + " deg")
+            if ((a0['detected'] is not None) and (a1['detected'] is not None) and (a1['detected'] < a0['detected'])):
+                regressions.append(name + " found fewer targets")
+            for key in ('distanceError_inches', 'midAngleError_deg'):
+                if ((a0[key] is not None) and ((a1[key] is None) or (a1[key] > a0[key] + 1e-6))):
+                    regressions.append(name + " " + key + " got worse")
+    return regressions
+
+parser = argparse.ArgumentParser(description='Benchmark the speed and accuracy of the vision pipelines')
+parser.add_argument('images', nargs='*', help='images or recording directories to use (default: *Boiler*.jpg and *Gear*.jpg)')
+parser.add_argument('--width', type=int, default=320)
+parser.add_argument('--height', type=int, default=240)
+parser.add_argument('--iterations', type=int, default=200)
+parser.add_argument('--pipelines', default=','.join(spec['name'] for spec in PIPELINES),
+                    help='comma separated pipelines to run')
+parser.add_argument('--recorded', type=int, default=300,
+                    help='most frames to take (evenly spaced) from each recording')
+parser.add_argument('--json', metavar='FILE', help='save the results here')
+parser.add_argument('--compare', metavar='FILE', help='compare with results saved by --json')
+parser.add_argument('--tolerance', type=float, default=10.0,
+                    help='percent slower allowed before --compare calls it a regression')
+args = parser.parse_args()
+
+paths = args.images
+if (len(paths) == 0):
+    paths = sorted(set(glob.glob('*Boiler*.jpg') + glob.glob('*Gear*.jpg') + glob.glob('*gear*.jpg')))
+images = []
+for path in paths:
+    if (isRecording(path) == True):
+        # Recordings have no labels; they only count for speed
+        reader = RecordingReader(path)
+        step = max(1, len(reader.entries()) // max(1, args.recorded))
+        for (i, (image, entry)) in enumerate(reader.frames()):
+            if ((i % step) == 0):
+                name = os.path.basename(entry['chunk']) + '#' + str(entry['seq'])
+                images.append((name, cv2.resize(image, (args.width, args.height)), None))
+        continue
+    image = cv2.imread(path)
+    if (image is not None):
+        images.append((path, cv2.resize(image, (args.width, args.height)), imageLabel(path)))
+print("Using " + str(len(images)) + " images (" + str(sum(1 for i in images if (i[2] is not None))) +
+      " labeled) at " + str(args.width) + "x" + str(args.height))
+if (len(images) == 0):
+    sys.exit(1)
+
+run = {'time' : time.time(),
+       'machine' : platform.node(),
+       'platform' : platform.platform(),
+       'python' : platform.python_version(),
+       'opencv' : cv2.__version__,
+       'width' : args.width,
+       'height' : args.height,
+       'iterations' : args.iterations,
+       'images' : [os.path.basename(path) for (path, image, label) in images],
+       'pipelines' : {}}
+
+selected = args.pipelines.split(',')
+for spec in PIPELINES:
+    if (spec['name'] not in selected):
+        continue
+    try:
+        spec['make']()
+    except (cv2.error, AttributeError, IOError) as e:
+        # e.g., Boiler needs SURF from opencv-contrib
+        print(spec['name'] + ": skipped (" + str(e).strip() + ")")
+        continue
+    try:
+        (summary, results) = accuracy(spec, images)
+        result = {'speed' : speed(spec, images, args.iterations),
+                  'accuracy' : summary,
+                  'results' : results}
+    except Exception as e:
+        # A pipeline that falls over is reported, not allowed to stop the others
+        print(spec['name'] + ": failed (" + e.__class__.__name__ + ": " + str(e) + ")")
+        continue
+    run['pipelines'][spec['name']] = result
+    report(spec['name'], result)
+
+if (args.json is not None):
+    with open(args.json, 'w') as f:
+        json.dump(run, f, indent=1, sort_keys=True)
+    print("Saved to " + args.json)
+
+if (args.compare is not None):
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, run, args.tolerance)
+    if (len(regressions) > 0):
+        print("REGRESSIONS:")
+        for regression in regressions:
+            print("    " + regression)
+        sys.exit(1)
+    print("No regressions")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+pipelineworker
+
+Runs vision pipelines in a separate process to get out from under the GIL
+
+The pure-Python parts of our pipelines (e.g., the contour pairing loops in
+GearLift and BoilerStack) hold the GIL and compete with the capture and
+HTTP threads. A PipelineWorker forks a process that owns the pipelines and
+runs them on frames that live in shared memory (a FrameRing created with
+shared=True), so no pixels are copied or pickled. The pipeline draws its
+overlay directly into the shared frame and the only thing sent back is the
+small list of NetworkTables updates it made, which are then applied to the
+real table in this process.
+
+NOTE: The worker is forked, so this only works where multiprocessing uses
+fork (i.e., Linux, which is what the coprocessor runs). The pipelines are
+copied into the child at start(); changing them afterwards in the parent
+has no effect on the worker.
+"""
+
+import multiprocessing
+
+import cv2
+
+from resulttable import ResultTable
+
+def _workerMain(conn, ipdictionary, images):
+    # Keep OpenCV from using its own thread pool in the forked child;
+    # pools created before a fork are not safe to use after it
+    cv2.setNumThreads(0)
+
+    # Record what the pipelines publish instead of talking to the network
+    tables = {}
+    for (selection, ip) in ipdictionary.items():
+        if (hasattr(ip, 'networkTable') == True):
+            tables[selection] = ResultTable()
+            ip.networkTable = tables[selection]
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if (request is None):
+            break
+
+        (selection, index, timestamp, quality) = request
+        ip = ipdictionary[selection]
+        if (hasattr(ip, 'captureTime') == True):
+            ip.captureTime = timestamp
+        if (hasattr(ip, 'setQuality') == True):
+            ip.setQuality(quality)
+        ip.process(images[index])
+
+        if (selection in tables):
+            conn.send(tables[selection].takeUpdates())
+        else:
+            conn.send([])
+
+    conn.close()
+
+
+class PipelineWorker:
+    def __init__(self, name, ipdictionary, ring):
+        self.name = name
+        self.ipdictionary = ipdictionary
+        self.ring = ring
+        self._conn = None
+        self._process = None
+
+    def start(self):
+        print("STARTING PipelineWorker for " + self.name)
+        (self._conn, childConn) = multiprocessing.Pipe()
+        images = [slot.image for slot in self.ring.slots]
+        self._process = multiprocessing.Process(target=_workerMain,
+                                                args=(childConn, self.ipdictionary, images))
+        self._process.daemon = True
+        self._process.start()
+        childConn.close()
+        return self
+
+    def process(self, selection, slot, quality=0):
+        # Run the selected pipeline on a (shared) ring slot in the worker,
+        # at the given quality if it has a setQuality(), and apply its
+        # results to the pipeline's table in this process
+        self._conn.send((selection, slot.index, slot.timestamp, quality))
+        updates = self._conn.recv()
+
+        ip = self.ipdictionary[selection]
+        if (hasattr(ip, 'networkTable') == True):
+            ResultTable.apply(ip.networkTable, updates)
+
+    def stop(self):
+        # Ask the worker to finish (it may already be gone), wait for it
+        # and close our end of the pipe
+        if (self._process is None):
+            return
+        print("STOPPING PipelineWorker for " + self.name)
+        try:
+            self._conn.send(None)
+        except IOError:
+            pass
+        self._process.join(1.0)
+        if (self._process.is_alive() == True):
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        print("PipelineWorker for " + self.name + " STOPPED, exit code " + str(self._process.exitcode))
+        self._process = None
@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
 import math
+from contourfilter import filterContours
+from hslthreshold import HSLThreshold
 
 class RedBoiler:
     """
@@ -22,6 +24,15 @@ class RedBoiler:
         self.__hsl_threshold_hue = [168.34532374100723, 180.0]
         self.__hsl_threshold_saturation = [82.55395683453237, 255.0]
         self.__hsl_threshold_luminance = [73.38129496402877, 174.4965870307167]
+        # Lookup table version of GRIP's cvtColor()/inRange(); building the
+        # table takes a moment, so start it now in the background
+        self.__hsl_threshold = HSLThreshold()
+        self.__hsl_threshold.warmUp(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+
+        # The camera frame our image is a copy of, when the BucketProcessor
+        # gives us one; other pipelines on the same frame with the same
+        # thresholds then share one mask (see framecache.py)
+        self.frame = None
         
         self.hsl_threshold_output = None
 
@@ -56,7 +67,12 @@ class RedBoiler:
 
         # Step HSL_Threshold0:
         self.__hsl_threshold_input = source0
-        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        if (self.frame is not None):
+            # The cached mask is shared and findContours() modifies its
+            # input, so we work on a copy
+            (self.hsl_threshold_output) = self.frame.cache.hslThreshold(self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance, self.__hsl_threshold).copy()
+        else:
+            (self.hsl_threshold_output) = self.__hsl_threshold.threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
 
         # Step Find_Contours0:
         self.__find_contours_input = self.hsl_threshold_output
@@ -64,7 +80,7 @@ class RedBoiler:
 
         # Step Filter_Contours0:
         self.__filter_contours_contours = self.find_contours_output
-        (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
+        (self.filter_contours_output) = filterContours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
 
         # TODO: Optionally draw the contours for debug
         # For now, just uncomment as needed
@@ -103,20 +119,6 @@ class RedBoiler:
         """
         return cv2.resize(input, ((int)(width), (int)(height)), 0, 0, interpolation)
 
-    @staticmethod
-    def __hsl_threshold(input, hue, sat, lum):
-        """Segment an image based on hue, saturation, and luminance ranges.
-        Args:
-            input: A BGR numpy.ndarray.
-            hue: A list of two numbers the are the min and max hue.
-            sat: A list of two numbers the are the min and max saturation.
-            lum: A list of two numbers the are the min and max luminance.
-        Returns:
-            A black and white numpy.ndarray.
-        """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
-        return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
-
     @staticmethod
     def __find_contours(input, external_only):
         """Sets the values of pixels in a binary image to their distance to the nearest black pixel.
@@ -134,50 +136,5 @@ class RedBoiler:
         im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
         return contours
 
-    @staticmethod
-    def __filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
-                        min_height, max_height, solidity, max_vertex_count, min_vertex_count,
-                        min_ratio, max_ratio):
-        """Filters out contours that do not meet certain criteria.
-        Args:
-            input_contours: Contours as a list of numpy.ndarray.
-            min_area: The minimum area of a contour that will be kept.
-            min_perimeter: The minimum perimeter of a contour that will be kept.
-            min_width: Minimum width of a contour.
-            max_width: MaxWidth maximum width.
-            min_height: Minimum height.
-            max_height: Maximimum height.
-            solidity: The minimum and maximum solidity of a contour.
-            min_vertex_count: Minimum vertex Count of the contours.
-            max_vertex_count: Maximum vertex Count.
-            min_ratio: Minimum ratio of width to height.
-            max_ratio: Maximum ratio of width to height.
-        Returns:
-            Contours as a list of numpy.ndarray.
-        """
-        output = []
-        for contour in input_contours:
-            x,y,w,h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
-
 
 
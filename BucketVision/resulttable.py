@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+resulttable
+
+Stand-in for a NetworkTables table that records what a pipeline publishes
+
+Pipelines report their targets with table.putNumber(...) and friends.
+A ResultTable remembers the latest value of every key and keeps a list of
+the updates since they were last collected, so the results can be shipped
+somewhere else (e.g., from a worker process back to the real table) or
+inspected offline. If given a table it also forwards every update to it.
+"""
+
+class ResultTable:
+    def __init__(self, table=None):
+        self.table = table
+        self.values = {}
+        self._updates = []
+
+    def _put(self, method, key, value):
+        self.values[key] = value
+        self._updates.append((method, key, value))
+        if (self.table is not None):
+            getattr(self.table, method)(key, value)
+        return True
+
+    def putNumber(self, key, value):
+        return self._put('putNumber', key, value)
+
+    def putString(self, key, value):
+        return self._put('putString', key, value)
+
+    def putBoolean(self, key, value):
+        return self._put('putBoolean', key, value)
+
+    def getNumber(self, key, defaultValue=None):
+        return self.values.get(key, defaultValue)
+
+    def getString(self, key, defaultValue=None):
+        return self.values.get(key, defaultValue)
+
+    def getBoolean(self, key, defaultValue=None):
+        return self.values.get(key, defaultValue)
+
+    def takeUpdates(self):
+        # Return the (method, key, value) updates since the last call
+        updates = self._updates
+        self._updates = []
+        return updates
+
+    @staticmethod
+    def apply(table, updates):
+        # Replay updates from takeUpdates() onto another table
+        for (method, key, value) in updates:
+            getattr(table, method)(key, value)
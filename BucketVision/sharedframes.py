@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+sharedframes
+
+Named shared-memory frame store for running the bucket brigade as
+separate processes (e.g., capture, processing and streaming), so that a
+crash in the MJPEG server or a slow pipeline cannot take down the capture
+loop, and without pickling frames between them.
+
+A writer creates a named segment (a file in /dev/shm on Linux) holding a
+small header and a ring of frame slots:
+
+    header:   magic, layout version, number of slots, shape, dtype,
+              bytes per frame, sequence number of the latest frame
+    slots:    per-slot version, sequence number and capture timestamp
+    frames:   the pixels, one fixed-size block per slot
+
+Frame N (counting from 1) always goes into slot (N - 1) % numSlots.
+
+Readers in any process map the same segment by name. There is no lock
+between processes; each slot carries a version number that is odd while
+the writer is filling it (a "seqlock"), and a reader copies the frame out
+and then checks that the version did not change while it was copying.
+If it did, the writer lapped it and the reader simply tries again with
+the newest frame. Readers wait for a new frame by looking at the latest
+sequence number every half frame period (measured from the frames' own
+timestamps), so a waiting reader costs next to nothing.
+
+The module also provides the two stages that glue this to the rest of
+BucketVision: SharedFramePublisher pushes the frames of any stage (e.g., a
+BucketCapture) into a store, and SharedFrameSource reads a store and looks
+like a BucketCapture to whatever consumes it (e.g., a BucketProcessor in
+another process).
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from threading import Thread
+
+import numpy as np
+
+import clock
+import threadcpu
+
+from framering import FrameRing
+from metrics import StageMetrics
+
+_MAGIC = b'BVSF'
+_LAYOUT_VERSION = 1
+
+# magic, layout version, numSlots, ndim, shape[4], dtype, frame bytes
+_HEADER_FORMAT = '<4sIII4I8sQ'
+_LATEST_OFFSET = struct.calcsize(_HEADER_FORMAT)    # u32 sequence of latest frame
+_SLOTS_OFFSET = 64
+
+# Seconds between looks at the store while waiting, until the frame rate
+# is known, and the bounds on it after that
+_POLL_INTERVAL = 0.005
+_MIN_POLL_INTERVAL = 0.001
+_MAX_POLL_INTERVAL = 0.05
+
+_SLOT_DTYPE = np.dtype([('version', '<u4'),
+                        ('seq', '<u4'),
+                        ('timestamp', '<f8'),
+                        ('reserved', 'V16')])
+
+def _align(n, alignment=64):
+    return (n + alignment - 1) // alignment * alignment
+
+def segmentPath(name):
+    # /dev/shm is a RAM backed file system on Linux; anywhere else the
+    # temp directory will have to do (the OS page cache does the rest)
+    if (os.path.isdir('/dev/shm')):
+        directory = '/dev/shm'
+    else:
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, 'bucketvision.' + name)
+
+
+class _SharedFrames:
+    # Views on a mapped segment; shared by the writer and reader
+    def _map(self, fileobj, size):
+        self._mm = mmap.mmap(fileobj.fileno(), size)
+        self._latest = np.frombuffer(self._mm, dtype='<u4', count=1, offset=_LATEST_OFFSET)
+        self._slots = np.frombuffer(self._mm, dtype=_SLOT_DTYPE,
+                                    count=self.numSlots, offset=_SLOTS_OFFSET)
+        dataOffset = _align(_SLOTS_OFFSET + _SLOT_DTYPE.itemsize * self.numSlots)
+        stride = _align(self.frameBytes)
+        self._frames = []
+        for i in range(self.numSlots):
+            frame = np.frombuffer(self._mm, dtype=self.dtype,
+                                  count=int(np.prod(self.shape)),
+                                  offset=dataOffset + i * stride).reshape(self.shape)
+            self._frames.append(frame)
+
+    @staticmethod
+    def _size(numSlots, frameBytes):
+        return _align(_SLOTS_OFFSET + _SLOT_DTYPE.itemsize * numSlots) + numSlots * _align(frameBytes)
+
+    def latestSeq(self):
+        return int(self._latest[0])
+
+    def close(self):
+        self._frames = []
+        self._slots = None
+        self._latest = None
+        try:
+            self._mm.close()
+        except BufferError:
+            # Someone still holds a view; the mapping goes away with it
+            pass
+
+
+class SharedFrameWriter(_SharedFrames):
+    def __init__(self, name, numSlots, shape, dtype=np.uint8):
+        self.name = name
+        self.path = segmentPath(name)
+        self.numSlots = numSlots
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        if (len(self.shape) > 4):
+            raise ValueError("SharedFrameWriter supports at most 4 dimensions")
+
+        # Always start from a fresh file so that readers still mapping a
+        # previous incarnation can tell (by inode) that they must reopen
+        if (os.path.exists(self.path)):
+            os.unlink(self.path)
+
+        size = self._size(numSlots, self.frameBytes)
+        with open(self.path, 'w+b') as f:
+            f.truncate(size)
+            self._map(f, size)
+
+        shape4 = list(self.shape) + [0] * (4 - len(self.shape))
+        header = struct.pack(_HEADER_FORMAT, _MAGIC, _LAYOUT_VERSION, numSlots,
+                             len(self.shape), shape4[0], shape4[1], shape4[2], shape4[3],
+                             self.dtype.str.encode('ascii'), self.frameBytes)
+        self._mm[0:len(header)] = header
+
+    def publish(self, image, timestamp=None):
+        # Copy a frame into the next slot and make it the latest; the
+        # timestamp is its monotonic capture time (see clock.py), which
+        # every process on the machine agrees on
+        if (timestamp is None):
+            timestamp = clock.monotonic()
+        seq = self.latestSeq() + 1
+        index = (seq - 1) % self.numSlots
+
+        self._slots['version'][index] += 1      # odd: being written
+        np.copyto(self._frames[index], image)
+        self._slots['seq'][index] = seq
+        self._slots['timestamp'][index] = timestamp
+        self._slots['version'][index] += 1      # even: stable
+
+        self._latest[0] = seq
+        return seq
+
+    def close(self, unlink=True):
+        _SharedFrames.close(self)
+        if ((unlink == True) and os.path.exists(self.path)):
+            os.unlink(self.path)
+
+
+class SharedFrameReader(_SharedFrames):
+    def __init__(self, name):
+        self.name = name
+        self.path = segmentPath(name)
+        self._open()
+
+        # Smoothed seconds between frames, from their timestamps, and the
+        # last frame it was measured from
+        self.framePeriod = None
+        self._lastSeq = None
+        self._lastTimestamp = None
+
+    def _open(self):
+        with open(self.path, 'r+b') as f:
+            header = f.read(struct.calcsize(_HEADER_FORMAT))
+            (magic, layout, numSlots, ndim, s0, s1, s2, s3,
+             dtype, frameBytes) = struct.unpack(_HEADER_FORMAT, header)
+            if ((magic != _MAGIC) or (layout != _LAYOUT_VERSION)):
+                raise IOError(self.path + " is not a BucketVision frame store")
+            self.numSlots = numSlots
+            self.shape = (s0, s1, s2, s3)[:ndim]
+            self.dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+            self.frameBytes = frameBytes
+            self._inode = os.fstat(f.fileno()).st_ino
+            self._map(f, self._size(numSlots, frameBytes))
+
+    def _reopenIfReplaced(self):
+        # A restarted writer creates a new file under the same name
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return False
+        if (inode == self._inode):
+            return False
+        self.close()
+        self._open()
+        return True
+
+    def read(self, afterSeq=0, timeout=None, out=None, pollInterval=None):
+        # Copy the newest frame with seq > afterSeq into out (allocated if
+        # not given), waiting up to timeout seconds (None waits forever,
+        # 0 polls once) and looking for it every pollInterval seconds
+        # (by default half the frame period)
+        #
+        # Returns (image, seq, timestamp), or (None, afterSeq, 0.0) if no
+        # newer frame arrived in time
+        if (timeout is not None):
+            deadline = clock.monotonic() + timeout
+        while True:
+            seq = self.latestSeq()
+            if (seq < afterSeq):
+                # The writer restarted and its count started over
+                afterSeq = 0
+            if (seq > afterSeq):
+                if (out is None):
+                    out = np.empty(self.shape, dtype=self.dtype)
+                index = (seq - 1) % self.numSlots
+                version = self._slots['version'][index]
+                if ((version & 1) == 0):
+                    np.copyto(out, self._frames[index])
+                    timestamp = float(self._slots['timestamp'][index])
+                    if ((self._slots['version'][index] == version) and
+                        (self._slots['seq'][index] == seq)):
+                        self._measure(seq, timestamp)
+                        return (out, seq, timestamp)
+                # Lapped by the writer; go again with the newest frame
+                continue
+
+            wait = pollInterval
+            if (wait is None):
+                wait = _POLL_INTERVAL
+                if (self.framePeriod is not None):
+                    wait = min(_MAX_POLL_INTERVAL, max(_MIN_POLL_INTERVAL, self.framePeriod / 2.0))
+            if (timeout is not None):
+                remaining = deadline - clock.monotonic()
+                if (remaining <= 0.0):
+                    if (self._reopenIfReplaced() == True):
+                        afterSeq = 0
+                    return (None, afterSeq, 0.0)
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def _measure(self, seq, timestamp):
+        # Keep track of the frame period from the frames we read
+        if ((self._lastSeq is not None) and (seq > self._lastSeq) and
+            (timestamp > self._lastTimestamp)):
+            period = (timestamp - self._lastTimestamp) / (seq - self._lastSeq)
+            if (self.framePeriod is None):
+                self.framePeriod = period
+            else:
+                self.framePeriod = 0.9 * self.framePeriod + 0.1 * period
+        self._lastSeq = seq
+        self._lastTimestamp = timestamp
+
+
+class SharedFramePublisher:
+    # Stage that copies every new frame of a stage (anything with the
+    # BucketCapture read() interface) into a named frame store
+    def __init__(self, name, stream, numSlots=4):
+        print("Creating SharedFramePublisher for " + name)
+        self.name = name
+        self.stream = stream
+        self.metrics = StageMetrics("SharedFramePublisher", name)
+        self.writer = SharedFrameWriter(name, numSlots, stream.ring.shape, stream.ring.dtype)
+
+        self._stop = False
+        self.stopped = True
+
+    def start(self):
+        print("STARTING SharedFramePublisher for " + self.name)
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("SharedFramePublisher for " + self.name + " RUNNING")
+        threadcpu.register("SharedFramePublisher " + self.name)
+        self.stopped = False
+
+        lastCount = 0
+        while True:
+            if (self._stop == True):
+                self._stop = False
+                self.writer.close()
+                self.stopped = True
+                return
+
+            previousCount = lastCount
+            (frame, lastCount, isNew) = self.stream.read(lastCount, 0.1)
+            if (isNew == False):
+                continue
+            self.metrics.start()
+            if (previousCount != 0):
+                self.metrics.skip(lastCount - previousCount - 1)
+            self.writer.publish(frame.image, frame.timestamp)
+            timestamp = frame.timestamp
+            frame.release()
+            self.metrics.end(timestamp=timestamp)
+
+    def stop(self):
+        self._stop = True
+
+    def isStopped(self):
+        return self.stopped
+
+
+class SharedFrameSource:
+    # Stage that reads a named frame store (written by another process)
+    # and hands the frames out like a BucketCapture
+    def __init__(self, name, numSlots=4, timeout=None):
+        print("Creating SharedFrameSource for " + name)
+        self.name = name
+        self.metrics = StageMetrics("SharedFrameSource", name)
+
+        # Wait for the writer to create the store
+        if (timeout is not None):
+            deadline = clock.monotonic() + timeout
+        while True:
+            try:
+                self.reader = SharedFrameReader(name)
+                break
+            except IOError:
+                if ((timeout is not None) and (clock.monotonic() >= deadline)):
+                    raise
+                time.sleep(0.1)
+
+        self.ring = FrameRing(numSlots, self.reader.shape, self.reader.dtype)
+
+        self._stop = False
+        self.stopped = True
+
+    def start(self):
+        print("STARTING SharedFrameSource for " + self.name)
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("SharedFrameSource for " + self.name + " RUNNING")
+        threadcpu.register("SharedFrameSource " + self.name)
+        self.stopped = False
+
+        lastSeq = 0
+        while True:
+            if (self._stop == True):
+                self._stop = False
+                self.reader.close()
+                self.stopped = True
+                return
+
+            slot = self.ring.acquire()
+            if (slot is None):
+                time.sleep(0.001)
+                continue
+
+            (image, seq, timestamp) = self.reader.read(lastSeq, 0.1, out=slot.image)
+            enter = clock.monotonic()
+            if (image is None):
+                if (self.reader.shape != self.ring.shape):
+                    print("SharedFrameSource for " + self.name + " frame size changed; stopping")
+                    self._stop = True
+                self.ring.abandon(slot)
+                continue
+
+            self.metrics.start(enter)
+            if (lastSeq != 0):
+                self.metrics.skip(seq - lastSeq - 1)
+            lastSeq = seq
+            slot.timestamp = timestamp
+            now = clock.monotonic()
+            slot.stamp("SharedFrameSource", enter, now)
+            self.ring.publish(slot)
+            self.metrics.end(now, timestamp)
+
+    def read(self, afterCount=0, timeout=None):
+        # Same contract as BucketCapture.read()
+        frame = self.ring.read(afterCount, timeout)
+        if (frame is None):
+            return (None, afterCount, False)
+        return (frame, frame.count, True)
+
+    def processUserCommand(self, key):
+        # Camera controls belong to the process that owns the camera
+        return key == ord('x')
+
+    def updateExposure(self, exposure):
+        pass
+
+    def stop(self):
+        self._stop = True
+        self.ring.wakeAll()
+
+    def isStopped(self):
+        return self.stopped
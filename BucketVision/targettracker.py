@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+targettracker
+
+Smoothed, latency-compensated target outputs for the roboRIO
+
+The pipelines publish a raw center angle and distance each time a frame
+completes, and NaN as soon as a single frame misses the target. The
+control loop on the roboRIO runs at its own rate, so it sees values that
+jump, that are already a frame or two old and that drop out on every
+glint.
+
+A TargetTracker sits between a pipeline and its NetworkTable. It passes
+everything through untouched (the raw keys stay as they are), and it also
+feeds the pipeline's <prefix>Center_deg and <prefix>Distance_inches into
+a constant-velocity Kalman filter per quantity, as of the time the frame
+was captured (from <prefix>Latency_ms, when the pipeline publishes it). A
+thread then publishes the filtered values predicted to the current time,
+at a fixed rate:
+
+    <prefix>Tracked_deg             filtered center angle
+    <prefix>TrackedDistance_inches  filtered distance
+    <prefix>TrackedConfidence       1 right after a verified pair, fading
+                                    to 0 while coasting without one
+    <prefix>TrackedAge              seconds since the last measurement
+
+When the target drops out the filter coasts on its last velocity while
+its covariance grows, and after maxCoast seconds (or once it is too
+uncertain) the tracked values go to NaN until the target comes back.
+
+Usage:
+
+    gearTracker = TargetTracker("Gear", bvTable).start()
+    gearLift = GearLift(gearTracker)
+"""
+
+import math
+import time
+
+from threading import Lock
+from threading import Thread
+
+import threadcpu
+
+from clock import monotonic
+
+class KalmanTrack:
+    # Constant-velocity Kalman filter for one quantity
+    #
+    # State is position and rate; processNoise is the spectral density of
+    # the (unknown) acceleration, in units^2/s^3
+    def __init__(self, processNoise, measurementNoise, initialRateVariance):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.initialRateVariance = initialRateVariance
+        self.reset()
+
+    def reset(self):
+        self.time = None
+        self.x = 0.0
+        self.v = 0.0
+        self.p00 = 0.0
+        self.p01 = 0.0
+        self.p11 = 0.0
+
+    def isValid(self):
+        return self.time is not None
+
+    def _predicted(self, t):
+        # State and covariance at time t (no change to the filter)
+        dt = max(0.0, t - self.time)
+        q = self.processNoise
+        x = self.x + self.v * dt
+        p00 = self.p00 + dt * (2.0 * self.p01 + dt * self.p11) + q * dt**3 / 3.0
+        p01 = self.p01 + dt * self.p11 + q * dt**2 / 2.0
+        p11 = self.p11 + q * dt
+        return (x, self.v, p00, p01, p11)
+
+    def predict(self, t):
+        # Return (value, variance) predicted to time t
+        (x, v, p00, p01, p11) = self._predicted(t)
+        return (x, p00)
+
+    def update(self, t, z, noiseScale=1.0):
+        # Fold in measurement z taken at time t
+        r = self.measurementNoise * noiseScale
+        if (self.time is None):
+            self.time = t
+            self.x = z
+            self.v = 0.0
+            self.p00 = r
+            self.p01 = 0.0
+            self.p11 = self.initialRateVariance
+            return
+
+        if (t < self.time):
+            return      # older than what we already have
+
+        (x, v, p00, p01, p11) = self._predicted(t)
+        s = p00 + r
+        k0 = p00 / s
+        k1 = p01 / s
+        residual = z - x
+        self.x = x + k0 * residual
+        self.v = v + k1 * residual
+        self.p00 = (1.0 - k0) * p00
+        self.p01 = (1.0 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        self.time = t
+
+
+class TargetTracker:
+    def __init__(self, prefix, table, rate=50.0, maxCoast=0.5, lead=0.0):
+        """
+        Args:
+            prefix: key prefix of the pipeline's outputs (e.g., "Gear")
+            table: the NetworkTable the pipeline would otherwise write to
+            rate: how often (Hz) to publish the tracked values
+            maxCoast: seconds to keep predicting without a measurement
+            lead: extra seconds to predict ahead (e.g., for the time the
+                  value takes to reach the roboRIO's control loop)
+        """
+        print("Creating TargetTracker for " + prefix)
+        self.name = prefix
+        self.prefix = prefix
+        self.table = table
+        self.rate = rate
+        self.maxCoast = maxCoast
+        self.lead = lead
+
+        # Tuned for a target seen from a driving robot: the angle can
+        # change by tens of degrees a second, the distance by a few feet
+        self.angle = KalmanTrack(processNoise=400.0, measurementNoise=0.25, initialRateVariance=100.0)
+        self.distance = KalmanTrack(processNoise=2000.0, measurementNoise=4.0, initialRateVariance=400.0)
+        self.maxAngleStd = 10.0     # degrees; give up beyond this
+
+        self._lock = Lock()
+        self._confidence = 0.0      # confidence put for the frame in progress
+        self._distance = None       # distance put for the frame in progress
+        self._captureTime = None    # capture time of the frame in progress
+        self._lastConfidence = 0.0
+        self.lastMeasurement = None
+        self.measurements = 0
+
+        self._stop = False
+        self.stopped = True
+
+    # NetworkTable interface for the pipeline; everything goes straight
+    # through and the keys we track are also fed to the filters
+    def putNumber(self, key, value):
+        self.table.putNumber(key, value)
+        if (key == self.prefix + "Confidence"):
+            self._confidence = value
+        elif (key == self.prefix + "Latency_ms"):
+            if (math.isnan(value) == False):
+                self._captureTime = monotonic() - value / 1000.0
+        elif (key == self.prefix + "Distance_inches"):
+            self._distance = value
+        elif (key == self.prefix + "Center_deg"):
+            # The pipelines put the angle last, so this completes a frame
+            self.measure(value, self._distance, self._confidence, self._captureTime)
+            self._distance = None
+            self._captureTime = None
+
+    def putString(self, key, value):
+        self.table.putString(key, value)
+
+    def putBoolean(self, key, value):
+        self.table.putBoolean(key, value)
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+    def measure(self, angle_deg, distance_inches=None, confidence=1.0, timestamp=None):
+        # Fold in one frame's result, captured at timestamp (monotonic, see
+        # clock.py; default now); NaN or None values are skipped, as are
+        # frames with no confidence at all
+        if (timestamp is None):
+            timestamp = monotonic()
+        if ((confidence is None) or (confidence <= 0.0)):
+            return
+
+        # A single piece of tape (confidence 0.5) gives a much rougher
+        # estimate than a verified pair
+        noiseScale = 1.0 / (confidence * confidence)
+
+        self._lock.acquire()
+        if ((angle_deg is not None) and (math.isnan(angle_deg) == False)):
+            self.angle.update(timestamp, angle_deg, noiseScale)
+            self.lastMeasurement = timestamp
+            self.measurements += 1
+            self._lastConfidence = confidence
+        if ((distance_inches is not None) and (math.isnan(distance_inches) == False) and
+            (self.angle.isValid() == True)):
+            self.distance.update(timestamp, distance_inches, noiseScale)
+        self._lock.release()
+
+    def predict(self, t=None):
+        # Return (angle_deg, distance_inches, confidence, age) predicted to
+        # time t (default now, plus our lead); NaN when we have nothing
+        if (t is None):
+            t = monotonic() + self.lead
+        nan = float('NaN')
+
+        self._lock.acquire()
+        try:
+            if (self.angle.isValid() == False):
+                return (nan, nan, 0.0, nan)
+
+            age = max(0.0, t - self.lastMeasurement)
+            (angle, angleVariance) = self.angle.predict(t)
+            if ((age > self.maxCoast) or (angleVariance > self.maxAngleStd**2)):
+                # Lost it; start over when it comes back
+                self.angle.reset()
+                self.distance.reset()
+                return (nan, nan, 0.0, nan)
+
+            if (self.distance.isValid() == True):
+                (distance, distanceVariance) = self.distance.predict(t)
+            else:
+                distance = nan
+
+            confidence = self._lastConfidence * max(0.0, 1.0 - age / self.maxCoast)
+            return (angle, distance, confidence, age)
+        finally:
+            self._lock.release()
+
+    def start(self):
+        print("STARTING TargetTracker for " + self.name)
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+    def update(self):
+        print("TargetTracker for " + self.name + " RUNNING")
+        threadcpu.register("TargetTracker " + self.name)
+        self.stopped = False
+
+        period = 1.0 / self.rate
+        nextTime = monotonic()
+        while True:
+            if (self._stop == True):
+                self._stop = False
+                self.stopped = True
+                return
+
+            (angle, distance, confidence, age) = self.predict()
+            self.table.putNumber(self.prefix + "Tracked_deg", angle)
+            self.table.putNumber(self.prefix + "TrackedDistance_inches", distance)
+            self.table.putNumber(self.prefix + "TrackedConfidence", confidence)
+            self.table.putNumber(self.prefix + "TrackedAge", age)
+
+            # Fixed rate, without drifting
+            nextTime += period
+            delay = nextTime - monotonic()
+            if (delay > 0.0):
+                time.sleep(delay)
+            else:
+                nextTime = monotonic()
+
+    def stop(self):
+        self._stop = True
+
+    def isStopped(self):
+        return self.stopped
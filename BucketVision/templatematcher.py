@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+templatematcher
+
+Coarse-to-fine multi-scale template matching on edge images
+
+match.py finds a template at an unknown size the brute force way (see
+http://www.pyimagesearch.com/2015/01/26/multi-scale-template-matching-using-python-opencv/):
+scale the image down in 20 steps and, at every step, take the edges of the
+whole image and slide the template's edges over all of it. PyramidMatcher
+gets the same answer for a fraction of the work:
+
+    coarse  the image and the template are both decimated (by 2 by
+            default) and every scale is tried; the image is a quarter of
+            the pixels and the template a quarter of the size, so each try
+            is about 16x cheaper. The edges are blurred a little and
+            compared with normalized correlation, so that being a pixel or
+            a scale step off still scores well.
+    fine    at full resolution, only the scales next to the best few
+            coarse peaks are tried, and only in a window around each
+
+The scaled images come from an image pyramid: the gray image is halved with
+cv2.pyrDown() until it is just larger than the size wanted and resized
+(bilinear) from there. That is both better filtered and much quicker than
+cv2.INTER_AREA at the odd ratios the scales come to.
+
+Every gray image, octave and edge map is computed once per image by an
+EdgePyramid. Given the FrameSlot the image came from, they go in the
+frame's cache instead (see framecache.py), so every matcher and pipeline
+looking at the same frame shares them. The template's own edges are made
+once, when the matcher is created.
+
+TemplateMatch is the pipeline that runs a PyramidMatcher in a
+BucketProcessor.
+"""
+
+import cv2
+import numpy as np
+
+from clock import monotonic
+
+# The coarse template is kept at least this wide; decimating a small
+# template further leaves too few edges to find it by
+MIN_COARSE_WIDTH = 24
+
+class EdgePyramid:
+    # The gray image and its edges at any size, each computed once
+    def __init__(self, gray, low, high, frame=None):
+        """
+        Args:
+            gray: the full size gray image
+            low, high: Canny hysteresis thresholds
+            frame: the FrameSlot gray is from, to use (and fill) its cache
+        """
+        self.image = gray
+        self.low = low
+        self.high = high
+        self.frame = frame
+        self._images = {}
+
+    def _get(self, key, compute, shape):
+        # From the frame's cache if we have a frame, else our own
+        if (self.frame is not None):
+            return self.frame.cache.get(key, compute, shape)
+        image = self._images.get(key)
+        if (image is None):
+            image = compute(np.empty(shape, dtype=np.uint8))
+            self._images[key] = image
+        return image
+
+    def shape(self):
+        return self.image.shape[:2]
+
+    def octave(self, level):
+        # The gray image halved level times
+        if (level == 0):
+            return self.image
+        above = self.octave(level - 1)
+        size = ((above.shape[1] + 1) // 2, (above.shape[0] + 1) // 2)
+        return self._get(('grayOctave', level),
+                         lambda dst: cv2.pyrDown(above, dst=dst, dstsize=size),
+                         (size[1], size[0]))
+
+    def gray(self, width, height):
+        size = (int(width), int(height))
+        (h, w) = self.shape()
+        if (size == (w, h)):
+            return self.image
+        # Resize from the smallest octave that is still at least as large
+        level = 0
+        while (((w >> (level + 1)) >= size[0]) and ((h >> (level + 1)) >= size[1])):
+            level += 1
+        octave = self.octave(level)
+        if (size == (octave.shape[1], octave.shape[0])):
+            return octave
+        return self._get(('grayResized', size),
+                         lambda dst: cv2.resize(octave, size, dst=dst, interpolation=cv2.INTER_LINEAR),
+                         (size[1], size[0]))
+
+    def edges(self, width, height):
+        size = (int(width), int(height))
+        return self._get(('edges', size, self.low, self.high),
+                         lambda dst: cv2.Canny(self.gray(width, height), self.low, self.high, edges=dst),
+                         (size[1], size[0]))
+
+    def blurredEdges(self, width, height):
+        # Edges softened so that near misses still correlate (coarse search)
+        size = (int(width), int(height))
+        edges = self.edges(width, height)
+        return self._get(('blurredEdges', size, self.low, self.high),
+                         lambda dst: cv2.GaussianBlur(edges, (3, 3), 0, dst=dst),
+                         (size[1], size[0]))
+
+
+class PyramidMatcher:
+    def __init__(self, template, minScale=0.2, maxScale=1.0, numScales=20,
+                 decimation=2, candidates=3, low=50, high=200):
+        """
+        Args:
+            template: gray (or BGR) image of the target at the smallest size
+                it is to be found at
+            minScale, maxScale, numScales: the image is scaled to
+                numScales sizes from maxScale down to minScale, so targets
+                from 1/maxScale to 1/minScale times the template's size are
+                found (the same as match.py)
+            decimation: how much smaller the coarse search's images are;
+                less if the template would end up narrower than
+                MIN_COARSE_WIDTH
+            candidates: how many of the best coarse peaks are refined
+            low, high: Canny hysteresis thresholds
+        """
+        if (len(template.shape) == 3):
+            template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        self.scales = np.linspace(minScale, maxScale, numScales)[::-1]
+        self.candidates = max(1, candidates)
+        self.low = low
+        self.high = high
+
+        # Template edges at full and coarse resolution, made once
+        self.template = cv2.Canny(template, low, high)
+        (self.tH, self.tW) = self.template.shape[:2]
+        self.decimation = max(1, min(int(decimation), self.tW // MIN_COARSE_WIDTH))
+        if (self.decimation > 1):
+            coarse = cv2.resize(template, (self.tW // self.decimation, self.tH // self.decimation),
+                                interpolation=cv2.INTER_AREA)
+        else:
+            coarse = template
+        self.coarseTemplate = cv2.GaussianBlur(cv2.Canny(coarse, low, high), (3, 3), 0)
+        (self.cH, self.cW) = self.coarseTemplate.shape[:2]
+
+        # Fine search window around a coarse peak, in full resolution
+        # pixels on each side
+        self.margin = 2 * self.decimation + 2
+
+    def pyramid(self, gray, frame=None):
+        # Return an EdgePyramid of the image, for match()
+        return EdgePyramid(gray, self.low, self.high, frame)
+
+    def match(self, pyramid):
+        """Finds the template.
+        Args:
+            pyramid: The EdgePyramid of the image (see pyramid()).
+        Returns:
+            (score, (startX, startY, endX, endY), scale) of the best match
+            in full size image coordinates, or None if the image is smaller
+            than the template at every scale. The score is the normalized
+            correlation coefficient of the edges, from -1 to 1.
+        """
+        (height, width) = pyramid.shape()
+
+        # Coarse: the best peak of every scale, on decimated images
+        peaks = []
+        for (i, scale) in enumerate(self.scales):
+            (w, h) = (int(width * scale), int(height * scale))
+            (cw, ch) = (w // self.decimation, h // self.decimation)
+            if ((h < self.tH) or (w < self.tW) or (ch < self.cH) or (cw < self.cW)):
+                continue
+            result = cv2.matchTemplate(pyramid.blurredEdges(cw, ch), self.coarseTemplate, cv2.TM_CCORR_NORMED)
+            (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+            # Where it matched, in full size image coordinates
+            peaks.append((maxVal, i, (maxLoc[0] * width / float(cw), maxLoc[1] * height / float(ch))))
+        if (len(peaks) == 0):
+            return None
+
+        # Fine: the scales around the best few, near where each matched
+        peaks.sort(reverse=True)
+        found = None
+        for (_, index, location) in peaks[:self.candidates]:
+            first = max(0, index - 1)
+            last = min(len(self.scales), index + 2)
+            refined = self.refine(pyramid, range(first, last), location)
+            if ((refined is not None) and ((found is None) or (refined[0] > found[0]))):
+                found = refined
+        return found
+
+    def refine(self, pyramid, indexes, location):
+        # Full resolution search at the given scales, only around location
+        # (full size image coordinates) if there is one
+        (height, width) = pyramid.shape()
+        found = None
+        for i in indexes:
+            scale = self.scales[i]
+            (w, h) = (int(width * scale), int(height * scale))
+            if ((h < self.tH) or (w < self.tW)):
+                continue
+            if (location is None):
+                (left, top) = (0, 0)
+                edges = pyramid.edges(w, h)
+            else:
+                # Canny only the window (plus a little, so that its own
+                # edges are not taken for the image's)
+                pad = 2
+                x = int(location[0] * w / float(width))
+                y = int(location[1] * h / float(height))
+                left = max(0, x - self.margin)
+                top = max(0, y - self.margin)
+                right = min(w, x + self.tW + self.margin)
+                bottom = min(h, y + self.tH + self.margin)
+                if ((right - left < self.tW) or (bottom - top < self.tH)):
+                    continue
+                gray = pyramid.gray(w, h)
+                (padLeft, padTop) = (max(0, left - pad), max(0, top - pad))
+                window = gray[padTop:min(h, bottom + pad), padLeft:min(w, right + pad)]
+                edges = cv2.Canny(window, self.low, self.high)
+                edges = edges[top - padTop:bottom - padTop, left - padLeft:right - padLeft]
+            result = cv2.matchTemplate(edges, self.template, cv2.TM_CCOEFF_NORMED)
+            (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+            if ((found is None) or (maxVal > found[0])):
+                found = (maxVal, (left + maxLoc[0], top + maxLoc[1]), width / float(w))
+
+        if (found is None):
+            return None
+        (maxVal, maxLoc, r) = found
+        (startX, startY) = (int(maxLoc[0] * r), int(maxLoc[1] * r))
+        (endX, endY) = (int((maxLoc[0] + self.tW) * r), int((maxLoc[1] + self.tH) * r))
+        return (maxVal, (startX, startY, endX, endY), 1.0 / r)
+
+    def matchExhaustive(self, pyramid):
+        # Every scale over the whole image, like match.py always did (for
+        # checking the coarse-to-fine answer)
+        return self.refine(pyramid, range(len(self.scales)), None)
+
+
+class TemplateMatch:
+    """
+    Pipeline that finds a template in each frame with a PyramidMatcher
+    and reports where it is as <prefix>Found, <prefix>Score,
+    <prefix>CenterX, <prefix>Center_deg and <prefix>Latency_ms.
+    """
+
+    def __init__(self, networkTable, templatePath, prefix, templateWidth=64, minScore=0.32, **matcherOptions):
+        """initializes all values to presets or None if need to be set
+
+        templateWidth is the width in pixels of the smallest appearance of
+        the target to look for; targets up to 1/minScale times that are
+        found. A match is only reported when its score (-1 to 1) is above
+        minScore; with the shirt pasted into our boiler images at 1 to 4
+        times the template's size, 0.32 kept 99 of 120 and was above every
+        score of 150 images without it.
+        """
+        self.networkTable = networkTable
+        self.prefix = prefix
+        self.minScore = minScore
+
+        template = cv2.imread(templatePath, cv2.IMREAD_GRAYSCALE)
+        if (template is None):
+            raise IOError("Could not read template " + templatePath)
+        height = max(1, int(round(template.shape[0] * templateWidth / float(template.shape[1]))))
+        template = cv2.resize(template, (int(templateWidth), height), interpolation=cv2.INTER_AREA)
+        self.matcher = PyramidMatcher(template, **matcherOptions)
+
+        # Cheaper mode the BucketProcessor may switch us to when it is
+        # behind (see setQuality()): half the scales, and only the best
+        # coarse peak refined (about 2.5x quicker, the size a little less
+        # exact)
+        self.qualityLevels = 2
+        self.quality = 0
+        options = dict(matcherOptions)
+        options['numScales'] = max(2, options.get('numScales', 20) // 2)
+        options['candidates'] = 1
+        self.fastMatcher = PyramidMatcher(template, **options)
+
+        # The camera frame our image is a copy of, when the BucketProcessor
+        # gives us one, so the edges can be shared (see framecache.py)
+        self.frame = None
+
+        # Monotonic time the frame was captured, when the BucketProcessor
+        # tells us (see clock.py)
+        self.captureTime = None
+
+        self.found = None
+
+    def setQuality(self, level):
+        # 0 is full quality, 1 uses the fastMatcher
+        self.quality = level
+
+    def process(self, source0):
+        """
+        Runs the pipeline and sets all outputs to new values.
+        """
+        if (self.frame is not None):
+            pyramid = self.matcher.pyramid(self.frame.cache.gray(), self.frame)
+        else:
+            pyramid = self.matcher.pyramid(cv2.cvtColor(source0, cv2.COLOR_BGR2GRAY))
+        if (self.quality == 0):
+            self.found = self.matcher.match(pyramid)
+        else:
+            self.found = self.fastMatcher.match(pyramid)
+
+        FOV_deg = 63.2 # Field of View in degrees Approximately and empirically determined
+        nan = float('NaN')
+
+        if (self.captureTime is not None):
+            self.networkTable.putNumber(self.prefix + "Latency_ms",1000.0 * (monotonic() - self.captureTime))
+        else:
+            self.networkTable.putNumber(self.prefix + "Latency_ms",nan)
+
+        if ((self.found is not None) and (self.found[0] > self.minScore)):
+            (score, (startX, startY, endX, endY), scale) = self.found
+            centerX = (startX + endX) / 2.0
+            centerFraction = ((2.0*centerX)/source0.shape[1]) - 1.0
+            center_deg = FOV_deg/2 * centerFraction
+
+            self.networkTable.putBoolean(self.prefix + "Found",True)
+            self.networkTable.putNumber(self.prefix + "Score",score)
+            self.networkTable.putNumber(self.prefix + "CenterX",centerFraction)
+            self.networkTable.putNumber(self.prefix + "Center_deg",center_deg)
+
+            cv2.rectangle(source0, (startX, startY), (endX, endY), (0, 0, 255), 2)
+        else:
+            self.networkTable.putBoolean(self.prefix + "Found",False)
+            self.networkTable.putNumber(self.prefix + "Score",nan)
+            self.networkTable.putNumber(self.prefix + "CenterX",nan)
+            self.networkTable.putNumber(self.prefix + "Center_deg",nan)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+threadcpu
+
+CPU time used by each of our threads (Linux only)
+
+Every stage runs in its own thread, so the per-process CPU figure from top
+does not say which stage is eating the coprocessor. The kernel keeps the
+CPU time of each thread in /proc/self/task/<tid>/stat; all we need is to
+know which tid is which stage, so each stage thread calls
+
+    threadcpu.register("BucketCapture FrontCam")
+
+when it starts. That records its kernel thread id (gettid(), which Python 2
+does not expose, so we make the system call through ctypes) and also sets
+the thread's name in the kernel, so the stages can be told apart in
+top -H and ps -L as well.
+
+Where /proc or the system call is not available, register() does nothing
+and cpuTimes() returns nothing.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+
+# SYS_gettid differs by architecture
+_SYS_GETTID = {'x86_64' : 186, 'i386' : 224, 'i686' : 224, 'aarch64' : 178}
+PR_SET_NAME = 15
+
+_libc = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (OSError, TypeError):
+    pass
+
+_lock = threading.Lock()
+_names = {}     # tid -> name given to register()
+
+try:
+    _ticksPerSecond = float(os.sysconf('SC_CLK_TCK'))
+except (AttributeError, ValueError, OSError):
+    _ticksPerSecond = 100.0
+
+def gettid():
+    # Return the kernel thread id of the calling thread, or None
+    if (hasattr(threading, 'get_native_id') == True):
+        return threading.get_native_id()
+    machine = platform.machine()
+    number = _SYS_GETTID.get(machine)
+    if ((number is None) and machine.startswith('arm')):
+        number = 224
+    if ((number is None) or (_libc is None)):
+        return None
+    return _libc.syscall(number)
+
+def register(name):
+    # Call from a thread to record which of our stages it is
+    tid = gettid()
+    if (tid is None):
+        return
+    _lock.acquire()
+    _names[tid] = name
+    _lock.release()
+
+    # The kernel's name is limited to 15 bytes; better than nothing
+    if (_libc is not None):
+        try:
+            _libc.prctl(PR_SET_NAME, ctypes.c_char_p(name[:15].encode('ascii', 'replace')), 0, 0, 0)
+        except AttributeError:
+            pass
+
+def cpuTimes():
+    # Return {tid: (name, cpuSeconds)} for every thread in this process,
+    # named as registered (or the kernel's name if never registered)
+    times = {}
+    try:
+        tids = os.listdir('/proc/self/task')
+    except OSError:
+        return times
+
+    _lock.acquire()
+    names = dict(_names)
+    _lock.release()
+
+    for entry in tids:
+        try:
+            with open('/proc/self/task/' + entry + '/stat') as f:
+                stat = f.read()
+        except IOError:
+            continue        # thread exited while we looked
+        # The name is in parentheses and may contain spaces; the fields
+        # we want are utime and stime, the 14th and 15th overall
+        close = stat.rfind(')')
+        fields = stat[close + 2:].split()
+        seconds = (int(fields[11]) + int(fields[12])) / _ticksPerSecond
+        tid = int(entry)
+        name = names.get(tid, stat[stat.find('(') + 1:close])
+        times[tid] = (name, seconds)
+
+    # Forget threads that are gone; their ids get reused
+    _lock.acquire()
+    for tid in list(_names.keys()):
+        if (tid not in times):
+            del _names[tid]
+    _lock.release()
+    return times
+
+
+class ThreadCpu:
+    # Turns cpuTimes() into percentages between calls to sample()
+    def __init__(self):
+        self._last = {}
+        self._lastTime = None
+
+    def sample(self, now):
+        """Samples the CPU time of every thread.
+        Args:
+            now: The current (monotonic) time.
+        Returns:
+            A list of (name, tid, cpuSeconds, percent) sorted by name,
+            where percent is of one core since the previous sample (0.0 on
+            the first).
+        """
+        times = cpuTimes()
+        result = []
+        for (tid, (name, seconds)) in times.items():
+            percent = 0.0
+            if ((self._lastTime is not None) and (tid in self._last) and (now > self._lastTime)):
+                percent = 100.0 * (seconds - self._last[tid]) / (now - self._lastTime)
+            result.append((name, tid, seconds, percent))
+        self._last = dict((tid, seconds) for (tid, (name, seconds)) in times.items())
+        self._lastTime = now
+        result.sort()
+        return result
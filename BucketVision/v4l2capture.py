@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+v4l2capture
+
+Direct Video4Linux2 capture using driver mmap buffers
+
+cv2.VideoCapture.read() allocates a new BGR frame every time it is called;
+at our frame rates that memory churn costs more than some of the pipelines.
+This class talks to the V4L2 driver directly (ioctl + mmap) and hands out
+views on a fixed pool of buffers that are allocated exactly once.
+
+The interface mimics the subset of cv2.VideoCapture used by BucketCapture
+(read, get, set, isOpened, release) so it can be swapped in as the stream.
+
+NOTE: Linux only, and only for drivers that support streaming I/O with
+MMAP buffers (all of the UVC webcams we use do)
+"""
+
+import ctypes
+import fcntl
+import mmap
+import os
+import select
+
+import cv2
+import numpy as np
+
+import clock
+
+# ---------------------------------------------------------------------------
+# ioctl request encoding (see linux/ioctl.h); sizes are taken from the
+# ctypes structures so the requests are correct on both ARM and x86
+_IOC_NRBITS = 8
+_IOC_TYPEBITS = 8
+_IOC_SIZEBITS = 14
+
+_IOC_NRSHIFT = 0
+_IOC_TYPESHIFT = _IOC_NRSHIFT + _IOC_NRBITS
+_IOC_SIZESHIFT = _IOC_TYPESHIFT + _IOC_TYPEBITS
+_IOC_DIRSHIFT = _IOC_SIZESHIFT + _IOC_SIZEBITS
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _IOC(dir, type, nr, size):
+    return ((dir << _IOC_DIRSHIFT) |
+            (ord(type) << _IOC_TYPESHIFT) |
+            (nr << _IOC_NRSHIFT) |
+            (size << _IOC_SIZESHIFT))
+
+def _IOR(type, nr, struct):
+    return _IOC(_IOC_READ, type, nr, ctypes.sizeof(struct))
+
+def _IOW(type, nr, struct):
+    return _IOC(_IOC_WRITE, type, nr, ctypes.sizeof(struct))
+
+def _IOWR(type, nr, struct):
+    return _IOC(_IOC_READ | _IOC_WRITE, type, nr, ctypes.sizeof(struct))
+
+def v4l2_fourcc(a, b, c, d):
+    return ord(a) | (ord(b) << 8) | (ord(c) << 16) | (ord(d) << 24)
+
+# ---------------------------------------------------------------------------
+# Constants and structures from linux/videodev2.h (only what we need)
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+
+V4L2_PIX_FMT_YUYV = v4l2_fourcc('Y', 'U', 'Y', 'V')
+V4L2_PIX_FMT_BGR24 = v4l2_fourcc('B', 'G', 'R', '3')
+
+V4L2_CID_BASE = 0x00980900
+V4L2_CID_BRIGHTNESS = V4L2_CID_BASE + 0
+V4L2_CID_CONTRAST = V4L2_CID_BASE + 1
+V4L2_CID_SATURATION = V4L2_CID_BASE + 2
+V4L2_CID_CAMERA_CLASS_BASE = 0x009a0900
+V4L2_CID_EXPOSURE_AUTO = V4L2_CID_CAMERA_CLASS_BASE + 1
+V4L2_CID_EXPOSURE_ABSOLUTE = V4L2_CID_CAMERA_CLASS_BASE + 2
+
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0x0000e000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x00002000
+
+V4L2_EXPOSURE_MANUAL = 1
+V4L2_EXPOSURE_APERTURE_PRIORITY = 3
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [('driver', ctypes.c_char * 16),
+                ('card', ctypes.c_char * 32),
+                ('bus_info', ctypes.c_char * 32),
+                ('version', ctypes.c_uint32),
+                ('capabilities', ctypes.c_uint32),
+                ('device_caps', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 3)]
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [('width', ctypes.c_uint32),
+                ('height', ctypes.c_uint32),
+                ('pixelformat', ctypes.c_uint32),
+                ('field', ctypes.c_uint32),
+                ('bytesperline', ctypes.c_uint32),
+                ('sizeimage', ctypes.c_uint32),
+                ('colorspace', ctypes.c_uint32),
+                ('priv', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('ycbcr_enc', ctypes.c_uint32),
+                ('quantization', ctypes.c_uint32),
+                ('xfer_func', ctypes.c_uint32)]
+
+class _v4l2_format_union(ctypes.Union):
+    # The kernel union also holds v4l2_window, which contains pointers;
+    # the c_void_p member reproduces that alignment
+    _fields_ = [('pix', v4l2_pix_format),
+                ('raw_data', ctypes.c_char * 200),
+                ('_align', ctypes.c_void_p)]
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32),
+                ('fmt', _v4l2_format_union)]
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [('count', ctypes.c_uint32),
+                ('type', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 2)]
+
+class timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('frames', ctypes.c_uint8),
+                ('seconds', ctypes.c_uint8),
+                ('minutes', ctypes.c_uint8),
+                ('hours', ctypes.c_uint8),
+                ('userbits', ctypes.c_uint8 * 4)]
+
+class _v4l2_buffer_m(ctypes.Union):
+    _fields_ = [('offset', ctypes.c_uint32),
+                ('userptr', ctypes.c_ulong),
+                ('planes', ctypes.c_void_p),
+                ('fd', ctypes.c_int32)]
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [('index', ctypes.c_uint32),
+                ('type', ctypes.c_uint32),
+                ('bytesused', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('field', ctypes.c_uint32),
+                ('timestamp', timeval),
+                ('timecode', v4l2_timecode),
+                ('sequence', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32),
+                ('m', _v4l2_buffer_m),
+                ('length', ctypes.c_uint32),
+                ('reserved2', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32)]
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [('numerator', ctypes.c_uint32),
+                ('denominator', ctypes.c_uint32)]
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [('capability', ctypes.c_uint32),
+                ('capturemode', ctypes.c_uint32),
+                ('timeperframe', v4l2_fract),
+                ('extendedmode', ctypes.c_uint32),
+                ('readbuffers', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 4)]
+
+class _v4l2_streamparm_union(ctypes.Union):
+    _fields_ = [('capture', v4l2_captureparm),
+                ('raw_data', ctypes.c_char * 200)]
+
+class v4l2_streamparm(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32),
+                ('parm', _v4l2_streamparm_union)]
+
+class v4l2_control(ctypes.Structure):
+    _fields_ = [('id', ctypes.c_uint32),
+                ('value', ctypes.c_int32)]
+
+VIDIOC_QUERYCAP = _IOR('V', 0, v4l2_capability)
+VIDIOC_S_FMT = _IOWR('V', 5, v4l2_format)
+VIDIOC_REQBUFS = _IOWR('V', 8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _IOWR('V', 9, v4l2_buffer)
+VIDIOC_QBUF = _IOWR('V', 15, v4l2_buffer)
+VIDIOC_DQBUF = _IOWR('V', 17, v4l2_buffer)
+VIDIOC_STREAMON = _IOW('V', 18, ctypes.c_int)
+VIDIOC_STREAMOFF = _IOW('V', 19, ctypes.c_int)
+VIDIOC_G_PARM = _IOWR('V', 21, v4l2_streamparm)
+VIDIOC_G_CTRL = _IOWR('V', 27, v4l2_control)
+VIDIOC_S_CTRL = _IOWR('V', 28, v4l2_control)
+
+# Map the cv2 property ids BucketCapture uses onto V4L2 controls
+_CV_TO_V4L2_CID = {cv2.CAP_PROP_BRIGHTNESS : V4L2_CID_BRIGHTNESS,
+                   cv2.CAP_PROP_CONTRAST : V4L2_CID_CONTRAST,
+                   cv2.CAP_PROP_SATURATION : V4L2_CID_SATURATION,
+                   cv2.CAP_PROP_EXPOSURE : V4L2_CID_EXPOSURE_ABSOLUTE}
+
+
+class V4L2Capture:
+    def __init__(self, src, width, height, numBuffers=4, poolSize=4, timeout=1.0):
+        """Opens the device and starts streaming into mmap'd driver buffers
+        Args:
+            src: device index (e.g., 0 for /dev/video0) or device path
+            width, height: requested frame size; the driver may adjust it
+            numBuffers: number of driver buffers to request
+            poolSize: number of BGR output frames rotated through by read()
+            timeout: seconds to wait for a frame before read() gives up
+        """
+        if (isinstance(src, int)):
+            self.device = '/dev/video' + str(src)
+        else:
+            self.device = src
+
+        self.timeout = timeout
+        self._fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK)
+        self._buffers = []
+        self._streaming = False
+
+        cap = v4l2_capability()
+        fcntl.ioctl(self._fd, VIDIOC_QUERYCAP, cap)
+        if ((cap.capabilities & V4L2_CAP_VIDEO_CAPTURE) == 0 or
+            (cap.capabilities & V4L2_CAP_STREAMING) == 0):
+            os.close(self._fd)
+            raise IOError(self.device + " does not support streaming video capture")
+
+        # Prefer a format we can hand out without any conversion; fall back
+        # to YUYV which every UVC camera supports
+        for pixelformat in (V4L2_PIX_FMT_BGR24, V4L2_PIX_FMT_YUYV):
+            fmt = v4l2_format()
+            fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            fmt.fmt.pix.width = int(width)
+            fmt.fmt.pix.height = int(height)
+            fmt.fmt.pix.pixelformat = pixelformat
+            fmt.fmt.pix.field = V4L2_FIELD_ANY
+            fcntl.ioctl(self._fd, VIDIOC_S_FMT, fmt)
+            if (fmt.fmt.pix.pixelformat == pixelformat):
+                break
+        else:
+            os.close(self._fd)
+            raise IOError(self.device + " supports neither BGR3 nor YUYV")
+
+        self.pixelformat = fmt.fmt.pix.pixelformat
+        self.width = fmt.fmt.pix.width
+        self.height = fmt.fmt.pix.height
+        self.bytesperline = fmt.fmt.pix.bytesperline
+
+        req = v4l2_requestbuffers()
+        req.count = numBuffers
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self._fd, VIDIOC_REQBUFS, req)
+        if (req.count < 2):
+            os.close(self._fd)
+            raise IOError(self.device + " could not allocate capture buffers")
+
+        # Map each driver buffer exactly once and keep a numpy view on it
+        if (self.pixelformat == V4L2_PIX_FMT_BGR24):
+            channels = 3
+        else:
+            channels = 2
+        for i in range(req.count):
+            buf = v4l2_buffer()
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_MMAP
+            buf.index = i
+            fcntl.ioctl(self._fd, VIDIOC_QUERYBUF, buf)
+            mm = mmap.mmap(self._fd, buf.length, mmap.MAP_SHARED,
+                           mmap.PROT_READ | mmap.PROT_WRITE, offset=buf.m.offset)
+            raw = np.frombuffer(mm, dtype=np.uint8, count=self.bytesperline * self.height)
+            view = np.lib.stride_tricks.as_strided(raw,
+                                                   shape=(self.height, self.width, channels),
+                                                   strides=(self.bytesperline, channels, 1))
+            self._buffers.append((mm, view))
+
+        # YUYV must be converted, so the conversion target is a fixed
+        # pool of BGR frames that we rotate through
+        self._pool = []
+        if (self.pixelformat == V4L2_PIX_FMT_YUYV):
+            for i in range(poolSize):
+                self._pool.append(np.empty((self.height, self.width, 3), dtype=np.uint8))
+        self._poolIndex = 0
+
+        # BGR buffers are handed out in place, so they are only given back
+        # to the driver once they are old enough that the consumer is done
+        # with them; keep at least two with the driver so it never starves
+        self._held = []
+        self._holdCount = max(1, req.count - 2)
+
+        self.timestamp = 0.0        # monotonic time the last frame was captured
+        self.driverTimestamp = False    # True once the driver stamped one
+        self.sequence = 0
+
+        for i in range(req.count):
+            self._queue(i)
+
+        fcntl.ioctl(self._fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        self._streaming = True
+
+    def _queue(self, index):
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        buf.index = index
+        fcntl.ioctl(self._fd, VIDIOC_QBUF, buf)
+
+    def isOpened(self):
+        return self._streaming
+
+    def read(self, image=None):
+        """Returns (grabbed, frame) like cv2.VideoCapture.read()
+        If image is supplied the frame is written into it; otherwise the
+        frame is a view on one of the preallocated buffers and remains
+        valid until that buffer comes back around.
+        """
+        if (self._streaming == False):
+            return (False, None)
+
+        r, w, e = select.select([self._fd], [], [], self.timeout)
+        if (r == []):
+            return (False, None)
+
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        try:
+            fcntl.ioctl(self._fd, VIDIOC_DQBUF, buf)
+        except IOError:
+            return (False, None)
+
+        # UVC drivers stamp the buffer with CLOCK_MONOTONIC when the first
+        # bytes of the frame arrive, which is as close to the exposure as
+        # we can get; older drivers may use another clock, in which case
+        # the time we dequeued it will have to do
+        if ((buf.flags & V4L2_BUF_FLAG_TIMESTAMP_MASK) == V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC):
+            self.timestamp = buf.timestamp.tv_sec + buf.timestamp.tv_usec * 1e-6
+            self.driverTimestamp = True
+        else:
+            self.timestamp = clock.monotonic()
+            self.driverTimestamp = False
+        self.sequence = buf.sequence
+        view = self._buffers[buf.index][1]
+
+        if (self.pixelformat == V4L2_PIX_FMT_YUYV):
+            if (image is None):
+                image = self._pool[self._poolIndex]
+                self._poolIndex = (self._poolIndex + 1) % len(self._pool)
+            cv2.cvtColor(view, cv2.COLOR_YUV2BGR_YUYV, dst=image)
+            self._queue(buf.index)
+            return (True, image)
+
+        if (image is not None):
+            np.copyto(image, view)
+            self._queue(buf.index)
+            return (True, image)
+
+        # Zero-copy: hand out the driver buffer itself
+        self._held.append(buf.index)
+        if (len(self._held) > self._holdCount):
+            self._queue(self._held.pop(0))
+        return (True, view)
+
+    def get(self, propId):
+        if (propId == cv2.CAP_PROP_FRAME_WIDTH):
+            return float(self.width)
+        elif (propId == cv2.CAP_PROP_FRAME_HEIGHT):
+            return float(self.height)
+        elif (propId == cv2.CAP_PROP_FPS):
+            parm = v4l2_streamparm()
+            parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            try:
+                fcntl.ioctl(self._fd, VIDIOC_G_PARM, parm)
+            except IOError:
+                return 0.0
+            tpf = parm.parm.capture.timeperframe
+            if (tpf.numerator == 0):
+                return 0.0
+            return float(tpf.denominator) / tpf.numerator
+        elif (propId in _CV_TO_V4L2_CID):
+            ctrl = v4l2_control()
+            ctrl.id = _CV_TO_V4L2_CID[propId]
+            try:
+                fcntl.ioctl(self._fd, VIDIOC_G_CTRL, ctrl)
+            except IOError:
+                return 0.0
+            return float(ctrl.value)
+        return 0.0
+
+    def set(self, propId, value):
+        if (propId not in _CV_TO_V4L2_CID):
+            return False
+
+        try:
+            if (propId == cv2.CAP_PROP_EXPOSURE):
+                # Negative exposure means "let the camera decide"
+                ctrl = v4l2_control()
+                ctrl.id = V4L2_CID_EXPOSURE_AUTO
+                if (value < 0):
+                    ctrl.value = V4L2_EXPOSURE_APERTURE_PRIORITY
+                    fcntl.ioctl(self._fd, VIDIOC_S_CTRL, ctrl)
+                    return True
+                ctrl.value = V4L2_EXPOSURE_MANUAL
+                fcntl.ioctl(self._fd, VIDIOC_S_CTRL, ctrl)
+
+            ctrl = v4l2_control()
+            ctrl.id = _CV_TO_V4L2_CID[propId]
+            ctrl.value = int(value)
+            fcntl.ioctl(self._fd, VIDIOC_S_CTRL, ctrl)
+        except IOError as e:
+            print(self.device + " control failed: " + str(e))
+            return False
+        return True
+
+    def release(self):
+        if (self._streaming == True):
+            self._streaming = False
+            fcntl.ioctl(self._fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        for (mm, view) in self._buffers:
+            try:
+                mm.close()
+            except BufferError:
+                # A consumer still holds a view; the mapping goes away with it
+                pass
+        self._buffers = []
+        if (self._fd is not None):
+            os.close(self._fd)
+            self._fd = None